@@ -10,14 +10,46 @@ Features:
 - VECTOR_COSINE_SIMILARITY for document retrieval
 """
 
+import asyncio
+import atexit
+import bisect
+import contextvars
+import cProfile
+import csv
+import fcntl
+import gzip
+import hashlib
+import io
+import itertools
+import json
+import math
+import mmap
+import multiprocessing
 import os
+import pickle
 import random
-from datetime import datetime, timedelta
+import threading
+import time
+import unicodedata
+from collections import OrderedDict, namedtuple
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, ThreadPoolExecutor, wait
+from concurrent.futures.process import BrokenProcessPool
+from contextlib import contextmanager
+from functools import lru_cache, wraps
+from datetime import datetime, timedelta, timezone
+from types import MappingProxyType
+import re
 import secrets
+import shutil
+import socket
+import sqlite3
 import statistics
-from flask import Flask, request, jsonify
+import tempfile
+from flask import Flask, Response, request, jsonify, stream_with_context
+from flask.json.provider import DefaultJSONProvider
 from flask_cors import CORS
 from dotenv import load_dotenv
+import numpy as np
 import snowflake.connector
 
 load_dotenv()
@@ -34,6 +66,8 @@ app.config['SECRET_KEY'] = os.getenv('SECRET_KEY', secrets.token_hex(32))
 
 # Company salary multipliers relative to market median (1.0 = market average)
 # Based on publicly available salary data from Levels.fyi, Glassdoor, etc.
+# These seed the transparent_companies registry (see COMPANY REGISTRY);
+# edit the table to change them without a redeploy.
 COMPANY_SALARY_DATA = {
     # FAANG / Big Tech (Premium pay)
     'google': {'multiplier': 1.45, 'name': 'Google', 'tier': 'top'},
@@ -131,27 +165,430 @@ COMPANY_SALARY_DATA = {
     't-mobile': {'multiplier': 1.05, 'name': 'T-Mobile', 'tier': 'mid'},
 }
 
-def get_company_data(company_name):
-    """Get company salary data based on company name."""
-    if not company_name:
+# Alternate names that do not contain the key or display name
+COMPANY_ALIASES = {
+    'google': ['alphabet'],
+    'meta': ['meta platforms'],
+    'amazon': ['aws', 'amazon web services'],
+    'jpmorgan': ['jp morgan', 'chase'],
+    'american express': ['amex'],
+    'bcg': ['boston consulting group'],
+    'pwc': ['pricewaterhousecoopers', 'price waterhouse coopers'],
+    'ey': ['ernst young'],
+    'ea': ['ea games'],
+    'at&t': ['att'],
+    'unitedhealth': ['unitedhealth group', 'united health group', 'optum'],
+}
+
+
+class CompanyMatcher:
+    """
+    Resolves free-text company names ("Google LLC", "JP Morgan", "Microsft")
+    to company records. Built once from a {key: record} mapping plus an
+    optional {key: [alias, ...]} mapping.
+
+    Names are compared as word tokens, so short keys like "ea" or "ey" only
+    match a whole word. Lookup order, first hit wins:
+
+    1. alias index: the whole name (minus legal suffixes such as "Inc"),
+       spaced or run together, equals a key, display name or alias;
+    2. Aho-Corasick automaton over the same patterns: the longest pattern
+       occurring as a run of words inside the name;
+    3. token index: a word that is the distinctive first word of exactly one
+       multi-word name ("Goldman" -> Goldman Sachs);
+    4. fuzzy: bounded Levenshtein distance (1 edit for 5-9 characters, 2 for
+       longer names, none for shorter ones) against run-together names,
+       with candidates found through a single-deletion index.
+
+    Results are memoized per matcher, so repeated names cost a dict lookup.
+    """
+
+    LEGAL_SUFFIXES = frozenset({
+        'inc', 'incorporated', 'llc', 'llp', 'lp', 'ltd', 'limited', 'corp', 'corporation',
+        'co', 'company', 'plc', 'gmbh', 'ag', 'sa', 'holdings', 'group',
+    })
+    GENERIC_TOKENS = frozenset({
+        'american', 'bank', 'capital', 'first', 'general', 'global', 'international',
+        'national', 'united', 'games', 'health', 'systems', 'technologies', 'solutions',
+    })
+
+    def __init__(self, companies, aliases=None, cache_size=4096):
+        self.records = []
+        self._exact = {}
+        self._goto = [{}]
+        self._fail = [0]
+        self._out = [[]]
+        self._first_tokens = {}
+        self._deletes = {}
+        self._fuzzy_names = []
+        self._exact_compacts = set()
+        aliases = aliases or {}
+
+        first_token_owners = {}
+        for key, record in companies.items():
+            record_id = len(self.records)
+            self.records.append(record)
+            for pattern in (key, record['name'], *aliases.get(key, ())):
+                tokens = self.tokenize(pattern)
+                for form in {tokens, self.strip_suffixes(tokens)}:
+                    if form:
+                        self._add_pattern(form, record_id)
+                if len(tokens) > 1:
+                    first_token_owners.setdefault(tokens[0], set()).add(record['name'])
+                    self._first_tokens.setdefault(tokens[0], record_id)
+
+        for token, owners in first_token_owners.items():
+            if len(owners) > 1 or token in self.GENERIC_TOKENS or len(token) < 4 or token in self._exact:
+                del self._first_tokens[token]
+
+        self._build_failure_links()
+        self.match = lru_cache(maxsize=cache_size)(self._match)
+
+    @staticmethod
+    def tokenize(text):
+        text = unicodedata.normalize('NFKD', text).encode('ascii', 'ignore').decode().lower()
+        return tuple(t for t in re.findall(r'[a-z0-9]+', text) if t != 'and')
+
+    @classmethod
+    def strip_suffixes(cls, tokens):
+        start, end = (1 if tokens[:1] == ('the',) else 0), len(tokens)
+        while end - start > 1 and tokens[end - 1] in cls.LEGAL_SUFFIXES:
+            end -= 1
+        return tokens[start:end]
+
+    @staticmethod
+    def max_edits(length):
+        return 0 if length < 5 else 1 if length < 10 else 2
+
+    def _add_pattern(self, tokens, record_id):
+        self._exact.setdefault(' '.join(tokens), record_id)
+        compact = ''.join(tokens)
+        self._exact.setdefault(compact, record_id)
+
+        state = 0
+        for token in tokens:
+            nxt = self._goto[state].get(token)
+            if nxt is None:
+                nxt = len(self._goto)
+                self._goto[state][token] = nxt
+                self._goto.append({})
+                self._fail.append(0)
+                self._out.append([])
+            state = nxt
+        if not self._out[state]:
+            self._out[state].append((len(tokens), len(compact), record_id))
+
+        if self.max_edits(len(compact)) and compact not in self._exact_compacts:
+            self._exact_compacts.add(compact)
+            name_id = len(self._fuzzy_names)
+            self._fuzzy_names.append((compact, record_id))
+            for variant in self.deletion_variants(compact):
+                self._deletes.setdefault(variant, []).append(name_id)
+
+    @staticmethod
+    def deletion_variants(text):
+        return {text, *(text[:i] + text[i + 1:] for i in range(len(text)))}
+
+    def _build_failure_links(self):
+        # Breadth-first from the root's children, whose failure link is the root
+        queue = list(self._goto[0].values())
+        for state in queue:
+            for token, nxt in self._goto[state].items():
+                queue.append(nxt)
+                fail = self._fail[state]
+                while fail and token not in self._goto[fail]:
+                    fail = self._fail[fail]
+                self._fail[nxt] = self._goto[fail].get(token, 0)
+                self._out[nxt] = self._out[nxt] + self._out[self._fail[nxt]]
+
+    def _scan(self, tokens):
+        """Best (longest) pattern occurring as a run of words in `tokens`."""
+        best = None
+        state = 0
+        for token in tokens:
+            while state and token not in self._goto[state]:
+                state = self._fail[state]
+            state = self._goto[state].get(token, 0)
+            for n_tokens, n_chars, record_id in self._out[state]:
+                if best is None or (n_tokens, n_chars) > best[:2]:
+                    best = (n_tokens, n_chars, record_id)
+        return best[2] if best else None
+
+    def _fuzzy(self, compact):
+        limit = self.max_edits(len(compact))
+        if not limit:
+            return None
+        candidates = set()
+        for variant in self.deletion_variants(compact):
+            candidates.update(self._deletes.get(variant, ()))
+        best = None
+        for name_id in candidates:
+            name, record_id = self._fuzzy_names[name_id]
+            distance = bounded_levenshtein(compact, name, min(limit, self.max_edits(len(name))))
+            if distance is not None and (best is None or distance < best[0]):
+                best = (distance, record_id)
+        return best[1] if best else None
+
+    def _match(self, company_name):
+        tokens = self.tokenize(company_name or '')
+        if not tokens:
+            return None
+        stripped = self.strip_suffixes(tokens)
+
+        record_id = self._exact.get(' '.join(stripped))
+        if record_id is None:
+            record_id = self._exact.get(''.join(stripped))
+        if record_id is None:
+            record_id = self._scan(tokens)
+        if record_id is None:
+            record_id = next((self._first_tokens[t] for t in stripped if t in self._first_tokens), None)
+        if record_id is None:
+            # Whole name first, then its longest words ("Amazn Web Services")
+            candidates = [''.join(stripped)]
+            if len(stripped) > 1:
+                candidates += sorted(stripped, key=len, reverse=True)
+            record_id = next((r for r in map(self._fuzzy, candidates) if r is not None), None)
+        return self.records[record_id] if record_id is not None else None
+
+
+def bounded_levenshtein(a, b, limit):
+    """Edit distance between a and b, or None if it exceeds `limit`."""
+    if abs(len(a) - len(b)) > limit:
         return None
+    previous = list(range(len(b) + 1))
+    for i, ca in enumerate(a, 1):
+        current = [i]
+        for j, cb in enumerate(b, 1):
+            current.append(min(previous[j] + 1, current[j - 1] + 1, previous[j - 1] + (ca != cb)))
+        if min(current) > limit:
+            return None
+        previous = current
+    return previous[-1] if previous[-1] <= limit else None
+
+
+# =============================================================================
+# INSTRUMENTATION
+# =============================================================================
+# Every request gets a RequestTrace; code on the hot path wraps its work in
+# span('pool_wait' | 'connect' | 'execute' | 'fetch' | 'serialize' | 'llm' | 'rag' | 'embed').
+# Spans and per-query timings feed the Prometheus histograms served at
+# /metrics (per process: each gunicorn worker keeps its own). SERVER_TIMING=1
+# adds a Server-Timing header; PROFILE_SAMPLE_RATE > 0 profiles a sample of
+# requests and keeps the cProfile dumps of those slower than PROFILE_SLOW_MS.
+
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+
+class Histogram:
+    """Prometheus-style cumulative histogram, one series per label tuple."""
+
+    def __init__(self, name, help_text, label_names, buckets=LATENCY_BUCKETS, max_series=500):
+        self.name = name
+        self.help_text = help_text
+        self.label_names = label_names
+        self.buckets = buckets
+        self.max_series = max_series
+        self._lock = threading.Lock()
+        self._series = {}  # labels -> [bucket counts..., sum, count]
+
+    def observe(self, labels, seconds):
+        i = bisect.bisect_left(self.buckets, seconds)
+        with self._lock:
+            series = self._series.get(labels)
+            if series is None:
+                if len(self._series) >= self.max_series:
+                    labels = ('other',) * len(self.label_names)
+                series = self._series.setdefault(labels, [0] * (len(self.buckets) + 2))
+            if i < len(self.buckets):
+                series[i] += 1
+            series[-2] += seconds
+            series[-1] += 1
+
+    def exposition(self):
+        with self._lock:
+            series = {labels: list(values) for labels, values in self._series.items()}
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} histogram"]
+        for labels, values in sorted(series.items()):
+            base = ','.join(f'{k}="{prometheus_escape(v)}"' for k, v in zip(self.label_names, labels))
+            cumulative = 0
+            for bound, count in zip(self.buckets, values):
+                cumulative += count
+                lines.append(f'{self.name}_bucket{{{base},le="{bound:g}"}} {cumulative}')
+            lines.append(f'{self.name}_bucket{{{base},le="+Inf"}} {values[-1]}')
+            lines.append(f'{self.name}_sum{{{base}}} {values[-2]:.6f}')
+            lines.append(f'{self.name}_count{{{base}}} {values[-1]}')
+        return lines
+
+
+def prometheus_escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+REQUEST_SECONDS = Histogram('countermarket_request_duration_seconds', 'HTTP request latency.',
+                            ('route', 'method', 'status'))
+SPAN_SECONDS = Histogram('countermarket_span_duration_seconds', 'Time spent in each request phase.',
+                         ('span',))
+QUERY_SECONDS = Histogram('countermarket_query_duration_seconds', 'Database query latency (execute + fetch).',
+                          ('query',))
+
+INSTRUMENTATION_ENABLED = os.getenv('INSTRUMENTATION_ENABLED', '1') == '1'
+
+
+class RequestTrace:
+    """Span totals for one request (fan-out threads add to the same trace)."""
+
+    def __init__(self):
+        self.started = time.perf_counter()
+        self._lock = threading.Lock()
+        self.spans = {}  # name -> [seconds, count]
+        self.context_token = None
+        self.profiler = None
+
+    def add(self, name, seconds):
+        with self._lock:
+            total = self.spans.setdefault(name, [0.0, 0])
+            total[0] += seconds
+            total[1] += 1
+
+    def server_timing(self):
+        with self._lock:
+            spans = dict(self.spans)
+        parts = [f'{name};dur={seconds * 1000:.1f};desc="{count}x"' for name, (seconds, count) in spans.items()]
+        parts.append(f'total;dur={(time.perf_counter() - self.started) * 1000:.1f}')
+        return ', '.join(parts)
+
+
+_current_trace = contextvars.ContextVar('countermarket_trace', default=None)
+
+
+@contextmanager
+def span(name):
+    """Time a phase of the current request."""
+    if not INSTRUMENTATION_ENABLED:
+        yield
+        return
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        elapsed = time.perf_counter() - start
+        SPAN_SECONDS.observe((name,), elapsed)
+        trace = _current_trace.get()
+        if trace is not None:
+            trace.add(name, elapsed)
 
-    # Normalize company name for lookup
-    normalized = company_name.lower().strip()
 
-    # Direct match
-    if normalized in COMPANY_SALARY_DATA:
-        return COMPANY_SALARY_DATA[normalized]
+def traced(name):
+    """Decorator form of span()."""
+    def decorator(fn):
+        @wraps(fn)
+        def wrapper(*args, **kwargs):
+            with span(name):
+                return fn(*args, **kwargs)
+        return wrapper
+    return decorator
 
-    # Partial match (e.g., "Google Inc" -> "google")
-    for key, data in COMPANY_SALARY_DATA.items():
-        if key in normalized or normalized in key:
-            return data
-        # Also check the display name
-        if data['name'].lower() in normalized or normalized in data['name'].lower():
-            return data
 
-    return None
+def query_label(query):
+    """Bounded-cardinality label for a SQL statement: whitespace collapsed,
+    placeholder lists folded, truncated."""
+    text = ' '.join(query.split())
+    text = re.sub(r"(?:%s|\?)(?:\s*,\s*(?:%s|\?))+", '%s, ...', text)
+    text = re.sub(r"\(%s, \.\.\.\)(?:\s*,\s*\(%s, \.\.\.\))+", '(%s, ...), ...', text)
+    return text[:120]
+
+
+def observe_query(query, seconds):
+    if INSTRUMENTATION_ENABLED:
+        QUERY_SECONDS.observe((query_label(query),), seconds)
+
+
+def start_trace(profile=True):
+    """Begin tracing the current request. Pass profile=False where the
+    thread is shared by other requests (the ASGI event loop)."""
+    trace = RequestTrace()
+    trace.context_token = _current_trace.set(trace)
+    if profile:
+        trace.profiler = start_profile()
+    return trace
+
+
+def finish_trace(trace, route, method, status):
+    """Record the request; returns the Server-Timing value (or None)."""
+    elapsed = time.perf_counter() - trace.started
+    _current_trace.reset(trace.context_token)
+    if trace.profiler is not None:
+        finish_profile(trace.profiler, route, elapsed)
+    if INSTRUMENTATION_ENABLED:
+        REQUEST_SECONDS.observe((route, method, str(status)), elapsed)
+    return trace.server_timing() if server_timing_enabled() else None
+
+
+def server_timing_enabled():
+    return os.getenv('SERVER_TIMING', '0') == '1'
+
+
+# cProfile cannot profile two requests at once, so only one sampled
+# request is profiled at a time
+_profile_lock = threading.Lock()
+
+
+def start_profile():
+    rate = float(os.getenv('PROFILE_SAMPLE_RATE', 0))
+    if rate <= 0 or random.random() >= rate or not _profile_lock.acquire(blocking=False):
+        return None
+    profiler = cProfile.Profile()
+    try:
+        profiler.enable()
+    except ValueError:  # another profiler (e.g. a debugger) is active
+        _profile_lock.release()
+        return None
+    return profiler
+
+
+def finish_profile(profiler, route, seconds):
+    """Stop the profiler; keep the dump if the request was slow. Only the
+    request's own thread is profiled, not QueryPlan fan-out threads."""
+    try:
+        profiler.disable()
+    finally:
+        _profile_lock.release()
+    if seconds * 1000 < float(os.getenv('PROFILE_SLOW_MS', 500)):
+        return
+    directory = os.getenv('PROFILE_DIR', 'profiles')
+    os.makedirs(directory, exist_ok=True)
+    name = re.sub(r'[^A-Za-z0-9]+', '_', route).strip('_') or 'root'
+    path = os.path.join(directory, f"{datetime.now():%Y%m%d-%H%M%S}-{name}-{seconds * 1000:.0f}ms-{os.getpid()}.prof")
+    profiler.dump_stats(path)
+    print(f"Slow request profile written to {path}")
+
+
+class TimedJSONProvider(DefaultJSONProvider):
+    """Flask's JSON provider with serialization timed as the 'serialize' span."""
+
+    def dumps(self, obj, **kwargs):
+        with span('serialize'):
+            return super().dumps(obj, **kwargs)
+
+
+app.json = TimedJSONProvider(app)
+
+
+@app.before_request
+def begin_request_trace():
+    request.environ['countermarket.trace'] = start_trace()
+
+
+@app.after_request
+def end_request_trace(response):
+    trace = request.environ.pop('countermarket.trace', None)
+    if trace is not None:
+        route = request.url_rule.rule if request.url_rule is not None else 'unmatched'
+        timing = finish_trace(trace, route, request.method, response.status_code)
+        if timing:
+            response.headers['Server-Timing'] = timing
+    return response
+
 
 # =============================================================================
 # SNOWFLAKE CONNECTION
@@ -168,50 +605,1098 @@ def get_snowflake_connection(database=None):
         schema=os.getenv('SNOWFLAKE_SCHEMA')
     )
 
-def execute_query(query, params=None, fetch=True, database=None):
-    """Execute a Snowflake query and return results."""
-    conn = get_snowflake_connection(database)
-    try:
+
+class PoolTimeout(Exception):
+    """Raised when no pooled connection becomes available in time."""
+
+
+class ConnectionPool:
+    """
+    Bounded, thread-safe pool of database connections.
+
+    Connections are health-checked on checkout once they have been idle for
+    longer than `health_check_after` seconds, evicted after `max_idle`
+    seconds without use, and recycled once they are older than `max_lifetime`.
+    """
+
+    def __init__(self, factory, max_size=5, timeout=30.0, max_idle=300.0,
+                 max_lifetime=3600.0, health_check_after=30.0):
+        self.factory = factory
+        self.max_size = max_size
+        self.timeout = timeout
+        self.max_idle = max_idle
+        self.max_lifetime = max_lifetime
+        self.health_check_after = health_check_after
+
+        self._cond = threading.Condition()
+        self._idle = []  # stack of (conn, created_at, last_used)
+        self._created_at = {}  # id(conn) -> created_at
+        self._in_use = 0
+
+        self.created = 0
+        self.destroyed = 0
+        self.checkouts = 0
+        self.wait_time_total = 0.0  # queueing for a slot
+        self.wait_time_max = 0.0
+        self.connects = 0  # logins and health checks, timed apart from the wait
+        self.connect_time_total = 0.0
+        self.connect_time_max = 0.0
+
+    @property
+    def size(self):
+        return len(self._idle) + self._in_use
+
+    def acquire(self):
+        """Borrow a connection, opening one if the pool is below max_size."""
+        start = time.monotonic()
+        deadline = start + self.timeout
+        expired = []
+        with span('pool_wait'), self._cond:
+            while True:
+                expired.extend(self._pop_expired())
+                if self._idle:
+                    conn, created_at, last_used = self._idle.pop()
+                    self._in_use += 1
+                    break
+                if self.size < self.max_size:
+                    conn, created_at, last_used = None, None, None
+                    self._in_use += 1
+                    break
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    raise PoolTimeout(
+                        f"Timed out after {self.timeout}s waiting for a connection "
+                        f"(pool size {self.max_size})"
+                    )
+                self._cond.wait(remaining)
+            # The wait is time spent queueing for a slot, not connecting
+            waited = time.monotonic() - start
+            self.checkouts += 1
+            self.wait_time_total += waited
+            self.wait_time_max = max(self.wait_time_max, waited)
+        for stale in expired:
+            self._close(stale)
+
+        # Connect and health-check outside the lock so slow logins don't
+        # block other threads returning connections.
+        if conn is not None and time.monotonic() - last_used <= self.health_check_after:
+            return conn
+        connect_start = time.monotonic()
+        try:
+            with span('connect'):
+                if conn is not None and not self._is_healthy(conn):
+                    self._close(conn)
+                    conn = None
+                if conn is None:
+                    conn = self.factory()
+                    with self._cond:
+                        self.created += 1
+                        self._created_at[id(conn)] = time.monotonic()
+        except Exception:
+            with self._cond:
+                self._in_use -= 1
+                self._cond.notify()
+            raise
+        finally:
+            connected = time.monotonic() - connect_start
+            with self._cond:
+                self.connects += 1
+                self.connect_time_total += connected
+                self.connect_time_max = max(self.connect_time_max, connected)
+        return conn
+
+    def release(self, conn, discard=False):
+        """Return a connection to the pool, or close it if it is unusable."""
+        now = time.monotonic()
+        with self._cond:
+            self._in_use -= 1
+            created_at = self._created_at.get(id(conn), now)
+            expired = now - created_at > self.max_lifetime
+            if not discard and not expired and not self._is_closed(conn):
+                self._idle.append((conn, created_at, now))
+                conn = None
+            self._cond.notify()
+        if conn is not None:
+            self._close(conn)
+
+    @contextmanager
+    def connection(self):
+        """Context manager that borrows a connection and always returns it."""
+        conn = self.acquire()
+        discard = False
+        try:
+            yield conn
+        except Exception:
+            # Never hand the next borrower a half-finished transaction
+            discard = self._is_closed(conn)
+            if not discard:
+                try:
+                    conn.rollback()
+                except Exception:
+                    discard = True
+            raise
+        finally:
+            self.release(conn, discard=discard)
+
+    def close_all(self):
+        """Close every idle connection (borrowed ones are closed on release)."""
+        with self._cond:
+            idle, self._idle = self._idle, []
+        for conn, _, _ in idle:
+            self._close(conn)
+
+    def stats(self):
+        with self._cond:
+            return {
+                'max_size': self.max_size,
+                'in_use': self._in_use,
+                'idle': len(self._idle),
+                'created': self.created,
+                'destroyed': self.destroyed,
+                'checkouts': self.checkouts,
+                'wait_time_avg_ms': round(self.wait_time_total / self.checkouts * 1000, 3) if self.checkouts else 0.0,
+                'wait_time_max_ms': round(self.wait_time_max * 1000, 3),
+                'connects': self.connects,
+                'connect_time_avg_ms': round(self.connect_time_total / self.connects * 1000, 3) if self.connects else 0.0,
+                'connect_time_max_ms': round(self.connect_time_max * 1000, 3),
+            }
+
+    def _pop_expired(self):
+        # Caller holds the lock; the returned connections are closed after
+        # it is released.
+        now = time.monotonic()
+        keep, expired = [], []
+        for entry in self._idle:
+            conn, created_at, last_used = entry
+            if now - last_used > self.max_idle or now - created_at > self.max_lifetime:
+                expired.append(conn)
+            else:
+                keep.append(entry)
+        self._idle = keep
+        return expired
+
+    def _is_healthy(self, conn):
+        if self._is_closed(conn):
+            return False
+        try:
+            cursor = conn.cursor()
+            cursor.execute("SELECT 1")
+            cursor.fetchall()
+            cursor.close()
+            return True
+        except Exception:
+            return False
+
+    @staticmethod
+    def _is_closed(conn):
+        is_closed = getattr(conn, 'is_closed', None)
+        try:
+            return bool(is_closed()) if callable(is_closed) else False
+        except Exception:
+            return True
+
+    def _close(self, conn):
+        try:
+            conn.close()
+        except Exception:
+            pass
+        with self._cond:
+            self.destroyed += 1
+            self._created_at.pop(id(conn), None)
+
+
+# =============================================================================
+# STORAGE BACKENDS
+# =============================================================================
+
+def percentile_cont(sorted_values, fraction):
+    """PERCENTILE_CONT over an already sorted sequence (linear interpolation)."""
+    n = len(sorted_values)
+    if n == 0:
+        return None
+    position = fraction * (n - 1)
+    lower = int(position)
+    upper = min(lower + 1, n - 1)
+    weight = position - lower
+    return sorted_values[lower] + (sorted_values[upper] - sorted_values[lower]) * weight
+
+
+class _PercentileAggregate:
+    """SQLite aggregate backing PERCENTILE_CONT(value, fraction)."""
+
+    def __init__(self):
+        self.values = []
+        self.fraction = None
+
+    def step(self, value, fraction):
+        if value is not None:
+            self.values.append(float(value))
+            self.fraction = fraction
+
+    def finalize(self):
+        self.values.sort()
+        return percentile_cont(self.values, self.fraction or 0.0)
+
+
+class _MedianAggregate(_PercentileAggregate):
+    def step(self, value):
+        super().step(value, 0.5)
+
+
+class _StddevAggregate:
+    """SQLite aggregate matching Snowflake's STDDEV (sample standard deviation)."""
+
+    def __init__(self):
+        self.values = []
+
+    def step(self, value):
+        if value is not None:
+            self.values.append(float(value))
+
+    def finalize(self):
+        return statistics.stdev(self.values) if len(self.values) > 1 else None
+
+
+class UnsupportedQuery(Exception):
+    """Raised when a query uses a feature the active backend cannot run."""
+
+
+class StorageBackend:
+    """
+    Base class for the database behind execute_query.
+
+    Subclasses open DB-API connections and translate the Snowflake SQL the
+    routes are written in to their own dialect. Each backend keeps one
+    connection pool per database per worker process.
+    """
+
+    name = None
+    supports_cortex = False
+
+    def __init__(self):
+        self._pools = {}
+        self._pools_pid = None
+        self._pools_lock = threading.Lock()
+
+    def connect(self, database=None):
+        raise NotImplementedError
+
+    def translate(self, query):
+        return query
+
+    def bootstrap(self):
+        """Create the database/schema the tables live in, if needed."""
+
+    def add_column(self, table, column, column_type):
+        """Add a column to an existing table unless it is already there."""
+        execute_query(f"ALTER TABLE {table} ADD COLUMN IF NOT EXISTS {column} {column_type}", fetch=False)
+
+    def pool(self, database=None):
+        """Return this worker's pool for `database`, creating it on first use."""
+        # Pools are per process: gunicorn forks workers after import, and a
+        # connection must never be shared across a fork.
+        with self._pools_lock:
+            if self._pools_pid != os.getpid():
+                self._pools, self._pools_pid = {}, os.getpid()
+            pool = self._pools.get(database)
+            if pool is None:
+                pool = ConnectionPool(
+                    lambda: self.connect(database),
+                    max_size=int(os.getenv('DB_POOL_SIZE', 5)),
+                    timeout=float(os.getenv('DB_POOL_TIMEOUT', 30)),
+                    max_idle=float(os.getenv('DB_POOL_MAX_IDLE', 300)),
+                    max_lifetime=float(os.getenv('DB_POOL_MAX_LIFETIME', 3600)),
+                )
+                self._pools[database] = pool
+            return pool
+
+    def bulk_insert(self, table, columns, batches, database=None):
+        """
+        Insert an iterable of row batches (lists of tuples) using multi-row
+        executemany calls of DB_BULK_BATCH_SIZE rows. Returns the row count.
+        """
+        query = self.translate(
+            f"INSERT INTO {table} ({', '.join(columns)}) VALUES ({', '.join(['%s'] * len(columns))})"
+        )
+        batch_size = int(os.getenv('DB_BULK_BATCH_SIZE', 10000))
+        total = 0
+        with self.pool(database).connection() as conn:
+            cursor = conn.cursor()
+            try:
+                for rows in batches:
+                    for i in range(0, len(rows), batch_size):
+                        with span('execute'):
+                            cursor.executemany(query, rows[i:i + batch_size])
+                    total += len(rows)
+                conn.commit()
+            finally:
+                cursor.close()
+        tables_written((table,), database)
+        return total
+
+    async def execute_query_async(self, query, params=None, database=None):
+        """Awaitable read query; the default runs execute_query in a worker thread."""
+        return await asyncio.to_thread(execute_query, query, params, True, database)
+
+    def pool_stats(self):
+        with self._pools_lock:
+            pools = dict(self._pools) if self._pools_pid == os.getpid() else {}
+        return {db or 'default': p.stats() for db, p in pools.items()}
+
+    def close(self):
+        with self._pools_lock:
+            pools, self._pools = self._pools, {}
+        for pool in pools.values():
+            pool.close_all()
+
+
+class SnowflakeBackend(StorageBackend):
+    """Snowflake warehouse (the production backend)."""
+
+    name = 'snowflake'
+    supports_cortex = True
+
+    def connect(self, database=None):
+        return get_snowflake_connection(database)
+
+    def bootstrap(self):
+        # Connect without specifying a database, since it may not exist yet
+        conn = snowflake.connector.connect(
+            account=os.getenv('SNOWFLAKE_ACCOUNT'),
+            user=os.getenv('SNOWFLAKE_USER'),
+            password=os.getenv('SNOWFLAKE_PASSWORD'),
+            warehouse=os.getenv('SNOWFLAKE_WAREHOUSE')
+        )
+        try:
+            cursor = conn.cursor()
+            cursor.execute("CREATE DATABASE IF NOT EXISTS WAGEWATCH")
+            cursor.execute("USE DATABASE WAGEWATCH")
+            cursor.execute("CREATE SCHEMA IF NOT EXISTS PUBLIC")
+            conn.commit()
+            print("Database WAGEWATCH created/verified")
+        finally:
+            conn.close()
+
+    def bulk_insert(self, table, columns, batches, database=None):
+        """
+        With SNOWFLAKE_BULK_LOAD=stage, write each batch to a gzipped CSV,
+        PUT it on the table stage and load everything with one COPY INTO.
+        Otherwise use multi-row INSERTs.
+        """
+        if os.getenv('SNOWFLAKE_BULK_LOAD', 'insert') != 'stage':
+            return super().bulk_insert(table, columns, batches, database)
+
+        total = 0
+        with tempfile.TemporaryDirectory() as tmp, self.pool(database).connection() as conn:
+            cursor = conn.cursor()
+            try:
+                for n, rows in enumerate(batches):
+                    path = os.path.join(tmp, f"{table}_{n}.csv.gz")
+                    with gzip.open(path, 'wt', newline='') as f:
+                        csv.writer(f).writerows(rows)
+                    cursor.execute(f"PUT 'file://{path}' @%{table} AUTO_COMPRESS = FALSE")
+                    total += len(rows)
+                cursor.execute(f"""
+                    COPY INTO {table} ({', '.join(columns)})
+                    FROM @%{table}
+                    FILE_FORMAT = (TYPE = CSV COMPRESSION = GZIP FIELD_OPTIONALLY_ENCLOSED_BY = '"' NULL_IF = (''))
+                    PURGE = TRUE
+                """)
+                conn.commit()
+            finally:
+                cursor.close()
+        tables_written((table,), database)
+        return total
+
+    async def execute_query_async(self, query, params=None, database=None):
+        """
+        Submit with the connector's execute_async and poll for completion, so
+        a long warehouse call such as Cortex COMPLETE holds neither a thread
+        nor a pooled connection while it runs. Each step borrows a pooled
+        connection briefly; results of an async query can be fetched from
+        any session of the same user.
+        """
+        pool = self.pool(database)
+        poll_interval = float(os.getenv('SNOWFLAKE_ASYNC_POLL_INTERVAL', 0.2))
+
+        def submit():
+            with pool.connection() as conn:
+                cursor = conn.cursor()
+                try:
+                    cursor.execute_async(query, params)
+                    return cursor.sfqid
+                finally:
+                    cursor.close()
+
+        def still_running(query_id):
+            with pool.connection() as conn:
+                return conn.is_still_running(conn.get_query_status_throw_if_error(query_id))
+
+        def fetch(query_id):
+            with pool.connection() as conn:
+                cursor = conn.cursor()
+                try:
+                    cursor.get_results_from_sfqid(query_id)
+                    columns = [desc[0].lower() for desc in cursor.description]
+                    return [dict(zip(columns, row)) for row in cursor.fetchall()]
+                finally:
+                    cursor.close()
+
+        query_id = await asyncio.to_thread(submit)
+        while await asyncio.to_thread(still_running, query_id):
+            await asyncio.sleep(poll_interval)
+        return await asyncio.to_thread(fetch, query_id)
+
+
+class SQLiteBackend(StorageBackend):
+    """
+    Embedded SQLite database with the same tables as Snowflake.
+
+    MEDIAN, STDDEV and PERCENTILE_CONT ... WITHIN GROUP are provided as
+    Python aggregates so the route queries run unchanged. Cortex AI
+    functions are not available and raise UnsupportedQuery.
+    """
+
+    name = 'sqlite'
+
+    _PERCENTILE_RE = re.compile(
+        r'PERCENTILE_CONT\(\s*([\d.]+)\s*\)\s*WITHIN\s+GROUP\s*\(\s*ORDER\s+BY\s+([\w.]+)\s*\)',
+        re.IGNORECASE,
+    )
+    _DATEADD_RE = re.compile(
+        r"DATEADD\(\s*'day'\s*,\s*(-?)\?\s*,\s*CURRENT_DATE\(\)\s*\)",
+        re.IGNORECASE,
+    )
+
+    def __init__(self, path):
+        super().__init__()
+        self.path = path
+        self._translations = {}
+
+    def connect(self, database=None):
+        conn = sqlite3.connect(self.path, timeout=30, check_same_thread=False)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.create_aggregate('MEDIAN', 1, _MedianAggregate)
+        conn.create_aggregate('PERCENTILE_CONT', 2, _PercentileAggregate)
+        conn.create_aggregate('STDDEV', 1, _StddevAggregate)
+        return conn
+
+    def add_column(self, table, column, column_type):
+        columns = [row['name'] for row in execute_query(f"PRAGMA table_info({table})")]
+        if column not in columns:
+            execute_query(f"ALTER TABLE {table} ADD COLUMN {column} {column_type}", fetch=False)
+
+    def translate(self, query):
+        translated = self._translations.get(query)
+        if translated is None:
+            if 'SNOWFLAKE.CORTEX' in query.upper():
+                raise UnsupportedQuery("Cortex AI functions require the Snowflake backend")
+            translated = query.replace('%s', '?')
+            translated = self._PERCENTILE_RE.sub(r'PERCENTILE_CONT(\2, \1)', translated)
+            translated = self._DATEADD_RE.sub(r"date('now', \1? || ' days')", translated)
+            translated = re.sub(r'CURRENT_(TIMESTAMP|DATE)\(\)', r'CURRENT_\1', translated, flags=re.IGNORECASE)
+            translated = re.sub(r'::\s*ARRAY\b', '', translated, flags=re.IGNORECASE)
+            translated = re.sub(r'VECTOR\(\s*FLOAT\s*,\s*\d+\s*\)', 'TEXT', translated, flags=re.IGNORECASE)
+            self._translations[query] = translated
+        return translated
+
+
+_storage_backend = None
+_storage_backend_lock = threading.Lock()
+
+
+def create_storage_backend(kind=None):
+    """Build the backend named by `kind` (or the STORAGE_BACKEND env var)."""
+    kind = (kind or os.getenv('STORAGE_BACKEND', 'snowflake')).lower()
+    if kind == 'snowflake':
+        return SnowflakeBackend()
+    if kind == 'sqlite':
+        return SQLiteBackend(os.getenv('LOCAL_DB_PATH', 'countermarket.db'))
+    raise ValueError(f"Unknown STORAGE_BACKEND '{kind}' (expected 'snowflake' or 'sqlite')")
+
+
+def get_storage_backend():
+    """Return the process-wide storage backend, creating it on first use."""
+    global _storage_backend
+    if _storage_backend is None:
+        with _storage_backend_lock:
+            if _storage_backend is None:
+                _storage_backend = create_storage_backend()
+    return _storage_backend
+
+
+def get_connection_pool(database=None):
+    """Return this worker's pool on the active backend."""
+    return get_storage_backend().pool(database)
+
+
+def pooled_connection(database=None):
+    """Borrow a connection from this worker's pool on the active backend."""
+    return get_connection_pool(database).connection()
+
+
+def get_pool_stats():
+    """Metrics for every pool in this worker, keyed by database."""
+    backend = get_storage_backend()
+    return {'pid': os.getpid(), 'backend': backend.name, 'pools': backend.pool_stats()}
+
+
+def execute_query(query, params=None, fetch=True, database=None, cache=True):
+    """
+    Execute a query on the active storage backend and return results.
+
+    With the query result cache enabled, reads are answered from it (pass
+    cache=False for reads that must see other workers' writes now) and
+    writes invalidate the tables they touch.
+    """
+    if QUERY_CACHE is not None:
+        return QUERY_CACHE.execute(query, params, database,
+                                   lambda: _execute_query(query, params, fetch, database), cache and fetch)
+    return _execute_query(query, params, fetch, database)
+
+
+def _execute_query(query, params=None, fetch=True, database=None):
+    backend = get_storage_backend()
+    sql = backend.translate(query)
+    with backend.pool(database).connection() as conn:
         cursor = conn.cursor()
-        if params:
-            cursor.execute(query, params)
-        else:
-            cursor.execute(query)
-        if fetch:
-            if cursor.description:
-                columns = [desc[0].lower() for desc in cursor.description]
-                results = [dict(zip(columns, row)) for row in cursor.fetchall()]
-                return results
-            return []
-        conn.commit()
-        return cursor.rowcount
-    finally:
-        conn.close()
+        start = time.perf_counter()
+        try:
+            with span('execute'):
+                if params:
+                    cursor.execute(sql, params)
+                else:
+                    cursor.execute(sql)
+            if fetch:
+                if cursor.description:
+                    with span('fetch'):
+                        columns = [desc[0].lower() for desc in cursor.description]
+                        results = [dict(zip(columns, row)) for row in cursor.fetchall()]
+                    return results
+                return []
+            conn.commit()
+            return cursor.rowcount
+        finally:
+            cursor.close()
+            observe_query(query, time.perf_counter() - start)
+
+
+async def execute_query_async(query, params=None, database=None):
+    """
+    Awaitable read-only execute_query for the ASGI serving mode (asgi.py).
+    Returns the same list of dicts.
+    """
+    return await get_storage_backend().execute_query_async(query, params, database)
+
+# =============================================================================
+# CACHING
+# =============================================================================
+
+_MISSING = object()
+
+
+class TTLCache:
+    """
+    Thread-safe LRU cache with per-entry expiry and optional byte budget.
+
+    `sizeof(value)` is used for size accounting when `max_bytes` or
+    `max_entry_bytes` (the largest single value stored) is set;
+    `on_evict(key, value)` is called for every entry that leaves the cache
+    through expiry, eviction or invalidation. `get_or_load` adds stampede
+    protection: concurrent misses for one key share a single load.
+    """
+
+    def __init__(self, max_entries=1000, ttl=None, max_bytes=None, sizeof=None, on_evict=None, max_entry_bytes=None):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self.max_entry_bytes = max_entry_bytes
+        self.sizeof = sizeof or (lambda value: 0)
+        self.on_evict = on_evict
+        self._lock = threading.RLock()
+        self._entries = OrderedDict()  # key -> (value, expires_at, size)
+        self._loading = {}  # key -> Event set when the in-flight load finishes
+        self._voided = set()  # in-flight keys popped or cleared mid-load
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, key, default=None):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[1] is not None and entry[1] < time.monotonic():
+                self._remove(key)
+                entry = None
+            if entry is None:
+                self.misses += 1
+                return default
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[0]
+
+    def peek(self, key, default=None):
+        """Like get() but without touching LRU order or hit counters."""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or (entry[1] is not None and entry[1] < time.monotonic()):
+                return default
+            return entry[0]
+
+    def set(self, key, value, ttl=None):
+        ttl = self.ttl if ttl is None else ttl
+        size = self.sizeof(value)
+        if any(limit is not None and size > limit for limit in (self.max_bytes, self.max_entry_bytes)):
+            return False
+        with self._lock:
+            if key in self._entries:
+                self._remove(key, evicted=False)
+            expires_at = time.monotonic() + ttl if ttl else None
+            self._entries[key] = (value, expires_at, size)
+            self.bytes += size
+            while self._entries and (
+                len(self._entries) > self.max_entries
+                or (self.max_bytes is not None and self.bytes > self.max_bytes)
+            ):
+                self._remove(next(iter(self._entries)))
+                self.evictions += 1
+        return True
+
+    def get_or_load(self, key, load, ttl=None):
+        """
+        get(), calling `load()` on a miss. Concurrent misses for the same key
+        wait for the first caller's load instead of running their own. Errors
+        are not cached (waiters retry), and a result loaded across a pop() of
+        its key or a clear() is returned but not stored.
+        """
+        while True:
+            with self._lock:
+                value = self.get(key, _MISSING)
+                if value is not _MISSING:
+                    return value
+                event = self._loading.get(key)
+                owner = event is None
+                if owner:
+                    event = self._loading[key] = threading.Event()
+            if not owner:
+                event.wait()
+                continue
+            try:
+                value = load()
+                with self._lock:
+                    if key not in self._voided:
+                        self.set(key, value, ttl)
+                return value
+            finally:
+                with self._lock:
+                    del self._loading[key]
+                    self._voided.discard(key)
+                event.set()
+
+    def pop(self, key):
+        with self._lock:
+            if key in self._loading:
+                self._voided.add(key)
+            if key in self._entries:
+                self._remove(key)
+
+    def clear(self):
+        with self._lock:
+            self._voided.update(self._loading)
+            for key in list(self._entries):
+                self._remove(key)
+
+    def items(self):
+        """Snapshot of live (key, value) pairs, least recently used first."""
+        now = time.monotonic()
+        with self._lock:
+            return [(k, v) for k, (v, expires_at, _) in self._entries.items()
+                    if expires_at is None or expires_at >= now]
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                'entries': len(self._entries),
+                'bytes': self.bytes,
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'hit_rate': round(self.hits / lookups, 4) if lookups else 0.0,
+            }
+
+    def _remove(self, key, evicted=True):
+        value, _, size = self._entries.pop(key)
+        self.bytes -= size
+        if evicted and self.on_evict:
+            self.on_evict(key, value)
+
+# =============================================================================
+# QUERY RESULT CACHE
+# =============================================================================
+# Opt-in (QUERY_CACHE_ENABLED=1): execute_query answers repeated reads (the
+# health check COUNT, dashboard GROUP BYs, cohort stats) from memory. Entries
+# are keyed by the normalized SQL, the params and the current version of
+# every table the query reads; a write bumps the versions of the tables it
+# touches, so later lookups miss and stale entries age out of the LRU. Local
+# versions only see this worker's writes and other workers' writes show up
+# within QUERY_CACHE_TTL; with QUERY_CACHE_DIR set, versions and results live
+# in a directory shared by every worker on the host and invalidation is
+# immediate everywhere.
+
+_SQL_LITERAL_RE = re.compile(r"('(?:[^']|'')*')")
+_READ_TABLES_RE = re.compile(r'\b(?:FROM|JOIN)\s+([A-Za-z_][\w.$]*)', re.IGNORECASE)
+_WRITE_TABLES_RE = re.compile(
+    r'\b(?:INSERT\s+(?:OVERWRITE\s+)?INTO|UPDATE|DELETE\s+FROM|MERGE\s+INTO|TRUNCATE\s+(?:TABLE\s+)?'
+    r'|(?:ALTER|DROP)\s+TABLE(?:\s+IF\s+EXISTS)?'
+    r'|CREATE\s+(?:OR\s+REPLACE\s+)?(?:TEMP\w*\s+)?TABLE(?:\s+IF\s+NOT\s+EXISTS)?)\s+([A-Za-z_][\w.$]*)',
+    re.IGNORECASE,
+)
+# Results that depend on the clock, randomness or a model are never cached
+_VOLATILE_SQL_RE = re.compile(r'\b(?:CURRENT_\w+|SYSDATE|GETDATE|RANDOM|UUID_STRING|SNOWFLAKE\.CORTEX)\b',
+                              re.IGNORECASE)
+_WRITE_STATEMENTS = frozenset(('insert', 'update', 'delete', 'merge', 'truncate', 'alter', 'drop', 'create'))
+# Version every cached read depends on, bumped by writes whose tables are unknown
+ALL_TABLES = '*'
+
+
+@lru_cache(maxsize=1024)
+def query_cache_plan(query):
+    """
+    (normalized SQL, tables read, tables written) of a query. Tables read is
+    None unless the query is a deterministic SELECT that may be cached.
+    Whitespace is collapsed outside string literals only.
+    """
+    parts = _SQL_LITERAL_RE.split(query)
+    normalized = ''.join(part if i % 2 else re.sub(r'\s+', ' ', part) for i, part in enumerate(parts)).strip()
+    code = ' '.join(parts[::2])
+    statement = (code.split() or [''])[0].lower()
+    reads = None
+    if statement in ('select', 'with') and not _VOLATILE_SQL_RE.search(code):
+        reads = frozenset(name.rsplit('.', 1)[-1].lower() for name in _READ_TABLES_RE.findall(code)) or None
+    writes = frozenset()
+    if statement in _WRITE_STATEMENTS:
+        writes = frozenset(name.rsplit('.', 1)[-1].lower() for name in _WRITE_TABLES_RE.findall(code))
+        writes = writes or frozenset((ALL_TABLES,))
+    return normalized, reads, writes
+
+
+class QueryResultCache:
+    """
+    Version-keyed cache of execute_query results.
+
+    The in-process level is a TTLCache with LRU eviction and byte
+    accounting (pickled size, estimated from a sample of rows); results
+    larger than `max_entry_bytes` are not stored. With `directory` set,
+    table versions are files there and a local miss checks the directory
+    (one pickle file per entry, pruned to `directory_max_bytes`) before
+    running the query. The directory must only be writable by the app.
+    """
+
+    def __init__(self, max_entries=5000, ttl=60, max_bytes=50_000_000, max_entry_bytes=2_000_000,
+                 directory=None, directory_max_bytes=200_000_000):
+        self.ttl = ttl
+        self.directory = directory
+        self.directory_max_bytes = directory_max_bytes
+        self._entries = TTLCache(max_entries=max_entries, ttl=ttl, max_bytes=max_bytes,
+                                 max_entry_bytes=max_entry_bytes, sizeof=lambda value: value[1])
+        self._versions = {}  # (database, table) -> counter, without a directory
+        self._lock = threading.Lock()
+        self._writes = 0
+        self.shared_hits = 0
+        self.bypassed = 0
+        if directory:
+            os.makedirs(os.path.join(directory, 'versions'), exist_ok=True)
+            os.makedirs(os.path.join(directory, 'entries'), exist_ok=True)
+
+    def execute(self, query, params, database, run, cache=True):
+        """
+        `run()`'s result for `query`, from the cache when it is a cacheable
+        read; bumps the versions of the tables `query` writes.
+        """
+        normalized, reads, writes = query_cache_plan(query)
+        key = None
+        if cache and reads is not None:
+            try:
+                key = (database, normalized, tuple(params or ()))
+                hash(key)
+            except TypeError:
+                key = None
+        if key is None:
+            if not writes:
+                self.bypassed += 1
+            try:
+                return run()
+            finally:
+                if writes:
+                    self.bump(writes, database)
+
+        tables = sorted(reads | {ALL_TABLES})
+        key += (tuple(zip(tables, (self._version(table, database) for table in tables))),)
+        rows, _ = self._entries.get_or_load(key, lambda: self._load(key, run))
+        # Callers may modify the rows they get back
+        return [dict(row) for row in rows]
+
+    def bump(self, tables, database=None):
+        """Invalidate every cached read of `tables`."""
+        for table in tables:
+            if self.directory:
+                self._write_file(self._version_path(table, database), secrets.token_hex(8).encode())
+            else:
+                with self._lock:
+                    self._versions[database, table] = self._versions.get((database, table), 0) + 1
+
+    def clear(self):
+        """Drop this worker's entries (shared entries expire with their versions)."""
+        self._entries.clear()
+
+    def stats(self):
+        stats = self._entries.stats()
+        lookups = stats['hits'] + stats['misses']
+        stats['shared_hits'] = self.shared_hits
+        stats['bypassed'] = self.bypassed
+        stats['hit_rate'] = round((stats['hits'] + self.shared_hits) / lookups, 4) if lookups else 0.0
+        stats['directory'] = self.directory
+        return stats
+
+    def _load(self, key, run):
+        path = self._entry_path(key) if self.directory else None
+        if path is not None:
+            rows = self._read_entry(path, key)
+            if rows is not None:
+                self.shared_hits += 1
+                return rows, self._sizeof(rows)
+        rows = run()
+        size = self._sizeof(rows)
+        if path is not None and size <= (self._entries.max_entry_bytes or math.inf):
+            self._write_file(path, pickle.dumps((repr(key), time.time() + self.ttl, rows), pickle.HIGHEST_PROTOCOL))
+            self._writes += 1
+            if self._writes % 64 == 0:
+                self._prune()
+        return rows, size
+
+    @staticmethod
+    def _sizeof(rows, sample=64):
+        if not rows:
+            return 0
+        return len(pickle.dumps(rows[:sample], pickle.HIGHEST_PROTOCOL)) * len(rows) // min(len(rows), sample)
+
+    def _version(self, table, database):
+        if not self.directory:
+            return self._versions.get((database, table), 0)
+        try:
+            with open(self._version_path(table, database), 'rb') as f:
+                return f.read().decode()
+        except FileNotFoundError:
+            return ''
+
+    def _version_path(self, table, database):
+        return os.path.join(self.directory, 'versions', f"{database or 'default'}.{table}")
+
+    def _entry_path(self, key):
+        return os.path.join(self.directory, 'entries', hashlib.sha256(repr(key).encode()).hexdigest() + '.pkl')
+
+    def _read_entry(self, path, key):
+        try:
+            with open(path, 'rb') as f:
+                stored_key, expires_at, rows = pickle.load(f)
+        except FileNotFoundError:
+            return None
+        except Exception as e:  # torn or foreign file: treat as a miss
+            print(f"Query cache entry unreadable ({path}): {e}")
+            return None
+        if stored_key != repr(key) or expires_at < time.time():
+            return None
+        try:
+            os.utime(path)  # recently used entries survive pruning
+        except FileNotFoundError:
+            pass
+        return rows
+
+    def _write_file(self, path, data):
+        fd, tmp = tempfile.mkstemp(prefix='.tmp-', dir=os.path.dirname(path))
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                f.write(data)
+            os.replace(tmp, path)
+        except BaseException:
+            if os.path.exists(tmp):
+                os.unlink(tmp)
+            raise
+
+    def _prune(self):
+        """Remove expired shared entries, then the least recently used beyond directory_max_bytes."""
+        entries = []
+        for entry in os.scandir(os.path.join(self.directory, 'entries')):
+            try:
+                st = entry.stat()
+            except FileNotFoundError:
+                continue
+            entries.append((st.st_mtime, st.st_size, entry.path))
+        entries.sort()
+        total = sum(size for _, size, _ in entries)
+        now = time.time()
+        for mtime, size, path in entries:
+            if mtime >= now - self.ttl and total <= self.directory_max_bytes:
+                break
+            try:
+                os.unlink(path)
+            except FileNotFoundError:
+                pass
+            total -= size
+
+
+QUERY_CACHE = None
+if os.getenv('QUERY_CACHE_ENABLED', '0') == '1':
+    QUERY_CACHE = QueryResultCache(
+        max_entries=int(os.getenv('QUERY_CACHE_MAX_ENTRIES', 5000)),
+        ttl=float(os.getenv('QUERY_CACHE_TTL', 60)),
+        max_bytes=int(os.getenv('QUERY_CACHE_MAX_BYTES', 50_000_000)),
+        max_entry_bytes=int(os.getenv('QUERY_CACHE_MAX_ENTRY_BYTES', 2_000_000)),
+        directory=os.getenv('QUERY_CACHE_DIR') or None,
+        directory_max_bytes=int(os.getenv('QUERY_CACHE_DIR_MAX_BYTES', 200_000_000)),
+    )
+
+
+def tables_written(tables, database=None):
+    """Record a write made outside execute_query (bulk loads, raw cursors)."""
+    if QUERY_CACHE is not None:
+        QUERY_CACHE.bump(tables, database)
+
+# =============================================================================
+# QUERY FAN-OUT
+# =============================================================================
+
+class QueryTimeout(Exception):
+    """A QueryPlan step did not finish within its timeout."""
+
+
+_fanout_local = threading.local()
+_query_executors = {}
+_query_executors_lock = threading.Lock()
+
+
+def _mark_fanout_worker():
+    _fanout_local.worker = True
+
+
+def get_query_executor():
+    """
+    Shared thread pool for QueryPlan, one per process (executor threads do
+    not survive a fork). None when QUERY_FANOUT_WORKERS=0.
+    """
+    pid = os.getpid()
+    executor = _query_executors.get(pid)
+    if executor is None:
+        workers = int(os.getenv('QUERY_FANOUT_WORKERS', 16))
+        if workers <= 0:
+            return None
+        with _query_executors_lock:
+            executor = _query_executors.get(pid)
+            if executor is None:
+                executor = ThreadPoolExecutor(
+                    max_workers=workers,
+                    thread_name_prefix='query-fanout',
+                    initializer=_mark_fanout_worker,
+                )
+                _query_executors[pid] = executor
+    return executor
+
+
+class QueryPlan:
+    """
+    The queries one request needs, run concurrently.
+
+        plan = QueryPlan()
+        plan.add('stats', get_cohort_stats, industry, experience)
+        plan.add('rank', get_percentile_rank, salary, industry, experience)
+        results = plan.run()    # {'stats': ..., 'rank': ...}
+
+    A step may name earlier steps it `depends_on`; their results are passed
+    as its leading positional arguments and it is submitted as soon as they
+    finish, so request latency is the longest dependency chain instead of
+    the sum of every round trip.
+
+    Each step has `timeout` seconds (QUERY_TIMEOUT by default) from
+    submission. On the first error or timeout, steps that have not started
+    are cancelled and the error is raised; steps already running cannot be
+    interrupted and finish in the background.
+
+    Steps run one after another, in the order added and without timeouts,
+    when `parallel` is False, when fan-out is disabled, or when the plan is
+    run from inside another plan's step (so nested plans cannot deadlock
+    the shared pool).
+    """
+
+    def __init__(self, parallel=True, timeout=None):
+        self.parallel = parallel
+        self.timeout = timeout if timeout is not None else float(os.getenv('QUERY_TIMEOUT', 30))
+        self._steps = {}
+
+    def add(self, name, fn, *args, depends_on=(), timeout=None, **kwargs):
+        if name in self._steps:
+            raise ValueError(f"Duplicate query step '{name}'")
+        unknown = [dep for dep in depends_on if dep not in self._steps]
+        if unknown:
+            raise ValueError(f"Query step '{name}' depends on unknown steps: {unknown}")
+        self._steps[name] = (fn, args, kwargs, tuple(depends_on), timeout or self.timeout)
+        return self
+
+    def run(self):
+        executor = None
+        if self.parallel and len(self._steps) > 1 and not getattr(_fanout_local, 'worker', False):
+            executor = get_query_executor()
+        if executor is None:
+            results = {}
+            for name, (fn, args, kwargs, depends_on, _) in self._steps.items():
+                results[name] = fn(*[results[dep] for dep in depends_on], *args, **kwargs)
+            return results
+
+        results = {}
+        waiting = dict(self._steps)
+        running = {}  # future -> (name, deadline)
+        try:
+            while waiting or running:
+                for name, (fn, args, kwargs, depends_on, timeout) in list(waiting.items()):
+                    if all(dep in results for dep in depends_on):
+                        del waiting[name]
+                        # Each step runs in a copy of the caller's context so its
+                        # spans land in the request's trace
+                        future = executor.submit(contextvars.copy_context().run, fn,
+                                                 *[results[dep] for dep in depends_on], *args, **kwargs)
+                        running[future] = (name, time.monotonic() + timeout)
+
+                next_deadline = min(deadline for _, deadline in running.values())
+                done, _ = wait(running, timeout=max(0.0, next_deadline - time.monotonic()),
+                               return_when=FIRST_COMPLETED)
+                for future in done:
+                    name, _ = running.pop(future)
+                    results[name] = future.result()
+
+                now = time.monotonic()
+                for name, deadline in running.values():
+                    if deadline <= now:
+                        raise QueryTimeout(f"Query step '{name}' timed out after {self._steps[name][4]:g}s")
+        finally:
+            for future in running:
+                future.cancel()
+        return {name: results[name] for name in self._steps}
+
 
 # =============================================================================
 # DATABASE INITIALIZATION
 # =============================================================================
 
 def init_snowflake_database():
-    """Initialize Snowflake database and tables."""
-    print("Initializing Snowflake database...")
+    """Initialize the database and tables on the active storage backend."""
+    backend = get_storage_backend()
+    print(f"Initializing {backend.name} database...")
 
-    # First, create database (connect without specifying database)
-    conn = snowflake.connector.connect(
-        account=os.getenv('SNOWFLAKE_ACCOUNT'),
-        user=os.getenv('SNOWFLAKE_USER'),
-        password=os.getenv('SNOWFLAKE_PASSWORD'),
-        warehouse=os.getenv('SNOWFLAKE_WAREHOUSE')
-    )
-    try:
-        cursor = conn.cursor()
-        cursor.execute("CREATE DATABASE IF NOT EXISTS WAGEWATCH")
-        cursor.execute("USE DATABASE WAGEWATCH")
-        cursor.execute("CREATE SCHEMA IF NOT EXISTS PUBLIC")
-        conn.commit()
-        print("Database WAGEWATCH created/verified")
-    finally:
-        conn.close()
+    # First, create database/schema if the backend needs one
+    backend.bootstrap()
 
     # Now create tables
     print("Creating tables...")
@@ -245,11 +1730,49 @@ def init_snowflake_database():
             category VARCHAR(100) NOT NULL,
             title VARCHAR(255) NOT NULL,
             content TEXT NOT NULL,
+            embedding VECTOR(FLOAT, 768),
+            embedding_hash VARCHAR(64),
             created_at TIMESTAMP_NTZ DEFAULT CURRENT_TIMESTAMP()
         )
     """, fetch=False)
+    # Tables created before embeddings were stored
+    backend.add_column('negotiation_knowledge', 'embedding', 'VECTOR(FLOAT, 768)')
+    backend.add_column('negotiation_knowledge', 'embedding_hash', 'VARCHAR(64)')
     print("Knowledge base table created!")
 
+    # Company registry (multipliers and pay tiers used by /api/salary/compare)
+    execute_query("""
+        CREATE TABLE IF NOT EXISTS transparent_companies (
+            id VARCHAR(64) PRIMARY KEY,
+            name VARCHAR(255) NOT NULL,
+            industry VARCHAR(100),
+            location VARCHAR(255),
+            website VARCHAR(500),
+            transparency_score INTEGER,
+            has_pay_bands BOOLEAN DEFAULT FALSE,
+            publishes_salary_ranges BOOLEAN DEFAULT FALSE,
+            equal_pay_certified BOOLEAN DEFAULT FALSE,
+            conducts_pay_audits BOOLEAN DEFAULT FALSE,
+            employee_count INTEGER,
+            founded_year INTEGER,
+            description TEXT,
+            company_key VARCHAR(100),
+            salary_multiplier NUMBER(4, 2),
+            pay_tier VARCHAR(20),
+            aliases VARCHAR(2000),
+            revision INTEGER DEFAULT 1,
+            created_at TIMESTAMP_NTZ DEFAULT CURRENT_TIMESTAMP(),
+            updated_at TIMESTAMP_NTZ DEFAULT CURRENT_TIMESTAMP()
+        )
+    """, fetch=False)
+    # Tables created from database/schema.sql before the registry columns
+    backend.add_column('transparent_companies', 'company_key', 'VARCHAR(100)')
+    backend.add_column('transparent_companies', 'salary_multiplier', 'NUMBER(4, 2)')
+    backend.add_column('transparent_companies', 'pay_tier', 'VARCHAR(20)')
+    backend.add_column('transparent_companies', 'aliases', 'VARCHAR(2000)')
+    backend.add_column('transparent_companies', 'revision', 'INTEGER DEFAULT 1')
+    seed_company_registry()
+
     # Check if we need sample data
     count = execute_query("SELECT COUNT(*) as cnt FROM salary_submissions")
     if count and count[0]['cnt'] == 0:
@@ -258,18 +1781,37 @@ def init_snowflake_database():
     else:
         print(f"Found {count[0]['cnt']} existing records")
 
-    # Initialize knowledge base
+    # Initialize knowledge base (new/edited articles and their embeddings)
     kb_count = execute_query("SELECT COUNT(*) as cnt FROM negotiation_knowledge")
     if kb_count and kb_count[0]['cnt'] == 0:
         print("Initializing RAG knowledge base...")
-        init_knowledge_base()
     else:
         print(f"Found {kb_count[0]['cnt']} knowledge base articles")
+    init_knowledge_base()
+
+    print("Database initialization complete!")
 
-    print("Snowflake initialization complete!")
+# Column order of salary_submissions rows written by the bulk paths
+SUBMISSION_COLUMNS = (
+    'id', 'job_title', 'industry', 'years_experience', 'salary', 'location', 'gender', 'ethnicity',
+    'education_level', 'company_size', 'company_name', 'remote_status', 'created_at',
+)
+SAMPLE_DATA_COLUMNS = (
+    'id', 'job_title', 'industry', 'years_experience', 'salary', 'location', 'gender',
+    'ethnicity', 'education_level', 'company_size', 'remote_status', 'created_at',
+)
+SAMPLE_DATA_CHUNK_SIZE = 100_000
+HEX_DIGITS = np.array([ord(c) for c in '0123456789abcdef'], dtype=np.uint32)
 
-def insert_snowflake_sample_data():
-    """Insert realistic sample salary data into Snowflake based on 2024-2025 market rates."""
+
+def generate_sample_population(count, seed, anchor_date=None):
+    """
+    Build a synthetic population of salary records based on 2024-2025 market rates.
+
+    Rows are generated with NumPy in columnar chunks of SAMPLE_DATA_CHUNK_SIZE
+    and yielded as dicts of column arrays keyed by SAMPLE_DATA_COLUMNS.
+    created_at is spread over the year before `anchor_date` (default today).
+    """
 
     # Industry-specific job titles with realistic median salaries
     # These are median salaries (not top-tier) for each role in that industry
@@ -402,92 +1944,130 @@ def insert_snowflake_sample_data():
     company_weights = [0.15, 0.20, 0.25, 0.25, 0.15]
     company_multipliers = {'startup': 0.92, 'small': 0.96, 'medium': 1.0, 'large': 1.05, 'enterprise': 1.10}
 
+    edu_bonus = {'High School': 0.92, 'Associate': 0.96, 'Bachelor': 1.0, 'Master': 1.05, 'PhD': 1.08}
+    gender_gaps = {'Female': 0.87, 'Male': 1.0, 'Non-binary': 0.91}  # 13% and 9% pay gaps
+    ethnicity_gaps = {
+        'Asian': 1.0,
+        'Black/African American': 0.93,
+        'Hispanic/Latino': 0.90,
+        'White': 1.0,
+        'Mixed/Multiple': 0.96,
+    }
+
     remote_statuses = ['remote', 'hybrid', 'onsite']
 
-    conn = get_snowflake_connection()
-    cursor = conn.cursor()
+    # Flatten the role table so a role can be picked per row with one
+    # vectorized draw: row i picks role_offsets[industry] + k.
+    industries = np.array(list(industry_roles.keys()))
+    role_counts = np.array([len(roles) for roles in industry_roles.values()])
+    role_offsets = np.concatenate(([0], np.cumsum(role_counts)[:-1]))
+    role_titles = np.array([t for roles in industry_roles.values() for t in roles])
+    role_bases = np.array([b for roles in industry_roles.values() for b in roles.values()], dtype=np.float64)
 
-    industries = list(industry_roles.keys())
-    locations = list(location_multipliers.keys())
+    locations = np.array(list(location_multipliers.keys()))
+    location_factors = np.array(list(location_multipliers.values()))
 
-    for i in range(500):  # Generate 500 records for better statistics
-        salary_id = secrets.token_hex(16)
+    anchor = np.datetime64(anchor_date or datetime.now().date(), 'D')
+    dates = np.datetime_as_string(anchor - np.arange(366).astype('timedelta64[D]'))
+
+    for start in range(0, count, SAMPLE_DATA_CHUNK_SIZE):
+        size = min(SAMPLE_DATA_CHUNK_SIZE, count - start)
+        # One independent stream per chunk keeps the dataset identical for
+        # a given (count, seed) regardless of how it is later batched.
+        rng = np.random.default_rng([seed, start // SAMPLE_DATA_CHUNK_SIZE])
 
         # Pick a random industry, then pick a role valid for that industry
-        industry = random.choice(industries)
-        roles = industry_roles[industry]
-        title = random.choice(list(roles.keys()))
+        industry_idx = rng.integers(0, len(industries), size)
+        role_idx = role_offsets[industry_idx] + (rng.random(size) * role_counts[industry_idx]).astype(np.int64)
 
-        location = random.choice(locations)
-        experience = random.randint(0, 15)
+        location_idx = rng.integers(0, len(locations), size)
+        experience = rng.integers(0, 16, size)
 
         # Start with the median base salary for this role in this industry
-        base = roles[title]
+        base = role_bases[role_idx]
 
         # Experience scaling (more realistic - diminishing returns)
         # Entry (0-2): 0.85-1.0x, Mid (3-6): 1.0-1.20x, Senior (7-12): 1.15-1.40x, Staff+ (13+): 1.35-1.55x
-        if experience <= 2:
-            exp_multiplier = 0.85 + (experience * 0.075)
-        elif experience <= 6:
-            exp_multiplier = 1.0 + ((experience - 2) * 0.05)
-        elif experience <= 12:
-            exp_multiplier = 1.20 + ((experience - 6) * 0.035)
-        else:
-            exp_multiplier = 1.40 + ((experience - 12) * 0.05)
-
+        exp_multiplier = np.select(
+            [experience <= 2, experience <= 6, experience <= 12],
+            [0.85 + experience * 0.075, 1.0 + (experience - 2) * 0.05, 1.20 + (experience - 6) * 0.035],
+            1.40 + (experience - 12) * 0.05,
+        )
         base = base * exp_multiplier
 
         # Apply location multiplier
-        base = base * location_multipliers[location]
+        base = base * location_factors[location_idx]
 
         # Company size impact
-        size = random.choices(company_sizes, weights=company_weights)[0]
-        base = base * company_multipliers[size]
+        size_idx = rng.choice(len(company_sizes), size, p=company_weights)
+        base = base * np.array([company_multipliers[s] for s in company_sizes])[size_idx]
 
         # Education bonus (smaller impact)
-        edu = random.choices(education_levels, weights=education_weights)[0]
-        edu_bonus = {'High School': 0.92, 'Associate': 0.96, 'Bachelor': 1.0, 'Master': 1.05, 'PhD': 1.08}
-        base = base * edu_bonus[edu]
+        edu_idx = rng.choice(len(education_levels), size, p=education_weights)
+        base = base * np.array([edu_bonus[e] for e in education_levels])[edu_idx]
 
         # Add some random variance (±8%)
-        base = base * random.uniform(0.92, 1.08)
+        base = base * rng.uniform(0.92, 1.08, size)
 
         # Gender selection with documented pay gaps
-        gender = random.choices(genders, weights=gender_weights)[0]
-        if gender == 'Female':
-            base = base * 0.87  # 13% pay gap
-        elif gender == 'Non-binary':
-            base = base * 0.91  # 9% pay gap
+        gender_idx = rng.choice(len(genders), size, p=gender_weights)
+        base = base * np.array([gender_gaps[g] for g in genders])[gender_idx]
 
         # Ethnicity with documented pay gaps
-        ethnicity = random.choice(ethnicities)
-        ethnicity_gaps = {
-            'Asian': 1.0,
-            'White': 1.0,
-            'Mixed/Multiple': 0.96,
-            'Black/African American': 0.93,
-            'Hispanic/Latino': 0.90,
-        }
-        base = base * ethnicity_gaps[ethnicity]
+        ethnicity_idx = rng.integers(0, len(ethnicities), size)
+        base = base * np.array([ethnicity_gaps[e] for e in ethnicities])[ethnicity_idx]
 
         # Round to nearest thousand for realism
-        final_salary = round(base / 1000) * 1000
-
-        remote = random.choice(remote_statuses)
-        days_ago = random.randint(1, 365)
-
-        cursor.execute("""
-            INSERT INTO salary_submissions
-            (id, job_title, industry, years_experience, salary, location, gender, ethnicity, education_level, company_size, remote_status, created_at)
-            VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, DATEADD('day', -%s, CURRENT_DATE()))
-        """, [salary_id, title, industry, experience, final_salary, location, gender, ethnicity, edu, size, remote, days_ago])
+        final_salary = np.round(base / 1000) * 1000
+
+        remote_idx = rng.integers(0, len(remote_statuses), size)
+        days_ago = rng.integers(1, 366, size)
+
+        # 128-bit random ids rendered as 32 hex characters
+        id_bytes = rng.integers(0, 256, (size, 16), dtype=np.uint8)
+        hex_chars = np.empty((size, 32), dtype=np.uint32)  # UCS-4 code points
+        hex_chars[:, 0::2] = HEX_DIGITS[id_bytes >> 4]
+        hex_chars[:, 1::2] = HEX_DIGITS[id_bytes & 0x0F]
+
+        yield {
+            'id': hex_chars.view('U32').ravel(),
+            'job_title': role_titles[role_idx],
+            'industry': industries[industry_idx],
+            'years_experience': experience,
+            'salary': final_salary,
+            'location': locations[location_idx],
+            'gender': np.array(genders)[gender_idx],
+            'ethnicity': np.array(ethnicities)[ethnicity_idx],
+            'education_level': np.array(education_levels)[edu_idx],
+            'company_size': np.array(company_sizes)[size_idx],
+            'remote_status': np.array(remote_statuses)[remote_idx],
+            'created_at': dates[days_ago],
+        }
 
-        if (i + 1) % 100 == 0:
-            print(f"  Inserted {i + 1} records...")
 
-    conn.commit()
-    conn.close()
-    print(f"Inserted 500 realistic sample salary records!")
+def insert_snowflake_sample_data(count=None, seed=None):
+    """
+    Generate `count` sample salary records (SAMPLE_DATA_ROWS, default 500)
+    and bulk-load them into salary_submissions. The same seed always
+    produces the same dataset; without one a random seed is drawn.
+    SAMPLE_DATA_ANCHOR_DATE (YYYY-MM-DD) pins created_at as well.
+    """
+    count = int(count if count is not None else os.getenv('SAMPLE_DATA_ROWS', 500))
+    if seed is None:
+        seed = os.getenv('SAMPLE_DATA_SEED') or None
+    seed = int(seed) if seed is not None else secrets.randbits(32)
+    anchor = os.getenv('SAMPLE_DATA_ANCHOR_DATE') or None
+
+    def row_batches():
+        for chunk in generate_sample_population(count, seed, anchor):
+            columns = [chunk[name].tolist() for name in SAMPLE_DATA_COLUMNS]
+            yield list(zip(*columns))
+
+    start = time.perf_counter()
+    inserted = get_storage_backend().bulk_insert('salary_submissions', SAMPLE_DATA_COLUMNS, row_batches())
+    print(f"Inserted {inserted} realistic sample salary records (seed {seed}) "
+          f"in {time.perf_counter() - start:.1f}s!")
+    return inserted
 
 # =============================================================================
 # RAG KNOWLEDGE BASE
@@ -549,45 +2129,163 @@ def init_knowledge_base():
         }
     ]
 
-    conn = get_snowflake_connection()
-    cursor = conn.cursor()
+    # Upsert by title so edited articles are picked up on the next start
+    existing = {
+        row['title']: row
+        for row in execute_query("SELECT id, title, content FROM negotiation_knowledge")
+    }
+    backend = get_storage_backend()
+    insert_sql = backend.translate("""
+        INSERT INTO negotiation_knowledge (id, category, title, content)
+        VALUES (%s, %s, %s, %s)
+    """)
+    update_sql = backend.translate("""
+        UPDATE negotiation_knowledge SET category = %s, content = %s WHERE id = %s
+    """)
+
+    inserted = updated = 0
+    with pooled_connection() as conn:
+        cursor = conn.cursor()
+
+        for article in knowledge_articles:
+            current = existing.get(article['title'])
+            if current is None:
+                article_id = secrets.token_hex(16)
+                cursor.execute(insert_sql, [article_id, article['category'], article['title'], article['content']])
+                inserted += 1
+            elif current['content'] != article['content']:
+                cursor.execute(update_sql, [article['category'], article['content'], current['id']])
+                updated += 1
 
-    for article in knowledge_articles:
-        article_id = secrets.token_hex(16)
-        cursor.execute("""
-            INSERT INTO negotiation_knowledge (id, category, title, content)
-            VALUES (%s, %s, %s, %s)
-        """, [article_id, article['category'], article['title'], article['content']])
+        conn.commit()
+    tables_written(('negotiation_knowledge',))
+    if inserted or updated:
+        print(f"Knowledge base: inserted {inserted}, updated {updated} articles")
+
+    sync_knowledge_embeddings()
+
+
+EMBEDDING_MODEL = 'e5-base-v2'
+EMBEDDING_DIM = 768
+EMBEDDING_STOPWORDS = frozenset(
+    "a an and are as at be by can do for from how i if in is it its me my of on or "
+    "so that the their there this to was what when where which who why will with you your".split()
+)
+
+
+def content_hash(text):
+    return hashlib.sha256(text.encode('utf-8')).hexdigest()
+
+
+def local_embedding(text, dim=EMBEDDING_DIM):
+    """
+    Deterministic hashing-trick embedding (word unigrams + bigrams) used when
+    Cortex is unavailable, e.g. on the SQLite backend. L2-normalized.
+    """
+    tokens = [t for t in re.findall(r"[a-z0-9']+", text.lower()) if t not in EMBEDDING_STOPWORDS]
+    features = tokens + [f"{a} {b}" for a, b in zip(tokens, tokens[1:])]
+    vector = np.zeros(dim, dtype=np.float32)
+    for feature in features:
+        digest = int.from_bytes(hashlib.blake2b(feature.encode('utf-8'), digest_size=8).digest(), 'little')
+        vector[digest % dim] += 1.0 if (digest >> 63) & 1 else -1.0
+    norm = np.linalg.norm(vector)
+    return vector / norm if norm else vector
+
+
+@traced('embed')
+def embed_question(text):
+    """Embed a user question with the same model as the stored articles."""
+    if get_storage_backend().supports_cortex:
+        result = execute_query(
+            f"SELECT SNOWFLAKE.CORTEX.EMBED_TEXT_{EMBEDDING_DIM}('{EMBEDDING_MODEL}', %s)::ARRAY as embedding",
+            [text],
+        )
+        return np.asarray(parse_vector(result[0]['embedding']), dtype=np.float32)
+    return local_embedding(text)
+
+
+def parse_vector(value):
+    """Stored embeddings come back as JSON text (ARRAY/TEXT) or a list."""
+    return json.loads(value) if isinstance(value, str) else value
+
+
+def sync_knowledge_embeddings():
+    """
+    Embed articles whose stored embedding is missing or was computed from
+    different content (tracked by embedding_hash). Returns the number of
+    articles re-embedded.
+    """
+    rows = execute_query("SELECT id, content, embedding_hash FROM negotiation_knowledge")
+    stale = [row for row in rows if row['embedding_hash'] != content_hash(row['content'])]
+    if not stale:
+        return 0
 
-    conn.commit()
-    conn.close()
-    print(f"Inserted {len(knowledge_articles)} knowledge base articles!")
+    backend = get_storage_backend()
+    with pooled_connection() as conn:
+        cursor = conn.cursor()
+        for row in stale:
+            if backend.supports_cortex:
+                # Let Cortex embed in place so the vector never leaves Snowflake
+                cursor.execute(f"""
+                    UPDATE negotiation_knowledge
+                    SET embedding = SNOWFLAKE.CORTEX.EMBED_TEXT_{EMBEDDING_DIM}('{EMBEDDING_MODEL}', content),
+                        embedding_hash = %s
+                    WHERE id = %s
+                """, [content_hash(row['content']), row['id']])
+            else:
+                cursor.execute(
+                    backend.translate("UPDATE negotiation_knowledge SET embedding = %s, embedding_hash = %s WHERE id = %s"),
+                    [json.dumps(local_embedding(row['content']).tolist()), content_hash(row['content']), row['id']],
+                )
+        conn.commit()
+    tables_written(('negotiation_knowledge',))
+    print(f"Embedded {len(stale)} knowledge base articles")
+    return len(stale)
 
 
-def retrieve_relevant_context(user_question, top_k=3):
+@traced('rag')
+def retrieve_relevant_context(user_question, top_k=3, question_embedding=None):
     """
     RAG: Retrieve relevant documents using Snowflake Cortex embeddings.
-    Uses EMBED_TEXT_768 for semantic search and VECTOR_COSINE_SIMILARITY for matching.
+    Article embeddings are stored at insert time; only the question is embedded
+    with EMBED_TEXT_768. Ranking uses the in-process KNOWLEDGE_INDEX when it is
+    loaded, else VECTOR_COSINE_SIMILARITY in SQL. On the local backend the
+    hashing-trick embedding is used instead. Pass `question_embedding` when the
+    caller has already embedded the question.
     Returns tuple of (context_string, list_of_sources)
     """
     try:
-        # Use Snowflake Cortex to find semantically similar documents
-        results = execute_query("""
-            WITH question_embedding AS (
-                SELECT SNOWFLAKE.CORTEX.EMBED_TEXT_768('e5-base-v2', %s) as embedding
-            )
-            SELECT
-                nk.title,
-                nk.category,
-                nk.content,
-                VECTOR_COSINE_SIMILARITY(
-                    SNOWFLAKE.CORTEX.EMBED_TEXT_768('e5-base-v2', nk.content),
-                    qe.embedding
-                ) as similarity_score
-            FROM negotiation_knowledge nk, question_embedding qe
-            ORDER BY similarity_score DESC
-            LIMIT %s
-        """, [user_question, top_k])
+        if KNOWLEDGE_INDEX is not None and len(KNOWLEDGE_INDEX):
+            if question_embedding is None:
+                question_embedding = embed_question(user_question)
+            results = search_knowledge_index(question_embedding, top_k)
+        elif get_storage_backend().supports_cortex:
+            # Only the question is embedded per request; articles use the
+            # stored embedding column
+            results = execute_query(f"""
+                WITH question_embedding AS (
+                    SELECT SNOWFLAKE.CORTEX.EMBED_TEXT_{EMBEDDING_DIM}('{EMBEDDING_MODEL}', %s) as embedding
+                )
+                SELECT
+                    nk.title,
+                    nk.category,
+                    nk.content,
+                    VECTOR_COSINE_SIMILARITY(nk.embedding, qe.embedding) as similarity_score
+                FROM negotiation_knowledge nk, question_embedding qe
+                WHERE nk.embedding IS NOT NULL
+                ORDER BY similarity_score DESC
+                LIMIT %s
+            """, [user_question, top_k])
+        else:
+            rows = execute_query("""
+                SELECT title, category, content, embedding
+                FROM negotiation_knowledge
+                WHERE embedding IS NOT NULL
+            """)
+            question = question_embedding if question_embedding is not None else local_embedding(user_question)
+            for row in rows:
+                row['similarity_score'] = float(np.dot(np.asarray(parse_vector(row.pop('embedding')), dtype=np.float32), question))
+            results = sorted(rows, key=lambda r: r['similarity_score'], reverse=True)[:top_k]
 
         if results:
             context_parts = []
@@ -606,60 +2304,786 @@ def retrieve_relevant_context(user_question, top_k=3):
         return "", []
 
 
-# Initialize on startup
-try:
-    init_snowflake_database()
-except Exception as e:
-    print(f"Snowflake init error: {e}")
-    print("Make sure your Snowflake credentials are correct in .env")
-
 # =============================================================================
-# SALARY ROUTES
+# VECTOR INDEX
 # =============================================================================
 
-@app.route('/api/salary/submit', methods=['POST'])
-def submit_salary():
-    """Submit anonymous salary data to Snowflake."""
-    data = request.json
-    required = ['job_title', 'industry', 'years_experience', 'salary', 'location']
-    if not all(k in data for k in required):
-        return jsonify({'error': 'Missing required fields'}), 400
+class VectorIndex:
+    """
+    In-process cosine-similarity index over L2-normalized vectors.
+
+    Small corpora are searched exactly with one matrix-vector product. Once
+    the index holds `ivf_threshold` vectors it trains an IVF coarse quantizer
+    (spherical k-means) and only scores the `nprobe` closest lists. Vectors
+    can be added and removed incrementally, and the index can be saved to a
+    directory and re-opened with the matrices memory-mapped. Processes
+    sharing a directory hold `directory_lock` around save() and load().
+    """
 
-    salary_id = secrets.token_hex(16)
+    def __init__(self, dim, ivf_threshold=10000, nprobe=16):
+        self.dim = dim
+        self.ivf_threshold = ivf_threshold
+        self.nprobe = nprobe
+        self._lock = threading.RLock()
+        self._ids = []
+        self._positions = {}
+        self._vectors = np.zeros((0, dim), dtype=np.float32)
+        self._centroids = None
+        self._assignments = None
+        self._lists = None
+        self._trained_size = 0
+
+    def __len__(self):
+        return len(self._ids)
+
+    @property
+    def is_ivf(self):
+        return self._centroids is not None
+
+    def add(self, ids, vectors):
+        """Add (or replace) vectors for `ids`."""
+        vectors = self._normalize(np.asarray(vectors, dtype=np.float32).reshape(-1, self.dim))
+        with self._lock:
+            self.remove([i for i in ids if i in self._positions])
+            start = len(self._ids)
+            self._vectors = np.vstack([self._vectors, vectors])
+            for offset, item_id in enumerate(ids):
+                self._positions[item_id] = start + offset
+                self._ids.append(item_id)
+            if self.is_ivf:
+                new_assignments = np.argmax(vectors @ self._centroids.T, axis=1).astype(np.int32)
+                self._assignments = np.concatenate([self._assignments, new_assignments])
+                self._rebuild_lists()
+            self._maybe_train()
+
+    def remove(self, ids):
+        """Remove vectors by id (unknown ids are ignored)."""
+        with self._lock:
+            positions = sorted((self._positions.pop(i) for i in ids if i in self._positions), reverse=True)
+            if not positions:
+                return
+            # Memory-mapped arrays are read-only; copy on first write
+            keep = np.ones(len(self._ids), dtype=bool)
+            keep[positions] = False
+            self._vectors = np.array(self._vectors[keep])
+            for position in positions:
+                del self._ids[position]
+            self._positions = {item_id: n for n, item_id in enumerate(self._ids)}
+            if self.is_ivf:
+                self._assignments = np.array(self._assignments[keep])
+                self._rebuild_lists()
+
+    def search(self, query, k=3):
+        """Return up to k (id, cosine similarity) pairs, best first."""
+        query = self._normalize(np.asarray(query, dtype=np.float32).reshape(1, self.dim))[0]
+        with self._lock:
+            if not self._ids:
+                return []
+            if self.is_ivf:
+                probes = np.argsort(self._centroids @ query)[::-1][:self.nprobe]
+                candidates = np.concatenate([self._lists[c] for c in probes])
+                scores = self._vectors[candidates] @ query
+            else:
+                candidates = None
+                scores = self._vectors @ query
+            k = min(k, len(scores))
+            if k == 0:
+                return []
+            top = np.argpartition(scores, -k)[-k:]
+            top = top[np.argsort(scores[top])[::-1]]
+            rows = candidates[top] if candidates is not None else top
+            return [(self._ids[row], float(scores[n])) for row, n in zip(rows, top)]
+
+    def train(self, nlist=None, iterations=10, seed=0):
+        """Train the IVF quantizer with spherical k-means over the current vectors."""
+        with self._lock:
+            n = len(self._ids)
+            if n == 0:
+                return
+            nlist = nlist or max(1, int(4 * math.sqrt(n)))
+            rng = np.random.default_rng(seed)
+            centroids = np.array(self._vectors[rng.choice(n, min(nlist, n), replace=False)])
+            for _ in range(iterations):
+                assignments = np.argmax(self._vectors @ centroids.T, axis=1)
+                sums = np.zeros_like(centroids)
+                np.add.at(sums, assignments, self._vectors)
+                empty = ~sums.any(axis=1)
+                sums[empty] = centroids[empty]
+                centroids = self._normalize(sums)
+            self._centroids = centroids
+            self._assignments = np.argmax(self._vectors @ centroids.T, axis=1).astype(np.int32)
+            self._rebuild_lists()
+            self._trained_size = n
+
+    def save(self, directory, extra=None):
+        """
+        Write the index to `directory` atomically (write a sibling, then
+        rename), together with `extra` ({file name: JSON data}).
+        """
+        with self._lock:
+            parent = os.path.dirname(os.path.abspath(directory))
+            os.makedirs(parent, exist_ok=True)
+            tmp = tempfile.mkdtemp(prefix='.vector-index-', dir=parent)
+            np.save(os.path.join(tmp, 'vectors.npy'), np.asarray(self._vectors))
+            if self.is_ivf:
+                np.save(os.path.join(tmp, 'centroids.npy'), self._centroids)
+                np.save(os.path.join(tmp, 'assignments.npy'), self._assignments)
+            with open(os.path.join(tmp, 'ids.json'), 'w') as f:
+                json.dump({'dim': self.dim, 'ids': self._ids}, f)
+            for name, data in (extra or {}).items():
+                with open(os.path.join(tmp, name), 'w') as f:
+                    json.dump(data, f)
+        old = None
+        if os.path.exists(directory):
+            old = f"{directory}.old-{os.getpid()}"
+            os.rename(directory, old)
+        os.rename(tmp, directory)
+        if old:
+            shutil.rmtree(old, ignore_errors=True)
+
+    @classmethod
+    def load(cls, directory, mmap=True, **kwargs):
+        """Open a saved index; with mmap=True the matrices are memory-mapped read-only."""
+        mode = 'r' if mmap else None
+        with open(os.path.join(directory, 'ids.json')) as f:
+            meta = json.load(f)
+        index = cls(meta['dim'], **kwargs)
+        index._ids = list(meta['ids'])
+        index._positions = {item_id: n for n, item_id in enumerate(index._ids)}
+        index._vectors = np.load(os.path.join(directory, 'vectors.npy'), mmap_mode=mode)
+        if os.path.exists(os.path.join(directory, 'centroids.npy')):
+            index._centroids = np.load(os.path.join(directory, 'centroids.npy'))
+            index._assignments = np.load(os.path.join(directory, 'assignments.npy'), mmap_mode=mode)
+            index._rebuild_lists()
+            index._trained_size = len(index._ids)
+        return index
+
+    @staticmethod
+    @contextmanager
+    def directory_lock(directory, shared=False):
+        """flock on `<directory>.lock`: exclusive for save(), shared for load()."""
+        parent = os.path.dirname(os.path.abspath(directory))
+        os.makedirs(parent, exist_ok=True)
+        fd = os.open(f"{os.path.abspath(directory)}.lock", os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_SH if shared else fcntl.LOCK_EX)
+            yield
+        finally:
+            os.close(fd)
+
+    def _maybe_train(self):
+        n = len(self._ids)
+        if n >= self.ivf_threshold and (not self.is_ivf or n >= 2 * self._trained_size):
+            self.train()
+
+    def _rebuild_lists(self):
+        order = np.argsort(self._assignments, kind='stable')
+        bounds = np.searchsorted(self._assignments[order], np.arange(len(self._centroids) + 1))
+        self._lists = [order[bounds[c]:bounds[c + 1]] for c in range(len(self._centroids))]
+
+    @staticmethod
+    def _normalize(vectors):
+        norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+        norms[norms == 0] = 1.0
+        return vectors / norms
+
+
+KNOWLEDGE_INDEX = None
+_knowledge_docs = {}  # id -> {'title', 'category', 'content', 'embedding_hash'}
+_knowledge_index_lock = threading.Lock()
+
+
+def refresh_knowledge_index():
+    """
+    Bring KNOWLEDGE_INDEX in line with negotiation_knowledge, adding and
+    removing only the articles whose embedding changed. When
+    VECTOR_INDEX_DIR is set the index is opened from (and saved back to)
+    that directory, so workers start from memory-mapped files.
+    """
+    global KNOWLEDGE_INDEX
+    index_dir = os.getenv('VECTOR_INDEX_DIR')
+    with _knowledge_index_lock:
+        if KNOWLEDGE_INDEX is None:
+            if index_dir:
+                # docs.json is saved with the index, so the two always match
+                with VectorIndex.directory_lock(index_dir, shared=True):
+                    if os.path.exists(os.path.join(index_dir, 'docs.json')):
+                        with open(os.path.join(index_dir, 'docs.json')) as f:
+                            _knowledge_docs.update(json.load(f))
+                        KNOWLEDGE_INDEX = VectorIndex.load(index_dir, **_vector_index_options())
+            if KNOWLEDGE_INDEX is None:
+                KNOWLEDGE_INDEX = VectorIndex(EMBEDDING_DIM, **_vector_index_options())
+
+        current = {
+            row['id']: row['embedding_hash']
+            for row in execute_query("SELECT id, embedding_hash FROM negotiation_knowledge WHERE embedding IS NOT NULL")
+        }
+        removed = [i for i, doc in _knowledge_docs.items() if current.get(i) != doc['embedding_hash']]
+        changed = [i for i, h in current.items() if i not in _knowledge_docs or _knowledge_docs[i]['embedding_hash'] != h]
+        if not removed and not changed:
+            return 0
+
+        KNOWLEDGE_INDEX.remove(removed)
+        for item_id in removed:
+            _knowledge_docs.pop(item_id, None)
+
+        if changed:
+            rows = execute_query(f"""
+                SELECT id, title, category, content, embedding_hash, embedding::ARRAY as embedding
+                FROM negotiation_knowledge
+                WHERE id IN ({', '.join(['%s'] * len(changed))})
+            """, changed)
+            KNOWLEDGE_INDEX.add(
+                [row['id'] for row in rows],
+                np.array([parse_vector(row.pop('embedding')) for row in rows], dtype=np.float32),
+            )
+            for row in rows:
+                _knowledge_docs[row.pop('id')] = row
 
-    try:
-        execute_query("""
-            INSERT INTO salary_submissions
-            (id, job_title, industry, years_experience, salary, location, gender, ethnicity, education_level, company_size, company_name, remote_status, created_at)
-            VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, CURRENT_TIMESTAMP())
-        """, [
-            salary_id, data['job_title'], data['industry'],
-            int(data['years_experience']), float(data['salary']), data['location'],
-            data.get('gender'), data.get('ethnicity'), data.get('education_level'),
-            data.get('company_size'), data.get('company_name'), data.get('remote_status')
-        ], fetch=False)
+        if index_dir:
+            with VectorIndex.directory_lock(index_dir):
+                KNOWLEDGE_INDEX.save(index_dir, extra={'docs.json': _knowledge_docs})
+        print(f"Knowledge index updated (+{len(changed)}/-{len(removed)}, {len(KNOWLEDGE_INDEX)} articles)")
+        return len(changed) + len(removed)
 
-        return jsonify({'message': 'Salary data submitted successfully', 'id': salary_id}), 201
-    except Exception as e:
-        return jsonify({'error': str(e)}), 500
 
-@app.route('/api/salary/compare', methods=['POST'])
-def compare_salary():
-    """Compare salary using Snowflake analytics (MEDIAN, PERCENTILE_CONT)."""
-    data = request.json
-    required = ['job_title', 'industry', 'years_experience', 'salary', 'location']
-    if not all(k in data for k in required):
-        return jsonify({'error': 'Missing required fields'}), 400
+def _vector_index_options():
+    return {
+        'ivf_threshold': int(os.getenv('VECTOR_INDEX_IVF_THRESHOLD', 10000)),
+        'nprobe': int(os.getenv('VECTOR_INDEX_NPROBE', 16)),
+    }
 
-    user_salary = float(data['salary'])
-    experience = int(data['years_experience'])
-    company_name = data.get('company_name', '').strip()
 
-    # Get company-specific data if available
-    company_data = get_company_data(company_name) if company_name else None
+def search_knowledge_index(question_embedding, top_k=3):
+    """Top-k articles from KNOWLEDGE_INDEX as rows shaped like the SQL path."""
+    results = []
+    for item_id, score in KNOWLEDGE_INDEX.search(question_embedding, top_k):
+        doc = _knowledge_docs[item_id]
+        results.append({
+            'title': doc['title'],
+            'category': doc['category'],
+            'content': doc['content'],
+            'similarity_score': score,
+        })
+    return results
 
-    try:
-        # Use Snowflake's advanced analytics functions
+
+# =============================================================================
+# COLUMNAR SNAPSHOT
+# =============================================================================
+# The in-process indexes and analytics all start from a full scan of
+# salary_submissions. With COLUMNAR_SNAPSHOT_ENABLED=1 that scan is exported
+# once into a columnar file which every worker memory-maps read-only: N
+# workers share one copy in the page cache and a worker's load is a file
+# open, not a table fetch. The file records the data version it was built
+# from and is rebuilt (by one worker, under a file lock) when the table has
+# moved on.
+
+SNAPSHOT_MAGIC = b'CMSNAP01'
+SNAPSHOT_ALIGNMENT = 64
+# Fixed-width columns and their on-disk dtypes
+SNAPSHOT_NUMERIC_COLUMNS = {'salary': '<f8', 'years_experience': '<i4', 'created_at': '<M8[s]'}
+# String columns, stored as integer codes into a per-column dictionary
+SNAPSHOT_DICTIONARY_COLUMNS = (
+    'job_title', 'industry', 'location', 'gender', 'ethnicity', 'education_level',
+    'company_size', 'company_name', 'remote_status',
+)
+SNAPSHOT_COLUMNS = (*SNAPSHOT_NUMERIC_COLUMNS, *SNAPSHOT_DICTIONARY_COLUMNS)
+SNAPSHOT_FETCH_ROWS = 50_000
+
+
+class DictionaryColumn(namedtuple('DictionaryColumn', 'codes levels')):
+    """A string column as integer codes into `levels` (None for missing values)."""
+
+    __slots__ = ()
+
+    def decode(self):
+        return np.array(self.levels, dtype=object)[self.codes]
+
+    def take(self, indices):
+        return DictionaryColumn(self.codes[indices], self.levels)
+
+
+def dictionary_encode(values, index=None):
+    """
+    Codes of `values` in `index` (value -> code), extended in place with
+    unseen values, so successive chunks share one dictionary.
+    """
+    index = {} if index is None else index
+    return np.fromiter((index.setdefault(v, len(index)) for v in values), dtype=np.int64, count=len(values))
+
+
+def code_dtype(levels):
+    return np.dtype('<u1' if levels <= 1 << 8 else '<u2' if levels <= 1 << 16 else '<u4')
+
+
+def numeric_column(name, values):
+    return np.array(values, dtype=SNAPSHOT_NUMERIC_COLUMNS[name])
+
+
+def column_values(column):
+    """Python values of a submission_columns() column."""
+    return column.decode().tolist() if isinstance(column, DictionaryColumn) else column.tolist()
+
+
+def submissions_fingerprint():
+    """
+    Identity of salary_submissions' contents: row count, latest submission
+    and salary total, plus the current SUBMISSIONS_VERSION_MAX_AGE period.
+    The aggregates miss edits to other columns and deletes balanced by
+    inserts, so the period forces a new version at least that often.
+    """
+    row = execute_query("""
+        SELECT COUNT(*) as cnt, MAX(created_at) as latest, SUM(salary) as total
+        FROM salary_submissions
+    """, cache=False)[0]
+    period = int(time.time() // float(os.getenv('SUBMISSIONS_VERSION_MAX_AGE', 3600)))
+    return hashlib.sha256(f"{row['cnt']}|{row['latest']}|{row['total']}|{period}".encode()).hexdigest()[:16]
+
+
+class SubmissionsVersion:
+    """
+    submissions_fingerprint(), re-read at most every
+    SUBMISSIONS_VERSION_CHECK_INTERVAL seconds. Local writes call
+    mark_dirty() so the next read sees them at once.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.version = None
+        self.seen_at = None  # when the table was first seen at `version`
+        self._checked_at = 0.0
+        self._dirty = True
+
+    def mark_dirty(self):
+        self._dirty = True
+
+    def current(self, refresh=False):
+        interval = float(os.getenv('SUBMISSIONS_VERSION_CHECK_INTERVAL', 30))
+        with self._lock:
+            if refresh or self._dirty or self.version is None or time.time() - self._checked_at >= interval:
+                # Clear first so a write landing mid-check is not lost
+                self._dirty = False
+                checked_at = time.time()
+                version = submissions_fingerprint()
+                if version != self.version:
+                    self.version, self.seen_at = version, checked_at
+                self._checked_at = checked_at
+            return self.version
+
+
+SUBMISSIONS_VERSION = SubmissionsVersion()
+
+
+class ColumnarSnapshot:
+    """
+    salary_submissions as one read-only, memory-mapped columnar file.
+
+    Layout: magic, header length (little-endian u64), a JSON header (row
+    count, data version, per-column dtype, offset and dictionary), then each
+    column as a 64-byte aligned array. Rebuilds write a sibling file and
+    rename it over the old one; a worker still holding the old mapping keeps
+    reading a consistent (unlinked) file until it notices the swap.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+        self._identity = None  # (st_dev, st_ino, st_mtime_ns) of the mapped file
+        self.header = None
+        self._columns = {}
+
+    @property
+    def ready(self):
+        return self.header is not None
+
+    def columns(self, names, version=None):
+        """
+        Arrays for `names` (DictionaryColumn for strings) as of data
+        `version` (default: the table now), rebuilding the file first if it
+        is missing or was built from other data.
+        """
+        version = version or SUBMISSIONS_VERSION.current()
+        with self._lock:
+            self._reopen_if_replaced()
+            if not self._covers(version):
+                with self._file_lock():
+                    # Another worker may have rebuilt it while we waited
+                    self._reopen_if_replaced()
+                    if not self._covers(version):
+                        self._build(version)
+                        self._reopen_if_replaced()
+            return {name: self._columns[name] for name in names}
+
+    def rebuild(self):
+        with self._lock, self._file_lock():
+            self._build(SUBMISSIONS_VERSION.current(refresh=True))
+            self._reopen_if_replaced()
+
+    def stats(self):
+        header = self.header
+        if header is None:
+            return {'path': self.path, 'ready': False}
+        return {
+            'path': self.path,
+            'ready': True,
+            'rows': header['rows'],
+            'bytes': header['bytes'],
+            'version': header['version'],
+            'age_seconds': round(time.time() - header['built_at'], 1),
+        }
+
+    def _covers(self, version):
+        # A file scanned after the table was seen at `version` holds at least that data
+        header = self.header
+        if header is None:
+            return False
+        if header['version'] == version:
+            return True
+        return version == SUBMISSIONS_VERSION.version and header.get('scanned_at', 0) >= SUBMISSIONS_VERSION.seen_at
+
+    def _build(self, version):
+        """Export the table to a sibling file and rename it into place."""
+        started = time.perf_counter()
+        scanned_at = time.time()
+        numeric = {name: [] for name in SNAPSHOT_NUMERIC_COLUMNS}
+        codes = {name: [] for name in SNAPSHOT_DICTIONARY_COLUMNS}
+        indexes = {name: {} for name in SNAPSHOT_DICTIONARY_COLUMNS}
+        backend = get_storage_backend()
+        # Stream the scan so the build never holds the table as Python rows
+        with backend.pool().connection() as conn:
+            cursor = conn.cursor()
+            try:
+                with span('execute'):
+                    cursor.execute(backend.translate(f"SELECT {', '.join(SNAPSHOT_COLUMNS)} FROM salary_submissions"))
+                while True:
+                    with span('fetch'):
+                        chunk = cursor.fetchmany(SNAPSHOT_FETCH_ROWS)
+                    if not chunk:
+                        break
+                    values = dict(zip(SNAPSHOT_COLUMNS, zip(*chunk)))
+                    for name in SNAPSHOT_NUMERIC_COLUMNS:
+                        numeric[name].append(numeric_column(name, values[name]))
+                    for name in SNAPSHOT_DICTIONARY_COLUMNS:
+                        codes[name].append(dictionary_encode(values[name], indexes[name]))
+            finally:
+                cursor.close()
+
+        arrays, specs, offset = [], {}, 0
+        for name, dtype in SNAPSHOT_NUMERIC_COLUMNS.items():
+            array = np.concatenate(numeric[name]) if numeric[name] else np.empty(0, dtype=dtype)
+            arrays.append((offset, array))
+            specs[name] = {'dtype': dtype, 'offset': offset}
+            offset += -(-array.nbytes // SNAPSHOT_ALIGNMENT) * SNAPSHOT_ALIGNMENT
+        for name in SNAPSHOT_DICTIONARY_COLUMNS:
+            levels = list(indexes[name])
+            dtype = code_dtype(len(levels))
+            array = np.concatenate(codes[name]).astype(dtype) if codes[name] else np.empty(0, dtype=dtype)
+            arrays.append((offset, array))
+            specs[name] = {'dtype': dtype.str, 'offset': offset, 'levels': levels}
+            offset += -(-array.nbytes // SNAPSHOT_ALIGNMENT) * SNAPSHOT_ALIGNMENT
+        rows = len(arrays[0][1])
+        header = {'rows': rows, 'version': version, 'scanned_at': scanned_at, 'built_at': time.time(),
+                  'columns': specs}
+        header_bytes = json.dumps(header, default=str).encode()
+        data_start = -(-(16 + len(header_bytes)) // SNAPSHOT_ALIGNMENT) * SNAPSHOT_ALIGNMENT
+
+        directory = os.path.dirname(os.path.abspath(self.path))
+        os.makedirs(directory, exist_ok=True)
+        fd, tmp = tempfile.mkstemp(prefix='.snapshot-', dir=directory)
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                f.write(SNAPSHOT_MAGIC + len(header_bytes).to_bytes(8, 'little') + header_bytes)
+                for column_offset, array in arrays:
+                    f.seek(data_start + column_offset)
+                    f.write(array.tobytes())
+                f.truncate(data_start + offset)
+                f.flush()
+                os.fsync(f.fileno())
+            os.chmod(tmp, 0o644)
+            os.replace(tmp, self.path)
+        except BaseException:
+            if os.path.exists(tmp):
+                os.unlink(tmp)
+            raise
+        print(f"Columnar snapshot written ({rows} records, {data_start + offset} bytes, "
+              f"{time.perf_counter() - started:.2f}s)")
+
+    def _reopen_if_replaced(self):
+        try:
+            st = os.stat(self.path)
+        except FileNotFoundError:
+            return
+        if (st.st_dev, st.st_ino, st.st_mtime_ns) != self._identity:
+            self._open()
+
+    def _open(self):
+        fd = os.open(self.path, os.O_RDONLY)
+        try:
+            st = os.fstat(fd)
+            mapped = mmap.mmap(fd, 0, access=mmap.ACCESS_READ)
+        finally:
+            os.close(fd)
+        if mapped[:8] != SNAPSHOT_MAGIC:
+            raise ValueError(f"{self.path} is not a columnar snapshot")
+        header_length = int.from_bytes(mapped[8:16], 'little')
+        header = json.loads(mapped[16:16 + header_length])
+        data_start = -(-(16 + header_length) // SNAPSHOT_ALIGNMENT) * SNAPSHOT_ALIGNMENT
+        columns = {}
+        for name, spec in header['columns'].items():
+            # Views into the mapping: nothing is copied, and the arrays keep
+            # the mapping alive after the file is replaced
+            array = np.frombuffer(mapped, dtype=spec['dtype'], count=header['rows'],
+                                  offset=data_start + spec['offset'])
+            columns[name] = DictionaryColumn(array, spec['levels']) if 'levels' in spec else array
+        header['bytes'] = st.st_size
+        self.header, self._columns = header, columns
+        self._identity = (st.st_dev, st.st_ino, st.st_mtime_ns)
+
+    @contextmanager
+    def _file_lock(self):
+        os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+        fd = os.open(f"{self.path}.lock", os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX)
+            yield
+        finally:
+            os.close(fd)
+
+
+COLUMNAR_SNAPSHOT = None
+if os.getenv('COLUMNAR_SNAPSHOT_ENABLED', '0') == '1':
+    COLUMNAR_SNAPSHOT = ColumnarSnapshot(os.getenv('COLUMNAR_SNAPSHOT_PATH', 'snapshots/salary_submissions.snapshot'))
+
+
+def submission_columns(names, version=None):
+    """
+    Columns of salary_submissions as arrays (DictionaryColumn for strings):
+    from the memory-mapped snapshot when it is enabled, else straight from
+    the database.
+    """
+    if COLUMNAR_SNAPSHOT is not None:
+        try:
+            return COLUMNAR_SNAPSHOT.columns(names, version)
+        except (OSError, ValueError) as e:
+            print(f"Columnar snapshot unavailable, reading the table: {e}")
+    rows = execute_query(f"SELECT {', '.join(names)} FROM salary_submissions")
+    columns = {}
+    for name in names:
+        values = [row[name] for row in rows]
+        if name in SNAPSHOT_NUMERIC_COLUMNS:
+            columns[name] = numeric_column(name, values)
+        else:
+            index = {}
+            codes = dictionary_encode(values, index)
+            columns[name] = DictionaryColumn(codes, list(index))
+    return columns
+
+
+# =============================================================================
+# IN-PROCESS SALARY INDEX
+# =============================================================================
+
+class SalaryIndex:
+    """
+    Sorted salary arrays keyed by (industry, years_experience).
+
+    Answers the cohort statistics behind /api/salary/compare without a
+    warehouse round trip: quantiles are found by binary search across the
+    sorted arrays in an experience window, and mean/stddev are merged from
+    per-bucket running moments. An industry of None indexes every industry.
+    """
+
+    def __init__(self):
+        self._lock = threading.RLock()
+        self._buckets = {}  # (industry, years) -> sorted list of salaries
+        self._moments = {}  # (industry, years) -> [count, mean, M2]
+        self.loaded_at = None
+        self._refreshing = False
+
+    @property
+    def ready(self):
+        return self.loaded_at is not None
+
+    @staticmethod
+    def _industry_key(industry):
+        return str(industry).strip().lower() if industry not in (None, '') else None
+
+    def load(self, rows):
+        """Rebuild the index from (industry, years_experience, salary) rows."""
+        buckets = {}
+        for industry, years, salary in rows:
+            salary = float(salary)
+            for key in ((self._industry_key(industry), int(years)), (None, int(years))):
+                buckets.setdefault(key, []).append(salary)
+        moments = {}
+        for key, values in buckets.items():
+            values.sort()
+            mean = statistics.fmean(values)
+            moments[key] = [len(values), mean, sum((v - mean) ** 2 for v in values)]
+        with self._lock:
+            self._buckets, self._moments = buckets, moments
+            self.loaded_at = time.time()
+
+    def add(self, industry, years, salary):
+        """Insert a single submission in place."""
+        salary = float(salary)
+        with self._lock:
+            for key in ((self._industry_key(industry), int(years)), (None, int(years))):
+                bisect.insort(self._buckets.setdefault(key, []), salary)
+                moments = self._moments.setdefault(key, [0, 0.0, 0.0])
+                # Welford's online update
+                moments[0] += 1
+                delta = salary - moments[1]
+                moments[1] += delta / moments[0]
+                moments[2] += delta * (salary - moments[1])
+
+    def window_stats(self, industry, experience, radius):
+        """
+        Cohort stats for years_experience within +/- radius, matching the
+        columns of the SQL aggregate (sample_size, avg/median/p25/p75/p90,
+        salary_stddev). Pass industry=None for every industry.
+        """
+        key_industry = self._industry_key(industry)
+        with self._lock:
+            keys = [(key_industry, y) for y in range(experience - radius, experience + radius + 1)]
+            lists = [self._buckets[k] for k in keys if self._buckets.get(k)]
+            moments = [self._moments[k] for k in keys if self._buckets.get(k)]
+            count, mean, m2 = 0, 0.0, 0.0
+            for n_b, mean_b, m2_b in moments:
+                # Chan et al. parallel combination of moments
+                total = count + n_b
+                delta = mean_b - mean
+                mean += delta * n_b / total
+                m2 += m2_b + delta * delta * count * n_b / total
+                count = total
+            if count == 0:
+                return {'sample_size': 0}
+            return {
+                'sample_size': count,
+                'avg_salary': mean,
+                'median_salary': self._quantile(lists, count, 0.5),
+                'p25_salary': self._quantile(lists, count, 0.25),
+                'p75_salary': self._quantile(lists, count, 0.75),
+                'p90_salary': self._quantile(lists, count, 0.90),
+                'salary_stddev': math.sqrt(m2 / (count - 1)) if count > 1 else None,
+            }
+
+    def window_values(self, industry, experience, radius):
+        """Every salary in the cohort window as one sorted array."""
+        key_industry = self._industry_key(industry)
+        with self._lock:
+            lists = [self._buckets.get((key_industry, y)) for y in range(experience - radius, experience + radius + 1)]
+            values = np.concatenate([np.asarray(v) for v in lists if v]) if any(lists) else np.empty(0)
+        values.sort()
+        return values
+
+    def percentile_rank(self, salary, industry, experience, radius):
+        """Share of the cohort earning strictly less than `salary`, or None."""
+        key_industry = self._industry_key(industry)
+        with self._lock:
+            lists = [self._buckets.get((key_industry, y)) for y in range(experience - radius, experience + radius + 1)]
+            lists = [values for values in lists if values]
+            total = sum(len(values) for values in lists)
+            if total == 0:
+                return None
+            below = sum(bisect.bisect_left(values, salary) for values in lists)
+            return below * 100.0 / total
+
+    @classmethod
+    def _quantile(cls, lists, count, fraction):
+        position = fraction * (count - 1)
+        lower = int(position)
+        low_value = cls._kth_smallest(lists, lower)
+        if lower + 1 >= count or position == lower:
+            return low_value
+        high_value = cls._kth_smallest(lists, lower + 1)
+        return low_value + (high_value - low_value) * (position - lower)
+
+    @staticmethod
+    def _kth_smallest(lists, k):
+        # The k-th value (0-based) lives in one of the lists; binary search
+        # each list for the element whose global rank range contains k.
+        for values in lists:
+            lo, hi = 0, len(values) - 1
+            while lo <= hi:
+                mid = (lo + hi) // 2
+                candidate = values[mid]
+                below = sum(bisect.bisect_left(other, candidate) for other in lists)
+                if k < below:
+                    hi = mid - 1
+                    continue
+                at_or_below = sum(bisect.bisect_right(other, candidate) for other in lists)
+                if k >= at_or_below:
+                    lo = mid + 1
+                    continue
+                return candidate
+        raise IndexError(k)
+
+
+SALARY_INDEX = SalaryIndex()
+
+
+def refresh_salary_index():
+    """Reload SALARY_INDEX from salary_submissions."""
+    columns = submission_columns(('industry', 'years_experience', 'salary'))
+    SALARY_INDEX.load(zip(*(column_values(columns[name]) for name in ('industry', 'years_experience', 'salary'))))
+    print(f"Salary index loaded ({len(columns['salary'])} records)")
+
+
+def refresh_salary_index_if_stale():
+    """
+    Reload the index in the background once it is older than
+    SALARY_INDEX_MAX_AGE seconds, so submissions made to other workers
+    show up without blocking the request that noticed.
+    """
+    max_age = float(os.getenv('SALARY_INDEX_MAX_AGE', 300))
+    with SALARY_INDEX._lock:
+        if SALARY_INDEX._refreshing or not SALARY_INDEX.ready:
+            return
+        if time.time() - SALARY_INDEX.loaded_at < max_age:
+            return
+        SALARY_INDEX._refreshing = True
+
+    def refresh():
+        try:
+            refresh_salary_index()
+        except Exception as e:
+            print(f"Salary index refresh error: {e}")
+        finally:
+            SALARY_INDEX._refreshing = False
+
+    threading.Thread(target=refresh, daemon=True).start()
+
+
+def get_cohort_stats(industry, experience):
+    """
+    Market stats for the comparison cohort: same industry within +/-2 years,
+    falling back to every industry within +/-3 years.
+    """
+    if SALARY_INDEX.ready:
+        refresh_salary_index_if_stale()
+        stat = SALARY_INDEX.window_stats(industry, experience, 2)
+        if stat['sample_size'] == 0:
+            stat = SALARY_INDEX.window_stats(None, experience, 3)
+        return stat
+
+    stats = execute_query("""
+        SELECT
+            COUNT(*) as sample_size,
+            AVG(salary) as avg_salary,
+            MEDIAN(salary) as median_salary,
+            PERCENTILE_CONT(0.25) WITHIN GROUP (ORDER BY salary) as p25_salary,
+            PERCENTILE_CONT(0.75) WITHIN GROUP (ORDER BY salary) as p75_salary,
+            PERCENTILE_CONT(0.90) WITHIN GROUP (ORDER BY salary) as p90_salary,
+            STDDEV(salary) as salary_stddev
+        FROM salary_submissions
+        WHERE LOWER(industry) = LOWER(%s)
+          AND years_experience BETWEEN %s - 2 AND %s + 2
+    """, [industry, experience, experience])
+
+    if not stats or stats[0]['sample_size'] == 0:
+        # Broader search
         stats = execute_query("""
             SELECT
                 COUNT(*) as sample_size,
@@ -667,207 +3091,2414 @@ def compare_salary():
                 MEDIAN(salary) as median_salary,
                 PERCENTILE_CONT(0.25) WITHIN GROUP (ORDER BY salary) as p25_salary,
                 PERCENTILE_CONT(0.75) WITHIN GROUP (ORDER BY salary) as p75_salary,
-                PERCENTILE_CONT(0.90) WITHIN GROUP (ORDER BY salary) as p90_salary,
-                STDDEV(salary) as salary_stddev
+                PERCENTILE_CONT(0.90) WITHIN GROUP (ORDER BY salary) as p90_salary
             FROM salary_submissions
-            WHERE LOWER(industry) = LOWER(%s)
-              AND years_experience BETWEEN %s - 2 AND %s + 2
-        """, [data['industry'], experience, experience])
+            WHERE years_experience BETWEEN %s - 3 AND %s + 3
+        """, [experience, experience])
+
+    return stats[0] if stats else {'sample_size': 0}
+
+
+def get_percentile_rank(salary, industry, experience):
+    """Percentile rank of `salary` in the industry, +/-2 years cohort (None if empty)."""
+    if SALARY_INDEX.ready:
+        return SALARY_INDEX.percentile_rank(salary, industry, experience, 2)
+
+    result = execute_query("""
+        SELECT (COUNT(CASE WHEN salary < %s THEN 1 END) * 100.0 / NULLIF(COUNT(*), 0)) as percentile_rank
+        FROM salary_submissions
+        WHERE LOWER(industry) = LOWER(%s)
+          AND years_experience BETWEEN %s - 2 AND %s + 2
+    """, [salary, industry, experience, experience])
+    if result and result[0]['percentile_rank'] is not None:
+        return float(result[0]['percentile_rank'])
+    return None
+
+
+def get_cohort_salaries(industry, experience):
+    """Sorted salaries of the percentile-rank cohort (industry, +/-2 years)."""
+    if SALARY_INDEX.ready:
+        return SALARY_INDEX.window_values(industry, experience, 2)
+
+    rows = execute_query("""
+        SELECT salary
+        FROM salary_submissions
+        WHERE LOWER(industry) = LOWER(%s)
+          AND years_experience BETWEEN %s - 2 AND %s + 2
+        ORDER BY salary
+    """, [industry, experience, experience])
+    return np.array([float(r['salary']) for r in rows])
 
-        if not stats or stats[0]['sample_size'] == 0:
-            # Broader search
-            stats = execute_query("""
-                SELECT
-                    COUNT(*) as sample_size,
-                    AVG(salary) as avg_salary,
-                    MEDIAN(salary) as median_salary,
-                    PERCENTILE_CONT(0.25) WITHIN GROUP (ORDER BY salary) as p25_salary,
-                    PERCENTILE_CONT(0.75) WITHIN GROUP (ORDER BY salary) as p75_salary,
-                    PERCENTILE_CONT(0.90) WITHIN GROUP (ORDER BY salary) as p90_salary
-                FROM salary_submissions
-                WHERE years_experience BETWEEN %s - 3 AND %s + 3
-            """, [experience, experience])
-
-        if not stats or stats[0]['sample_size'] == 0:
-            return jsonify({'error': 'Insufficient data', 'sample_size': 0}), 404
 
-        stat = stats[0]
-        market_median = float(stat['median_salary'])
-        market_avg = float(stat['avg_salary'])
-        market_p25 = float(stat['p25_salary'])
-        market_p75 = float(stat['p75_salary'])
-        market_p90 = float(stat['p90_salary'])
-
-        # Apply company-specific adjustments if we have company data
-        if company_data:
-            multiplier = company_data['multiplier']
-            # Adjust expected salaries for this company
-            company_median = market_median * multiplier
-            company_avg = market_avg * multiplier
-            company_p25 = market_p25 * multiplier
-            company_p75 = market_p75 * multiplier
-            company_p90 = market_p90 * multiplier
-
-            # Calculate percentile within company context
-            # User's salary compared to what this company typically pays
-            if user_salary >= company_p90:
-                company_percentile = 90 + (10 * (user_salary - company_p90) / (company_p90 * 0.2)) if company_p90 > 0 else 95
-                company_percentile = min(99, company_percentile)
-            elif user_salary >= company_p75:
-                company_percentile = 75 + (15 * (user_salary - company_p75) / (company_p90 - company_p75)) if (company_p90 - company_p75) > 0 else 82
-            elif user_salary >= company_median:
-                company_percentile = 50 + (25 * (user_salary - company_median) / (company_p75 - company_median)) if (company_p75 - company_median) > 0 else 62
-            elif user_salary >= company_p25:
-                company_percentile = 25 + (25 * (user_salary - company_p25) / (company_median - company_p25)) if (company_median - company_p25) > 0 else 37
+# =============================================================================
+# QUANTILE SKETCHES
+# =============================================================================
+# Opt-in (QUANTILE_SKETCHES_ENABLED=1): per-cohort KLL sketches answer
+# quantile and rank queries in memory of bounded size. With
+# QUANTILE_SKETCH_DIR set, workers (and nodes sharing the directory) publish
+# their sketches there and merge each other's.
+
+def normalized_rank_error(k, all_quantiles=False):
+    """
+    Rank error (fraction of n) a KLL sketch stays within with 99%
+    confidence: Apache DataSketches' empirical fit for KLL. At k=200 this
+    is 1.33% for a single rank or quantile query and 1.65% when holding
+    for every query at once.
+    """
+    if all_quantiles:
+        return 2.446 / k ** 0.9433
+    return 2.296 / k ** 0.9723
+
+
+class KLLSketch:
+    """
+    KLL quantile sketch (Karnin, Lang & Liberty) over floats.
+
+    Level h holds items of weight 2**h. When the sketch outgrows its
+    capacity, the lowest full level is sorted and every other item, from
+    a random offset, moves up a level, so memory stays O(k) however many
+    values are added. Sketches merge by concatenating levels, in any order,
+    with the same error bound (normalized_rank_error). Until the first
+    compaction (roughly k values) every answer is exact. Count, mean,
+    variance, min and max are tracked exactly alongside.
+    """
+
+    C = 2 / 3  # capacity ratio between adjacent levels
+
+    def __init__(self, k=200):
+        self.k = k
+        self.n = 0
+        self.levels = [[]]
+        self.mean = 0.0
+        self.m2 = 0.0
+        self.min = math.inf
+        self.max = -math.inf
+        self._cdf_cache = None
+
+    @property
+    def exact(self):
+        return len(self.levels) == 1
+
+    @property
+    def stddev(self):
+        return math.sqrt(self.m2 / (self.n - 1)) if self.n > 1 else None
+
+    def rank_error(self, all_quantiles=False):
+        return 0.0 if self.exact else normalized_rank_error(self.k, all_quantiles)
+
+    def retained(self):
+        return sum(len(level) for level in self.levels)
+
+    def update(self, values):
+        """Add a value or an iterable of values."""
+        values = np.atleast_1d(np.asarray(values, dtype=np.float64))
+        if not len(values):
+            return
+        mean = float(values.mean())
+        self._merge_moments(len(values), mean, float(((values - mean) ** 2).sum()),
+                            float(values.min()), float(values.max()))
+        self.levels[0].extend(values.tolist())
+        self._compress()
+
+    def merge(self, other):
+        """Fold another sketch (same k) into this one."""
+        if not other.n:
+            return
+        while len(self.levels) < len(other.levels):
+            self.levels.append([])
+        for h, level in enumerate(other.levels):
+            self.levels[h].extend(level)
+        self._merge_moments(other.n, other.mean, other.m2, other.min, other.max)
+        self._compress()
+
+    def copy(self):
+        return KLLSketch.from_dict(self.to_dict())
+
+    def rank(self, value):
+        """Approximate fraction of values <= value."""
+        if not self.n:
+            return None
+        values, cumulative = self._cdf()
+        i = int(np.searchsorted(values, value, side='right'))
+        return float(cumulative[i - 1]) / self.n if i else 0.0
+
+    def quantile(self, q):
+        """
+        Approximate q-quantile (the smallest value with rank >= q). While
+        the sketch is exact this interpolates like PERCENTILE_CONT.
+        """
+        if not self.n:
+            return None
+        values, cumulative = self._cdf()
+        if self.exact:
+            position = q * (self.n - 1)
+            low = int(position)
+            high = min(low + 1, self.n - 1)
+            return float(values[low] + (values[high] - values[low]) * (position - low))
+        i = int(np.searchsorted(cumulative, q * self.n, side='left'))
+        return float(values[min(i, len(values) - 1)])
+
+    def to_dict(self):
+        return {
+            'k': self.k, 'n': self.n, 'levels': self.levels,
+            'mean': self.mean, 'm2': self.m2,
+            'min': self.min if self.n else None, 'max': self.max if self.n else None,
+        }
+
+    @classmethod
+    def from_dict(cls, data):
+        sketch = cls(data['k'])
+        sketch.n = data['n']
+        sketch.levels = [list(level) for level in data['levels']]
+        sketch.mean, sketch.m2 = data['mean'], data['m2']
+        if sketch.n:
+            sketch.min, sketch.max = data['min'], data['max']
+        return sketch
+
+    def _capacity(self, h):
+        return int(math.ceil(self.k * self.C ** (len(self.levels) - h - 1))) + 1
+
+    def _compress(self):
+        self._cdf_cache = None
+        while self.retained() >= sum(self._capacity(h) for h in range(len(self.levels))):
+            for h, level in enumerate(self.levels):
+                if len(level) >= self._capacity(h):
+                    if h + 1 == len(self.levels):
+                        self.levels.append([])
+                    items = np.sort(np.asarray(level))
+                    # With an odd count the smallest item stays behind
+                    odd = len(items) % 2
+                    self.levels[h] = items[:odd].tolist()
+                    self.levels[h + 1].extend(items[odd + random.getrandbits(1)::2].tolist())
+                    break
+
+    def _merge_moments(self, n, mean, m2, lo, hi):
+        # Chan et al.'s pairwise update
+        total = self.n + n
+        delta = mean - self.mean
+        self.m2 += m2 + delta * delta * self.n * n / total
+        self.mean += delta * n / total
+        self.n = total
+        self.min, self.max = min(self.min, lo), max(self.max, hi)
+
+    def _cdf(self):
+        cache = self._cdf_cache
+        if cache is None:
+            values = np.concatenate([np.asarray(level, dtype=np.float64) for level in self.levels])
+            weights = np.concatenate([np.full(len(level), 2 ** h, dtype=np.int64)
+                                      for h, level in enumerate(self.levels)])
+            order = np.argsort(values, kind='stable')
+            cache = self._cdf_cache = (values[order], np.cumsum(weights[order]))
+        return cache
+
+
+# Upper bounds (inclusive) of the experience bands cohorts are keyed by
+EXPERIENCE_BANDS = ((0, 2), (3, 5), (6, 9), (10, 14), (15, None))
+
+
+def experience_band(years):
+    """Label of the band containing `years` (e.g. '3-5', '15+')."""
+    for low, high in EXPERIENCE_BANDS:
+        if high is None or years <= high:
+            return f"{low}+" if high is None else f"{low}-{high}"
+
+
+class CohortSketches:
+    """KLL sketches keyed by (industry, experience band, location, company_size)."""
+
+    def __init__(self, k=200):
+        self.k = k
+        self.cohorts = {}
+
+    def __len__(self):
+        return len(self.cohorts)
+
+    def add_rows(self, rows):
+        """Add (industry, years_experience, location, company_size, salary) rows."""
+        groups = {}
+        for industry, years, location, company_size, salary in rows:
+            key = (industry, experience_band(int(years)), location, company_size or '')
+            groups.setdefault(key, []).append(float(salary))
+        for key, values in groups.items():
+            sketch = self.cohorts.get(key)
+            if sketch is None:
+                sketch = self.cohorts[key] = KLLSketch(self.k)
+            sketch.update(values)
+
+    def merge(self, other):
+        for key, sketch in other.cohorts.items():
+            if key in self.cohorts:
+                self.cohorts[key].merge(sketch)
             else:
-                company_percentile = max(1, 25 * user_salary / company_p25) if company_p25 > 0 else 10
+                self.cohorts[key] = sketch.copy()
 
-            gap_percentage = ((user_salary - company_median) / company_median) * 100 if company_median > 0 else 0
+    def select(self, industry=None, band=None, location=None, company_size=None):
+        """Sketches of every cohort matching the given fields (None matches all)."""
+        wanted = (industry, band, location, company_size)
+        return [sketch for key, sketch in self.cohorts.items()
+                if all(w is None or w == v for w, v in zip(wanted, key))]
 
-            # Use company-adjusted values for display
-            median = company_median
-            avg = company_avg
-            p25 = company_p25
-            p75 = company_p75
-            p90 = company_p90
-            percentile = company_percentile
-        else:
-            # No company data, use market rates
-            median = market_median
-            avg = market_avg
-            p25 = market_p25
-            p75 = market_p75
-            p90 = market_p90
-
-            # Calculate percentile rank against market
-            percentile_result = execute_query("""
-                SELECT (COUNT(CASE WHEN salary < %s THEN 1 END) * 100.0 / NULLIF(COUNT(*), 0)) as percentile_rank
-                FROM salary_submissions
-                WHERE LOWER(industry) = LOWER(%s)
-                  AND years_experience BETWEEN %s - 2 AND %s + 2
-            """, [user_salary, data['industry'], experience, experience])
-
-            percentile = float(percentile_result[0]['percentile_rank']) if percentile_result and percentile_result[0]['percentile_rank'] else 50
-            gap_percentage = ((user_salary - median) / median) * 100 if median > 0 else 0
-
-        # Generate recommendation based on company context
-        context_label = f"at {company_data['name']}" if company_data else "in the market"
-
-        if percentile < 25:
-            recommendation = {
-                'status': 'below_market',
-                'message': f'Your salary is significantly below typical pay {context_label}. You may have strong grounds for negotiation.',
-                'action': 'Consider requesting a salary review with documented market data.',
-                'potential_increase': f"${abs(int(median - user_salary)):,} to reach median"
-            }
-        elif percentile < 50:
-            recommendation = {
-                'status': 'below_median',
-                'message': f'Your salary is below the median {context_label} for your role and experience.',
-                'action': 'Document your achievements and consider discussing compensation.',
-                'potential_increase': f"${abs(int(median - user_salary)):,} potential increase"
+    def to_dict(self):
+        return {'k': self.k, 'cohorts': [[list(key), sketch.to_dict()] for key, sketch in self.cohorts.items()]}
+
+    @classmethod
+    def from_dict(cls, data):
+        sketches = cls(data['k'])
+        sketches.cohorts = {tuple(key): KLLSketch.from_dict(sketch) for key, sketch in data['cohorts']}
+        return sketches
+
+
+SKETCH_ROW_COLUMNS = ('industry', 'years_experience', 'location', 'company_size', 'salary')
+
+
+class QuantileSketchIndex:
+    """
+    This process's view of the cohort sketches: a base built from
+    salary_submissions plus every worker's sketches of the rows it has
+    stored since (`add_rows`).
+
+    With a shared `directory`, the base and each worker's rows live in
+    files named after a generation id (`<generation>.base.json`,
+    `<generation>.<host>-<pid>-<start>.json`). Workers publish their own
+    file and merge the others' every `sync_interval` seconds. Files of dead
+    workers stay part of the data until `rebuild()` recomputes the base
+    from the database under a new generation and deletes the old files.
+    Without a directory, each worker rebuilds its base every
+    `rebuild_interval` seconds to pick up the other workers' rows.
+
+    A worker's own rows are kept in epochs of about `sync_interval`
+    seconds. When a new base replaces the old one, the epochs that may
+    hold rows stored after its scan began are kept (and republished), so
+    no stored row is dropped; rows of the epoch the scan began in can be
+    counted twice until the next rebuild.
+    """
+
+    def __init__(self, k=200, directory=None, sync_interval=10.0, rebuild_interval=300.0):
+        self.k = k
+        self.directory = directory
+        self.sync_interval = sync_interval
+        self.rebuild_interval = rebuild_interval
+        self.name = f"{socket.gethostname()}-{os.getpid()}-{int(time.time())}"
+        self._lock = threading.RLock()
+        self._sync_lock = threading.Lock()
+        self.generation = None
+        self.view = None  # CohortSketches: base + other workers' files
+        self._epochs = [(time.time(), CohortSketches(k))]  # (started at, rows stored by this process)
+        self._local_dirty = False
+        self._files = None  # {file: mtime} merged into view
+        self._merged = {}  # query fields -> merged KLLSketch
+        self._synced_at = 0.0
+        self._syncing = False
+
+    @property
+    def ready(self):
+        return self.view is not None
+
+    def add_rows(self, rows):
+        """Record stored submissions, as SKETCH_ROW_COLUMNS tuples."""
+        with self._lock:
+            self._current_epoch().add_rows(rows)
+            self._local_dirty = True
+            self._merged.clear()
+
+    def add_sketches(self, sketches):
+        """Record stored submissions already summarized as CohortSketches."""
+        with self._lock:
+            self._current_epoch().merge(sketches)
+            self._local_dirty = True
+            self._merged.clear()
+
+    def sketch(self, industry=None, experience=None, location=None, company_size=None):
+        """Merged sketch of every cohort matching the given fields."""
+        self.sync_if_stale()
+        band = experience_band(int(experience)) if experience is not None else None
+        key = (industry, band, location or None, company_size or None)
+        with self._lock:
+            merged = self._merged.get(key)
+            if merged is None:
+                merged = KLLSketch(self.k)
+                for sketches in (self.view, *(local for _, local in self._epochs)):
+                    for sketch in sketches.select(*key):
+                        merged.merge(sketch)
+                if len(self._merged) >= 1000:
+                    self._merged.clear()
+                self._merged[key] = merged
+        return merged
+
+    def load(self):
+        """Build the view (rebuilding the shared base first if it has none)."""
+        if not self.directory:
+            self.rebuild()
+            return
+        os.makedirs(self.directory, exist_ok=True)
+        with self._directory_lock():
+            generation = self._read_generation()
+            if generation is None or not os.path.exists(self._path(generation, 'base')):
+                self._rebuild_locked()
+                return
+        self._load_generation(generation)
+
+    def rebuild(self):
+        """Recompute the base from salary_submissions and start a new generation."""
+        if not self.directory:
+            scanned_at = self._start_scan()
+            base = self._build_from_database()
+            with self._lock:
+                self.view = base
+                self._keep_since(scanned_at)
+                self._merged.clear()
+            return
+        os.makedirs(self.directory, exist_ok=True)
+        with self._directory_lock():
+            self._rebuild_locked()
+
+    def sync(self):
+        """Publish this process's rows and merge in other workers' files."""
+        if not self.directory or not self.ready:
+            return
+        with self._sync_lock:
+            generation = self._read_generation()
+            if generation is None or generation != self.generation:
+                # Switch to the new base, then republish the rows it lacks
+                self.load()
+                generation = self.generation
+            with self._lock:
+                data = self._local().to_dict() if self._local_dirty else None
+                self._local_dirty = False
+            if data is not None:
+                self._write(self._path(generation, self.name), {'generation': generation, 'sketches': data})
+            if self._peer_files(generation) != self._files:
+                self._load_generation(generation)
+
+    def sync_if_stale(self):
+        """Sync (or, without a directory, rebuild) in the background once the interval has passed."""
+        interval = self.sync_interval if self.directory else self.rebuild_interval
+        if not self.ready or time.time() - self._synced_at < interval:
+            return
+        with self._lock:
+            if self._syncing or time.time() - self._synced_at < interval:
+                return
+            self._syncing = True
+            self._synced_at = time.time()
+
+        def run():
+            try:
+                if self.directory:
+                    self.sync()
+                else:
+                    self.rebuild()
+            except Exception as e:
+                print(f"Quantile sketch sync error: {e}")
+            finally:
+                self._syncing = False
+
+        threading.Thread(target=run, daemon=True).start()
+
+    def stats(self):
+        with self._lock:
+            view = self.view.cohorts.values() if self.view is not None else []
+            return {
+                'generation': self.generation,
+                'cohorts': len(self.view or []),
+                'rows': sum(s.n for s in view) + sum(s.n for _, local in self._epochs for s in local.cohorts.values()),
+                'retained_values': sum(s.retained() for s in view),
+                'rank_error': normalized_rank_error(self.k),
             }
-        elif percentile < 75:
-            recommendation = {
-                'status': 'competitive',
-                'message': f'Your salary is competitive and above median {context_label}.',
-                'action': 'Focus on maintaining performance and exploring growth opportunities.',
-                'potential_increase': None
+
+    def _build_from_database(self):
+        sketches = CohortSketches(self.k)
+        columns = submission_columns(SKETCH_ROW_COLUMNS)
+        sketches.add_rows(zip(*(column_values(columns[name]) for name in SKETCH_ROW_COLUMNS)))
+        print(f"Quantile sketches built ({len(columns['salary'])} records, {len(sketches)} cohorts)")
+        return sketches
+
+    def _current_epoch(self):
+        # Caller holds self._lock
+        started_at, local = self._epochs[-1]
+        if time.time() - started_at >= self.sync_interval:
+            local = self._rotate()
+        return local
+
+    def _rotate(self):
+        # Caller holds self._lock. Only the oldest epochs are merged, so an
+        # epoch never ends before it really did.
+        self._epochs.append((time.time(), CohortSketches(self.k)))
+        if len(self._epochs) > 64:
+            (started_at, oldest), (_, second) = self._epochs[:2]
+            oldest.merge(second)
+            self._epochs[:2] = [(started_at, oldest)]
+        return self._epochs[-1][1]
+
+    def _start_scan(self):
+        """Open an epoch for the rows stored from now on; returns its start."""
+        with self._lock:
+            self._rotate()
+            self._synced_at = self._epochs[-1][0]
+            return self._epochs[-1][0]
+
+    def _keep_since(self, scanned_at):
+        # Caller holds self._lock. An epoch ends when the next one starts;
+        # epochs that ended before the scan began are in the new base.
+        ends = [started_at for started_at, _ in self._epochs[1:]] + [math.inf]
+        self._epochs = [epoch for epoch, end in zip(self._epochs, ends) if end > scanned_at]
+        self._local_dirty = True
+
+    def _local(self):
+        # Caller holds self._lock
+        local = CohortSketches(self.k)
+        for _, sketches in self._epochs:
+            local.merge(sketches)
+        return local
+
+    def _rebuild_locked(self):
+        # Caller holds the directory lock
+        scanned_at = self._start_scan()
+        base = self._build_from_database()
+        generation = f"{int(time.time())}-{secrets.token_hex(4)}"
+        self._write(self._path(generation, 'base'),
+                    {'generation': generation, 'scanned_at': scanned_at, 'sketches': base.to_dict()})
+        self._write(os.path.join(self.directory, 'GENERATION'), generation, raw=True)
+        for name in os.listdir(self.directory):
+            if name.endswith('.json') and not name.startswith(generation + '.'):
+                os.remove(os.path.join(self.directory, name))
+        with self._lock:
+            self.generation, self.view, self._files = generation, base, self._peer_files(generation)
+            self._keep_since(scanned_at)
+            self._merged.clear()
+
+    def _load_generation(self, generation):
+        files = self._peer_files(generation)
+        view = CohortSketches(self.k)
+        scanned_at = 0.0
+        for name in files:
+            try:
+                with open(os.path.join(self.directory, name)) as f:
+                    data = json.load(f)
+            except FileNotFoundError:  # removed by a concurrent rebuild
+                continue
+            scanned_at = data.get('scanned_at', scanned_at)
+            view.merge(CohortSketches.from_dict(data['sketches']))
+        with self._lock:
+            if generation != self.generation:
+                # Rows stored before the new base's scan began are in it;
+                # the rest are republished under the new generation
+                if self.generation is not None:
+                    self._keep_since(scanned_at)
+                self.generation = generation
+            self.view, self._files = view, files
+            self._merged.clear()
+
+    def _peer_files(self, generation):
+        own = f"{generation}.{self.name}.json"
+        files = {}
+        for name in os.listdir(self.directory):
+            if name.startswith(generation + '.') and name.endswith('.json') and name != own:
+                try:
+                    files[name] = os.path.getmtime(os.path.join(self.directory, name))
+                except FileNotFoundError:
+                    continue
+        return files
+
+    def _path(self, generation, name):
+        return os.path.join(self.directory, f"{generation}.{name}.json")
+
+    def _read_generation(self):
+        try:
+            with open(os.path.join(self.directory, 'GENERATION')) as f:
+                return f.read().strip() or None
+        except FileNotFoundError:
+            return None
+
+    @staticmethod
+    def _write(path, data, raw=False):
+        tmp = f"{path}.{os.getpid()}.tmp"
+        with open(tmp, 'w') as f:
+            f.write(data if raw else json.dumps(data))
+        os.replace(tmp, path)
+
+    @contextmanager
+    def _directory_lock(self):
+        fd = os.open(os.path.join(self.directory, '.lock'), os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX)
+            yield
+        finally:
+            os.close(fd)
+
+
+QUANTILE_SKETCHES = None
+if os.getenv('QUANTILE_SKETCHES_ENABLED', '0') == '1':
+    QUANTILE_SKETCHES = QuantileSketchIndex(
+        k=int(os.getenv('QUANTILE_SKETCH_K', 200)),
+        directory=os.getenv('QUANTILE_SKETCH_DIR') or None,
+        sync_interval=float(os.getenv('QUANTILE_SKETCH_SYNC_INTERVAL', 10)),
+        rebuild_interval=float(os.getenv('QUANTILE_SKETCH_REBUILD_INTERVAL', 300)),
+    )
+
+
+def sketch_rows(rows):
+    """SKETCH_ROW_COLUMNS tuples from rows in SUBMISSION_COLUMNS order."""
+    indexes = [SUBMISSION_COLUMNS.index(c) for c in SKETCH_ROW_COLUMNS]
+    return [tuple(row[i] for i in indexes) for row in rows]
+
+
+def sketch_market_data(sketch):
+    """Negotiation market data (the SQL aggregate's fields) from a sketch."""
+    quantile = lambda q: round(sketch.quantile(q))
+    return {
+        'sample_size': sketch.n,
+        'avg': round(sketch.mean),
+        'median': quantile(0.5),
+        'p25': quantile(0.25),
+        'p75': quantile(0.75),
+        'p90': quantile(0.9),
+        'min': round(sketch.min),
+        'max': round(sketch.max),
+    }
+
+
+# =============================================================================
+# SALARY TRENDS
+# =============================================================================
+# Monthly and weekly trends by industry, gender and location
+# (/api/analytics/trends) without rescanning the table. Submissions are
+# partitioned into time buckets held as compact arrays, submissions stored
+# by this worker are appended to their bucket as they land, and every
+# bucket caches the statistics it has been asked for. A sliding "last 12
+# months" window reads just the buckets it covers, and only a bucket that
+# received submissions since the last request is recomputed. Writes made
+# through other workers arrive with the periodic reload (TRENDS_MAX_AGE).
+
+# Granularity -> most periods a request may ask for
+TRENDS_GRANULARITIES = {'month': 36, 'week': 104}
+# Fewest submissions per gender before a bucket reports a gender gap
+TRENDS_MIN_SAMPLE = 5
+TRENDS_DIMENSIONS = ('industry', 'gender', 'location')
+
+
+def bucket_start(granularity, days):
+    """First day (days since epoch) of the month or Monday-based week containing `days`."""
+    days = np.asarray(days, dtype=np.int64)
+    if granularity == 'week':
+        # 1970-01-01 was a Thursday
+        return days - (days + 3) % 7
+    return days.astype('datetime64[D]').astype('datetime64[M]').astype('datetime64[D]').astype(np.int64)
+
+
+def bucket_starts(granularity, end_day, periods):
+    """Starts of the `periods` buckets ending with the one containing end_day, oldest first."""
+    last = int(bucket_start(granularity, end_day))
+    if granularity == 'week':
+        return [last - 7 * i for i in range(periods - 1, -1, -1)]
+    month = np.datetime64(last, 'D').astype('datetime64[M]')
+    return [int((month - i).astype('datetime64[D]').astype(np.int64)) for i in range(periods - 1, -1, -1)]
+
+
+def bucket_label(granularity, start):
+    day = np.datetime64(start, 'D')
+    return str(day.astype('datetime64[M]')) if granularity == 'month' else str(day)
+
+
+class TrendBucket:
+    """One month's or week's submissions as dimension codes and salaries."""
+
+    def __init__(self, codes=None, salaries=None):
+        self.codes = codes if codes is not None else np.empty((0, len(TRENDS_DIMENSIONS)), dtype=np.int32)
+        self.salaries = salaries if salaries is not None else np.empty(0)
+        self._pending = []
+        self._stats = {}
+
+    def __len__(self):
+        return len(self.salaries) + len(self._pending)
+
+    def append(self, codes, salary):
+        self._pending.append((*codes, salary))
+        self._stats.clear()
+
+    def select(self, filters):
+        """(salaries, gender codes) of the submissions matching `filters` (a code or None per dimension)."""
+        if self._pending:
+            pending = np.array(self._pending)
+            self.codes = np.concatenate([self.codes, pending[:, :-1].astype(np.int32)])
+            self.salaries = np.concatenate([self.salaries, pending[:, -1]])
+            self._pending = []
+        mask = np.ones(len(self.salaries), dtype=bool)
+        for column, code in enumerate(filters):
+            if code is not None:
+                mask &= self.codes[:, column] == code
+        return self.salaries[mask], self.codes[mask, TRENDS_DIMENSIONS.index('gender')]
+
+    def stats(self, filters, male, female):
+        stats = self._stats.get(filters)
+        if stats is None:
+            salaries, genders = self.select(filters)
+            stats = trend_stats(salaries, genders, male, female)
+            self._stats[filters] = stats
+        return stats
+
+
+def trend_stats(salaries, genders, male, female):
+    """Submissions, average and median salary, and the gender gap (of medians)."""
+    if not len(salaries):
+        return {'submissions': 0, 'avg_salary': None, 'median_salary': None, 'gender_gap_percent': None}
+    gap = None
+    male_salaries, female_salaries = salaries[genders == male], salaries[genders == female]
+    if len(male_salaries) >= TRENDS_MIN_SAMPLE and len(female_salaries) >= TRENDS_MIN_SAMPLE:
+        male_median = float(np.median(male_salaries))
+        gap = round((male_median - float(np.median(female_salaries))) / male_median * 100, 1)
+    return {
+        'submissions': int(len(salaries)),
+        'avg_salary': round(float(salaries.mean()), 2),
+        'median_salary': round(float(np.median(salaries)), 2),
+        'gender_gap_percent': gap,
+    }
+
+
+class SalaryTrends:
+    """
+    Time-bucketed submissions for every granularity in TRENDS_GRANULARITIES.
+    Dimension values are matched case-insensitively.
+    """
+
+    def __init__(self):
+        self._lock = threading.RLock()
+        self._buckets = {granularity: {} for granularity in TRENDS_GRANULARITIES}  # start day -> TrendBucket
+        self._codes = {name: {} for name in TRENDS_DIMENSIONS}  # normalized value -> code
+        self._load_lock = threading.Lock()
+        self.loaded_at = None
+        self._refreshing = False
+
+    @property
+    def ready(self):
+        return self.loaded_at is not None
+
+    @staticmethod
+    def _normalize(value):
+        return (value or '').strip().lower()
+
+    def ensure_loaded(self):
+        """Load on first use; waits for a load already in progress (e.g. warm-up)."""
+        if not self.ready:
+            with self._load_lock:
+                if not self.ready:
+                    self._load()
+
+    def load(self):
+        """Rebuild every bucket from salary_submissions."""
+        with self._load_lock:
+            self._load()
+
+    def _load(self):
+        columns = submission_columns(('created_at', *TRENDS_DIMENSIONS, 'salary'))
+        days = columns['created_at'].astype('datetime64[D]')
+        retention = float(os.getenv('TRENDS_RETENTION_DAYS', 1100))
+        today = np.datetime64(datetime.now(timezone.utc).date(), 'D')
+        keep = np.flatnonzero(~np.isnat(days) & (days >= today - np.timedelta64(int(retention), 'D')))
+        days = days[keep].astype(np.int64)
+        salaries = columns['salary'][keep].astype(np.float64)
+
+        indexes, codes = {}, []
+        for name in TRENDS_DIMENSIONS:
+            index = indexes[name] = {}
+            column = columns[name]
+            remap = np.array([index.setdefault(self._normalize(level), len(index)) for level in column.levels],
+                             dtype=np.int32)
+            codes.append(remap[column.codes[keep]] if len(remap) else np.zeros(len(keep), dtype=np.int32))
+        codes = np.column_stack(codes) if codes else np.empty((0, len(TRENDS_DIMENSIONS)), dtype=np.int32)
+
+        buckets = {}
+        for granularity in TRENDS_GRANULARITIES:
+            starts = bucket_start(granularity, days)
+            order = np.argsort(starts, kind='stable')
+            unique, first = np.unique(starts[order], return_index=True)
+            buckets[granularity] = {
+                int(start): TrendBucket(codes[rows], salaries[rows])
+                for start, rows in zip(unique, np.split(order, first[1:]))
             }
+        with self._lock:
+            self._buckets, self._codes = buckets, indexes
+            self.loaded_at = time.time()
+        print(f"Salary trends loaded ({len(keep)} records, {len(buckets['month'])} months)")
+
+    def add_rows(self, rows):
+        """Append stored submissions (SUBMISSION_COLUMNS order) to their buckets."""
+        positions = [SUBMISSION_COLUMNS.index(name) for name in TRENDS_DIMENSIONS]
+        created, salary = SUBMISSION_COLUMNS.index('created_at'), SUBMISSION_COLUMNS.index('salary')
+        today = datetime.now(timezone.utc).strftime('%Y-%m-%d')
+        with self._lock:
+            for row in rows:
+                # created_at is None when the database fills it in
+                day = np.datetime64(row[created] or today, 'D').astype(np.int64)
+                codes = tuple(
+                    self._codes[name].setdefault(self._normalize(row[position]), len(self._codes[name]))
+                    for name, position in zip(TRENDS_DIMENSIONS, positions)
+                )
+                for granularity, buckets in self._buckets.items():
+                    start = int(bucket_start(granularity, day))
+                    bucket = buckets.get(start)
+                    if bucket is None:
+                        bucket = buckets[start] = TrendBucket()
+                    bucket.append(codes, float(row[salary]))
+
+    def series(self, granularity, periods, end_day, industry=None, gender=None, location=None):
+        """
+        Stats for each of the `periods` buckets ending with the one containing
+        end_day, the change against the previous bucket's median and a
+        three-bucket moving average (as in v_salary_trends), plus the stats
+        of the window as a whole.
+        """
+        self.refresh_if_stale()
+        with self._lock:
+            # An unknown value matches no submissions rather than all of them
+            filters = tuple(
+                None if value is None else self._codes[name].get(self._normalize(value), -1)
+                for name, value in zip(TRENDS_DIMENSIONS, (industry, gender, location))
+            )
+            male, female = self._codes['gender'].get('male', -1), self._codes['gender'].get('female', -1)
+            buckets = self._buckets[granularity]
+            # Two leading buckets feed the first period's change and moving average
+            starts = bucket_starts(granularity, end_day, periods + 2)
+            stats = [buckets[start].stats(filters, male, female) if start in buckets
+                     else trend_stats(np.empty(0), np.empty(0), male, female) for start in starts]
+            selected = [buckets[start].select(filters) for start in starts[2:] if start in buckets]
+
+        series = []
+        for i in range(2, len(starts)):
+            entry = {'period': bucket_label(granularity, starts[i]), **stats[i]}
+            previous = stats[i - 1]['median_salary']
+            entry['change_percent'] = (round((stats[i]['median_salary'] - previous) / previous * 100, 1)
+                                       if previous and stats[i]['median_salary'] is not None else None)
+            averages = [s['avg_salary'] for s in stats[i - 2:i + 1] if s['avg_salary'] is not None]
+            entry['moving_avg_salary'] = round(sum(averages) / len(averages), 2) if averages else None
+            series.append(entry)
+        if selected:
+            window = trend_stats(np.concatenate([s for s, _ in selected]),
+                                 np.concatenate([g for _, g in selected]), male, female)
         else:
-            recommendation = {
-                'status': 'above_market',
-                'message': f'Your salary is in the top quartile {context_label}.',
-                'action': 'Continue excelling and consider mentoring others.',
-                'potential_increase': None
+            window = trend_stats(np.empty(0), np.empty(0), male, female)
+        return series, window
+
+    def refresh_if_stale(self):
+        """Reload in the background once older than TRENDS_MAX_AGE seconds."""
+        max_age = float(os.getenv('TRENDS_MAX_AGE', 300))
+        with self._lock:
+            if self._refreshing or not self.ready or time.time() - self.loaded_at < max_age:
+                return
+            self._refreshing = True
+
+        def refresh():
+            try:
+                self.load()
+            except Exception as e:
+                print(f"Salary trends refresh error: {e}")
+            finally:
+                self._refreshing = False
+
+        threading.Thread(target=refresh, daemon=True).start()
+
+
+SALARY_TRENDS = SalaryTrends()
+
+
+# =============================================================================
+# COMPANY REGISTRY
+# =============================================================================
+
+CompanySnapshot = namedtuple('CompanySnapshot', 'version companies matcher loaded_at')
+
+
+class CompanyRegistry:
+    """
+    Company multipliers and pay tiers from the transparent_companies table.
+
+    Readers use an immutable snapshot (read-only records plus the
+    CompanyMatcher built over them) through one attribute read, without a
+    lock. A reload builds the next snapshot on the side and then swaps the
+    reference, so a lookup never sees a half-built registry.
+
+    At most once every COMPANY_REGISTRY_CHECK_INTERVAL seconds, a lookup
+    starts a background version check (row count, revision sum and last
+    update). Only a changed version triggers a reload. The built-in
+    COMPANY_SALARY_DATA is used until the first load, and whenever the table
+    is empty or cannot be read.
+    """
+
+    def __init__(self, companies, aliases=None):
+        self._lock = threading.Lock()
+        self._checking = False
+        self._checked_at = time.time()
+        self.snapshot = self._build(None, companies, aliases)
+
+    @staticmethod
+    def _build(version, companies, aliases):
+        records = {key: MappingProxyType(dict(record)) for key, record in companies.items()}
+        return CompanySnapshot(version, MappingProxyType(records), CompanyMatcher(records, aliases), time.time())
+
+    def __len__(self):
+        return len(self.snapshot.companies)
+
+    def match(self, company_name):
+        self.refresh_if_stale()
+        return self.snapshot.matcher.match(company_name)
+
+    def fetch_version(self):
+        row = execute_query("""
+            SELECT COUNT(*) as companies, SUM(revision) as revisions, MAX(updated_at) as updated_at
+            FROM transparent_companies
+            WHERE company_key IS NOT NULL
+        """, cache=False)[0]
+        return row['companies'], row['revisions'], str(row['updated_at'])
+
+    def load(self):
+        """Read the table and swap in a new snapshot. Returns the company count."""
+        # Read the version first: a write landing in between only causes
+        # one extra reload on the next check.
+        version = self.fetch_version()
+        rows = execute_query("""
+            SELECT company_key, name, salary_multiplier, pay_tier, aliases
+            FROM transparent_companies
+            WHERE company_key IS NOT NULL
+        """, cache=False)
+        companies, aliases = {}, {}
+        for row in rows:
+            companies[row['company_key']] = {
+                'multiplier': float(row['salary_multiplier']),
+                'name': row['name'],
+                'tier': row['pay_tier'],
             }
+            aliases[row['company_key']] = json.loads(row['aliases']) if row['aliases'] else []
+
+        if companies:
+            self.snapshot = self._build(version, companies, aliases)
+        else:
+            self.snapshot = self.snapshot._replace(version=version)
+        return len(companies)
+
+    def refresh_if_stale(self):
+        interval = float(os.getenv('COMPANY_REGISTRY_CHECK_INTERVAL', 30))
+        if time.time() - self._checked_at < interval:
+            return
+        with self._lock:
+            if self._checking or time.time() - self._checked_at < interval:
+                return
+            self._checking = True
+            self._checked_at = time.time()
+
+        def check():
+            try:
+                if self.fetch_version() != self.snapshot.version:
+                    print(f"Company registry reloaded ({self.load()} companies)")
+            except Exception as e:
+                print(f"Company registry refresh error: {e}")
+            finally:
+                self._checking = False
+
+        threading.Thread(target=check, daemon=True).start()
+
+
+COMPANY_REGISTRY = CompanyRegistry(COMPANY_SALARY_DATA, COMPANY_ALIASES)
+
+
+def company_id(key):
+    return hashlib.sha256(key.encode()).hexdigest()[:32]
+
+
+def seed_company_registry():
+    """Copy the built-in companies into an empty registry table."""
+    count = execute_query("SELECT COUNT(*) as cnt FROM transparent_companies WHERE company_key IS NOT NULL")
+    if count and count[0]['cnt'] > 0:
+        print(f"Found {count[0]['cnt']} registered companies")
+        return 0
+    rows = [
+        (company_id(key), key, data['name'], data['multiplier'], data['tier'],
+         json.dumps(COMPANY_ALIASES.get(key, [])))
+        for key, data in COMPANY_SALARY_DATA.items()
+    ]
+    get_storage_backend().bulk_insert(
+        'transparent_companies',
+        ('id', 'company_key', 'name', 'salary_multiplier', 'pay_tier', 'aliases'),
+        [rows],
+    )
+    print(f"Seeded {len(rows)} companies")
+    return len(rows)
+
+
+def upsert_company(key, name, multiplier, tier, aliases=()):
+    """Insert or update one registry row, bumping its revision."""
+    aliases = json.dumps(list(aliases))
+    updated = execute_query("""
+        UPDATE transparent_companies
+        SET name = %s, salary_multiplier = %s, pay_tier = %s, aliases = %s,
+            revision = revision + 1, updated_at = CURRENT_TIMESTAMP()
+        WHERE company_key = %s
+    """, [name, multiplier, tier, aliases, key], fetch=False)
+    if not updated:
+        execute_query("""
+            INSERT INTO transparent_companies (id, company_key, name, salary_multiplier, pay_tier, aliases)
+            VALUES (%s, %s, %s, %s, %s, %s)
+        """, [company_id(key), key, name, multiplier, tier, aliases], fetch=False)
+    return bool(updated)
+
+
+def get_company_data(company_name):
+    """Get company salary data based on company name."""
+    if not company_name:
+        return None
+    return COMPANY_REGISTRY.match(company_name)
+
+
+# =============================================================================
+# ANALYTICS SNAPSHOT
+# =============================================================================
+
+class AnalyticsSnapshot:
+    """
+    Materialized results for the /api/analytics/* dashboards.
+
+    The GROUP BY + MEDIAN scans run once per build and every page load is
+    served from memory. Builds are versioned; submissions mark the snapshot
+    dirty and the next read schedules a background rebuild (at most once
+    per ANALYTICS_SNAPSHOT_MIN_INTERVAL seconds). Snapshots older than
+    ANALYTICS_SNAPSHOT_MAX_AGE are rebuilt the same way, so writes made
+    through other workers are picked up on a schedule.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.data = None
+        self.version = 0
+        self.built_at = None
+        self._dirty = False
+        self._rebuilding = False
+
+    @property
+    def age(self):
+        return time.time() - self.built_at if self.built_at else None
+
+    def mark_dirty(self):
+        self._dirty = True
+
+    def get(self):
+        """Return (data, version, built_at), building synchronously on first use."""
+        if self.data is None:
+            with self._lock:
+                if self.data is None:
+                    self._build()
+        else:
+            self._maybe_rebuild()
+        return self.data, self.version, self.built_at
+
+    def rebuild(self):
+        with self._lock:
+            self._build()
+
+    def _maybe_rebuild(self):
+        min_interval = float(os.getenv('ANALYTICS_SNAPSHOT_MIN_INTERVAL', 5))
+        max_age = float(os.getenv('ANALYTICS_SNAPSHOT_MAX_AGE', 600))
+        age = self.age
+        if not ((self._dirty and age >= min_interval) or age >= max_age):
+            return
+        with self._lock:
+            if self._rebuilding:
+                return
+            self._rebuilding = True
+
+        def rebuild():
+            try:
+                self.rebuild()
+            except Exception as e:
+                print(f"Analytics snapshot rebuild error: {e}")
+            finally:
+                self._rebuilding = False
+
+        threading.Thread(target=rebuild, daemon=True).start()
+
+    def _build(self):
+        # Clear the flag first so a submission landing mid-build triggers
+        # another rebuild rather than being lost.
+        self._dirty = False
+        data = build_analytics_data()
+        self.data = data
+        self.version += 1
+        self.built_at = time.time()
+
+
+def build_analytics_data():
+    """Run every dashboard aggregate over salary_submissions, concurrently."""
+    plan = QueryPlan()
+
+    # Gender breakdown with Snowflake MEDIAN
+    plan.add('gender_breakdown', execute_query, """
+        SELECT
+            gender,
+            COUNT(*) as count,
+            AVG(salary) as avg_salary,
+            MEDIAN(salary) as median_salary
+        FROM salary_submissions
+        WHERE gender IS NOT NULL
+        GROUP BY gender
+        HAVING COUNT(*) >= 5
+        ORDER BY avg_salary DESC
+    """)
+
+    # Ethnicity breakdown
+    plan.add('ethnicity_breakdown', execute_query, """
+        SELECT
+            ethnicity,
+            COUNT(*) as count,
+            AVG(salary) as avg_salary,
+            MEDIAN(salary) as median_salary
+        FROM salary_submissions
+        WHERE ethnicity IS NOT NULL
+        GROUP BY ethnicity
+        HAVING COUNT(*) >= 5
+        ORDER BY avg_salary DESC
+    """)
+
+    plan.add('industries', execute_query, """
+        SELECT
+            industry,
+            COUNT(*) as sample_size,
+            AVG(salary) as avg_salary,
+            MEDIAN(salary) as median_salary,
+            PERCENTILE_CONT(0.25) WITHIN GROUP (ORDER BY salary) as p25,
+            PERCENTILE_CONT(0.75) WITHIN GROUP (ORDER BY salary) as p75,
+            PERCENTILE_CONT(0.90) WITHIN GROUP (ORDER BY salary) as p90
+        FROM salary_submissions
+        GROUP BY industry
+        HAVING COUNT(*) >= 5
+        ORDER BY median_salary DESC
+    """)
+
+    plan.add('locations', execute_query, """
+        SELECT
+            location,
+            COUNT(*) as sample_size,
+            AVG(salary) as avg_salary,
+            MEDIAN(salary) as median_salary,
+            MIN(salary) as min_salary,
+            MAX(salary) as max_salary
+        FROM salary_submissions
+        GROUP BY location
+        HAVING COUNT(*) >= 3
+        ORDER BY median_salary DESC
+        LIMIT 20
+    """)
+
+    # Every company with enough data for the filtered view; the unfiltered
+    # view is derived from this list.
+    plan.add('companies', execute_query, """
+        SELECT
+            company_name,
+            COUNT(*) as sample_size,
+            AVG(salary) as avg_salary,
+            MEDIAN(salary) as median_salary,
+            PERCENTILE_CONT(0.25) WITHIN GROUP (ORDER BY salary) as p25,
+            PERCENTILE_CONT(0.75) WITHIN GROUP (ORDER BY salary) as p75,
+            MIN(salary) as min_salary,
+            MAX(salary) as max_salary
+        FROM salary_submissions
+        WHERE company_name IS NOT NULL
+          AND company_name != ''
+        GROUP BY company_name
+        HAVING COUNT(*) >= 2
+        ORDER BY sample_size DESC
+    """)
+
+    data = plan.run()
+
+    # Calculate gap percentage
+    gap_summary = {}
+    gender_gap = data['gender_breakdown']
+    male_salary = next((float(g['avg_salary']) for g in gender_gap if g['gender'] == 'Male'), None)
+    female_salary = next((float(g['avg_salary']) for g in gender_gap if g['gender'] == 'Female'), None)
+
+    if male_salary and female_salary:
+        gap_summary['gender_gap_percentage'] = round(((male_salary - female_salary) / male_salary) * 100, 1)
+        gap_summary['female_cents_per_dollar'] = round((female_salary / male_salary) * 100, 0)
+
+    data['gap_summary'] = gap_summary
+    return data
+
+
+ANALYTICS_SNAPSHOT = AnalyticsSnapshot()
+
+
+def analytics_headers(version, built_at):
+    return {
+        'X-Analytics-Snapshot-Version': str(version),
+        'X-Analytics-Snapshot-Age': f"{time.time() - built_at:.1f}",
+    }
+
+
+def analytics_response(build_payload):
+    """Serve a dashboard payload from the snapshot with version/age headers."""
+    data, version, built_at = ANALYTICS_SNAPSHOT.get()
+    response = jsonify(build_payload(data))
+    response.headers.update(analytics_headers(version, built_at))
+    return response
+
+
+# =============================================================================
+# WRITE-BEHIND SUBMISSIONS
+# =============================================================================
+
+class WriteBehindFull(Exception):
+    """The write-behind log already holds WRITE_BEHIND_MAX_PENDING rows."""
+
+
+class WriteBehindLog:
+    """
+    Durable queue in front of salary_submissions inserts.
+
+    append() writes the row as a JSON line to this process's current log
+    segment and fsyncs it before returning, so an acknowledged submission
+    survives a crash. A background flusher closes the current segment every
+    `interval` seconds (sooner once `batch_rows` are waiting), inserts it in
+    batches of `batch_rows` through the backend's bulk loader, and deletes
+    it once every row is stored. Failures are retried with exponential
+    backoff. When `max_pending` rows are waiting, append() raises
+    WriteBehindFull so the endpoint can shed load instead of growing the
+    log without bound.
+
+    Each segment carries an exclusive flock held by the process writing it,
+    and a `.ckpt` file with the byte offset of the last stored batch. On
+    startup (and every `recover_interval` seconds) any segment whose lock
+    can be taken belongs to a process that died; it is replayed from its
+    checkpoint. Whenever a segment is replayed or retried, the ids of its
+    first batch are deleted before they are inserted again, in case that
+    batch was stored but not yet checkpointed.
+    """
+
+    def __init__(self, directory, batch_rows=1000, max_pending=100_000, interval=1.0,
+                 fsync=True, recover_interval=30.0):
+        self.directory = directory
+        self.batch_rows = batch_rows
+        self.max_pending = max_pending
+        self.interval = interval
+        self.fsync = fsync
+        self.recover_interval = recover_interval
+        self._lock = threading.Lock()
+        self._drain_lock = threading.Lock()  # one thread drains this process's segments at a time
+        self._wake = threading.Event()
+        self._pid = None
+        self._segment = None  # (path, file) currently appended to
+        self._segment_rows = 0
+        self._closed = []  # this process's full segments, oldest first
+        self._attempted = set()  # closed segments whose drain has been tried
+        self.pending = 0
+        self.flushed = 0
+        self.recovered = 0
+        self.failures = 0
+        self.last_error = None
+
+    def append(self, row):
+        """Durably queue one row (a tuple in SUBMISSION_COLUMNS order)."""
+        line = json.dumps(row) + '\n'
+        with self._lock:
+            self._start()
+            if self.pending >= self.max_pending:
+                raise WriteBehindFull(f"{self.pending} submissions waiting to be written")
+            if self._segment is None:
+                self._segment, self._segment_rows = self._open_segment(), 0
+            f = self._segment[1]
+            f.write(line)
+            f.flush()
+            if self.fsync:
+                os.fsync(f.fileno())
+            self._segment_rows += 1
+            self.pending += 1
+            if self.pending >= self.batch_rows:
+                self._wake.set()
+
+    def stats(self):
+        return {
+            'pending': self.pending,
+            'flushed': self.flushed,
+            'recovered': self.recovered,
+            'failures': self.failures,
+            'last_error': self.last_error,
+        }
+
+    def flush(self):
+        """Store everything this process has queued (used at shutdown)."""
+        with self._lock:
+            if self._pid != os.getpid():
+                return
+            self._rotate()
+        self._flush_closed()
+
+    def recover(self):
+        """Replay segments left behind by processes that exited."""
+        os.makedirs(self.directory, exist_ok=True)
+        with self._lock:
+            own = {path for path, _ in self._closed}
+            if self._segment:
+                own.add(self._segment[0])
+        for name in sorted(os.listdir(self.directory)):
+            path = os.path.join(self.directory, name)
+            if not name.endswith('.log') or path in own:
+                continue
+            try:
+                fd = os.open(path, os.O_RDONLY)
+            except FileNotFoundError:
+                continue
+            try:
+                fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                os.close(fd)  # its writer is alive
+                continue
+            try:
+                if os.fstat(fd).st_nlink:  # not already replayed by another worker
+                    rows = self._drain(path, resume=True, on_batch=submissions_stored)
+                    self.recovered += rows
+                    print(f"Write-behind: recovered {rows} submissions from {name}")
+            finally:
+                os.close(fd)
+
+    def _start(self):
+        # Called with the lock held. Segments, locks and the flusher thread
+        # are per process: none of them survive a fork.
+        if self._pid == os.getpid():
+            return
+        self._pid = os.getpid()
+        self._segment, self._segment_rows, self._closed, self.pending = None, 0, [], 0
+        self._drain_lock, self._attempted = threading.Lock(), set()
+        os.makedirs(self.directory, exist_ok=True)
+        threading.Thread(target=self._run, daemon=True, name='write-behind').start()
+
+    def _open_segment(self):
+        path = os.path.join(self.directory, f"segment-{os.getpid()}-{time.time_ns()}.log")
+        f = open(path, 'a', encoding='utf-8')
+        fcntl.flock(f.fileno(), fcntl.LOCK_EX)
+        if self.fsync:
+            dir_fd = os.open(self.directory, os.O_RDONLY)
+            try:
+                os.fsync(dir_fd)
+            finally:
+                os.close(dir_fd)
+        return path, f
+
+    def _rotate(self):
+        # Called with the lock held
+        if self._segment is not None and self._segment_rows:
+            self._closed.append(self._segment)
+            self._segment = None
+
+    def _run(self):
+        backoff = 1.0
+        last_recover = time.monotonic()
+        while True:
+            self._wake.wait(self.interval)
+            self._wake.clear()
+            with self._lock:
+                self._rotate()
+            try:
+                self._flush_closed()
+                if time.monotonic() - last_recover >= self.recover_interval:
+                    last_recover = time.monotonic()
+                    self.recover()
+                backoff = 1.0
+            except Exception as e:
+                self.failures += 1
+                self.last_error = str(e)
+                print(f"Write-behind flush error (retrying in {backoff:.0f}s): {e}")
+                time.sleep(backoff)
+                backoff = min(backoff * 2, 60.0)
+
+    def _flush_closed(self):
+        # The flusher thread and the shutdown flush() share the head segment
+        with self._drain_lock:
+            while self._closed:
+                path, f = self._closed[0]
+                # A retry after a failed attempt may find its first batch
+                # stored, even when the failure came before the checkpoint
+                resume = path in self._attempted
+                self._attempted.add(path)
+                self._drain(path, resume=resume, on_batch=self._stored)
+                self._attempted.discard(path)
+                with self._lock:
+                    self._closed.pop(0)
+                f.close()
+                ANALYTICS_SNAPSHOT.mark_dirty()
+                SUBMISSIONS_VERSION.mark_dirty()
+
+    def _stored(self, rows):
+        with self._lock:
+            self.pending -= len(rows)
+        self.flushed += len(rows)
+        # The rows are stored: a cache refresh failing must not replay them
+        try:
+            submissions_stored(rows)
+        except Exception as e:
+            print(f"Write-behind: in-process caches not updated: {e}")
+
+    def _drain(self, path, resume, on_batch=None):
+        """Store a segment from its checkpoint onward, then delete it."""
+        checkpoint = path + '.ckpt'
+        offset = 0
+        if os.path.exists(checkpoint):
+            with open(checkpoint) as f:
+                offset = int(f.read() or 0)
+        total = 0
+        backend = get_storage_backend()
+        with open(path, 'rb') as f:
+            f.seek(offset)
+            while True:
+                lines = list(itertools.islice(f, self.batch_rows))
+                if not lines:
+                    break
+                # A line without its newline was cut off by a crash before
+                # the submission was acknowledged
+                rows = [tuple(json.loads(line)) for line in lines if line.endswith(b'\n')]
+                if rows and resume:
+                    execute_query(
+                        f"DELETE FROM salary_submissions WHERE id IN ({', '.join(['%s'] * len(rows))})",
+                        [row[0] for row in rows], fetch=False,
+                    )
+                    resume = False
+                if rows:
+                    backend.bulk_insert('salary_submissions', SUBMISSION_COLUMNS, [rows])
+                total += len(rows)
+                if on_batch:
+                    on_batch(rows)
+                offset += sum(len(line) for line in lines)
+                tmp = checkpoint + '.tmp'
+                with open(tmp, 'w') as ck:
+                    ck.write(str(offset))
+                os.replace(tmp, checkpoint)
+        os.remove(path)
+        if os.path.exists(checkpoint):
+            os.remove(checkpoint)
+        return total
+
+
+WRITE_BEHIND = None
+if os.getenv('WRITE_BEHIND_ENABLED', '0') == '1':
+    WRITE_BEHIND = WriteBehindLog(
+        os.getenv('WRITE_BEHIND_DIR', 'write_behind'),
+        batch_rows=int(os.getenv('WRITE_BEHIND_BATCH_ROWS', 1000)),
+        max_pending=int(os.getenv('WRITE_BEHIND_MAX_PENDING', 100_000)),
+        interval=float(os.getenv('WRITE_BEHIND_INTERVAL', 1.0)),
+        fsync=os.getenv('WRITE_BEHIND_FSYNC', '1') == '1',
+    )
+    atexit.register(WRITE_BEHIND.flush)
+
+
+# =============================================================================
+# STARTUP AND READINESS
+# =============================================================================
+# Importing app.py does not touch the database. Schema creation, migrations
+# and seeding run once per deployment via `flask --app app init-db` (or
+# `python app.py` in development); workers only verify the schema on first
+# use and warm their in-process state in the background.
+
+class SchemaNotReady(Exception):
+    pass
+
+
+# Newest column of each table: selecting it proves the table exists and
+# every migration in init_snowflake_database has been applied
+SCHEMA_PROBES = {
+    'salary_submissions': 'company_name',
+    'negotiation_knowledge': 'embedding_hash',
+    'transparent_companies': 'revision',
+}
+
+
+def missing_schema():
+    """Tables (or migrations) init-db still has to create."""
+    missing = []
+    for table, column in SCHEMA_PROBES.items():
+        try:
+            execute_query(f"SELECT {column} FROM {table} WHERE 1 = 0")
+        except Exception:
+            missing.append(table)
+    return missing
+
+
+class Readiness:
+    """
+    Per-process startup state.
+
+    The first request (or readiness probe) verifies the schema, running
+    init_snowflake_database itself only when DB_AUTO_INIT=1, and then warms
+    up in a background thread: write-behind recovery, the company registry
+    and the in-process indexes. Requests are served as soon as the schema
+    checks out and take the SQL fallbacks until warm-up finishes.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.schema_ok = False
+        self.schema_error = None
+        self.schema_checked_at = 0.0
+        self.warmup = {}  # step -> 'pending' | 'ok' | error message
+        self.warmup_done = False
+        self.started_at = time.time()
+
+    def ensure_schema(self):
+        """Raise SchemaNotReady until the schema has been verified."""
+        if self.schema_ok:
+            return
+        with self._lock:
+            if self.schema_ok:
+                return
+            retry_after = float(os.getenv('SCHEMA_RETRY_INTERVAL', 5))
+            if self.schema_error and time.time() - self.schema_checked_at < retry_after:
+                raise SchemaNotReady(self.schema_error)
+            self.schema_checked_at = time.time()
+            try:
+                missing = missing_schema()
+                if missing and os.getenv('DB_AUTO_INIT', '0') == '1':
+                    init_snowflake_database()
+                    missing = missing_schema()
+                if missing:
+                    raise SchemaNotReady(f"Missing tables: {', '.join(missing)}. Run `flask --app app init-db`")
+            except SchemaNotReady as e:
+                self.schema_error = str(e)
+                raise
+            except Exception as e:
+                self.schema_error = f"Schema check failed: {e}"
+                raise SchemaNotReady(self.schema_error) from e
+            self.schema_ok, self.schema_error = True, None
+            self._start_warmup()
+
+    def _start_warmup(self):
+        steps = []
+        if WRITE_BEHIND is not None:
+            steps.append(('write_behind_recovery', WRITE_BEHIND.recover))
+        steps.append(('company_registry', lambda: print(f"Company registry loaded ({COMPANY_REGISTRY.load()} companies)")))
+        if os.getenv('VECTOR_INDEX_ENABLED', '1') == '1':
+            steps.append(('knowledge_index', refresh_knowledge_index))
+        if os.getenv('SALARY_INDEX_ENABLED', '1') == '1':
+            steps.append(('salary_index', refresh_salary_index))
+        if QUANTILE_SKETCHES is not None:
+            steps.append(('quantile_sketches', QUANTILE_SKETCHES.load))
+        if os.getenv('SALARY_TRENDS_ENABLED', '1') == '1':
+            steps.append(('salary_trends', SALARY_TRENDS.ensure_loaded))
+        self.warmup = {name: 'pending' for name, _ in steps}
+        threading.Thread(target=self._warm, args=(steps,), daemon=True, name='warmup').start()
+
+    def _warm(self, steps):
+        start = time.time()
+        for name, step in steps:
+            try:
+                step()
+                self.warmup[name] = 'ok'
+            except Exception as e:
+                print(f"Warm-up error ({name}): {e}")
+                self.warmup[name] = str(e)
+        self.warmup_done = True
+        print(f"Warm-up finished in {time.time() - start:.2f}s")
+
+    def status(self):
+        if not self.schema_ok:
+            state = 'not_ready'
+        elif not self.warmup_done:
+            state = 'warming_up'
+        elif any(v != 'ok' for v in self.warmup.values()):
+            state = 'degraded'
+        else:
+            state = 'ready'
+        return {
+            'status': state,
+            'schema': 'ok' if self.schema_ok else self.schema_error,
+            'warmup': dict(self.warmup),
+            'uptime_seconds': round(time.time() - self.started_at, 1),
+        }
+
+
+READINESS = Readiness()
+
+# Routes that must answer before (or regardless of) the schema check
+READINESS_EXEMPT = {'/', '/api/health', '/api/ready', '/metrics'}
+
+
+@app.before_request
+def require_schema():
+    if request.method == 'OPTIONS' or request.path in READINESS_EXEMPT:
+        return None
+    try:
+        READINESS.ensure_schema()
+    except SchemaNotReady as e:
+        response = jsonify({'error': 'Service not ready', 'detail': str(e)})
+        response.headers['Retry-After'] = os.getenv('SCHEMA_RETRY_INTERVAL', '5')
+        return response, 503
+    return None
+
+
+@app.cli.command('init-db')
+def init_db_command():
+    """Create tables, apply migrations and seed sample data (run once per deployment)."""
+    init_snowflake_database()
+
+
+@app.cli.command('build-sketches')
+def build_sketches_command():
+    """Rebuild the quantile sketches from salary_submissions (compacts QUANTILE_SKETCH_DIR)."""
+    if QUANTILE_SKETCHES is None:
+        print("Quantile sketches are disabled (set QUANTILE_SKETCHES_ENABLED=1)")
+        return
+    QUANTILE_SKETCHES.rebuild()
+
+
+@app.cli.command('build-snapshot')
+def build_snapshot_command():
+    """Export salary_submissions to the columnar snapshot the workers map."""
+    if COLUMNAR_SNAPSHOT is None:
+        print("The columnar snapshot is disabled (set COLUMNAR_SNAPSHOT_ENABLED=1)")
+        return
+    COLUMNAR_SNAPSHOT.rebuild()
+
+# =============================================================================
+# SALARY ROUTES
+# =============================================================================
+
+REQUIRED_SALARY_FIELDS = ['job_title', 'industry', 'years_experience', 'salary', 'location']
+
+
+def validate_submission(data):
+    """
+    Check one salary submission and return its cleaned values as a dict
+    (SUBMISSION_COLUMNS minus id and created_at). Raises ValueError.
+    """
+    if not isinstance(data, dict):
+        raise ValueError('Record must be an object')
+    missing = [k for k in REQUIRED_SALARY_FIELDS if data.get(k) in (None, '')]
+    if missing:
+        raise ValueError(f"Missing required fields: {', '.join(missing)}")
+    try:
+        salary = float(data['salary'])
+        years = int(float(data['years_experience']))
+    except (TypeError, ValueError):
+        raise ValueError('salary and years_experience must be numbers')
+    if not 0 < salary <= 10_000_000:
+        raise ValueError('salary must be between 0 and 10,000,000')
+    if not 0 <= years <= 70:
+        raise ValueError('years_experience must be between 0 and 70')
+
+    def text(field, limit):
+        value = data.get(field)
+        if value in (None, ''):
+            return None
+        value = str(value).strip()
+        if len(value) > limit:
+            raise ValueError(f'{field} is longer than {limit} characters')
+        return value
+
+    return {
+        'job_title': text('job_title', 255),
+        'industry': text('industry', 100),
+        'years_experience': years,
+        'salary': salary,
+        'location': text('location', 255),
+        'gender': text('gender', 50),
+        'ethnicity': text('ethnicity', 100),
+        'education_level': text('education_level', 50),
+        'company_size': text('company_size', 50),
+        'company_name': text('company_name', 255),
+        'remote_status': text('remote_status', 50),
+    }
+
+
+def open_upload():
+    """
+    The request payload as (text stream, kind), where kind is 'csv',
+    'ndjson' or 'json'. Reads a multipart `file` field (format from the
+    file name) or the raw body (format from Content-Type), and undoes
+    Content-Encoding: gzip. Nothing is read until the stream is consumed.
+    """
+    upload = request.files.get('file')
+    if upload is not None:
+        raw = upload.stream
+        name = (upload.filename or '').lower()
+        if name.endswith('.gz'):
+            raw, name = gzip.GzipFile(fileobj=raw), name[:-3]
+        kind = 'csv' if name.endswith('.csv') else 'ndjson' if name.endswith(('.ndjson', '.jsonl')) else 'json'
+    else:
+        raw = request.stream
+        if request.content_encoding == 'gzip':
+            raw = gzip.GzipFile(fileobj=raw)
+        kind = {'text/csv': 'csv', 'application/x-ndjson': 'ndjson',
+                'application/jsonl': 'ndjson'}.get(request.mimetype, 'json')
+    return io.TextIOWrapper(raw, encoding='utf-8-sig'), kind
+
+
+def iter_upload_records(stream, kind):
+    """
+    Yield (row, record or ValueError) from an upload, one line at a time
+    for CSV and NDJSON, so a malformed record is reported for its row and
+    reading continues. A JSON body is a list (or {"records": [...]}) and is
+    parsed whole.
+    """
+    if kind == 'csv':
+        reader = csv.DictReader(stream)
+        row = 0
+        while True:
+            try:
+                record = next(reader)
+            except StopIteration:
+                break
+            except csv.Error as e:
+                record = ValueError(f'Invalid CSV: {e}')
+            yield row, record
+            row += 1
+    elif kind == 'ndjson':
+        row = 0
+        for line in stream:
+            if not line.strip():
+                continue
+            try:
+                yield row, json.loads(line)
+            except ValueError as e:
+                yield row, ValueError(f'Invalid JSON: {e}')
+            row += 1
+    else:
+        data = json.load(stream)
+        records = data.get('records') if isinstance(data, dict) else data
+        if not isinstance(records, list):
+            raise ValueError('Expected a JSON list of records or {"records": [...]}')
+        yield from enumerate(records)
+
+
+@app.route('/api/salary/submit', methods=['POST'])
+def submit_salary():
+    """Submit anonymous salary data to Snowflake."""
+    try:
+        values = validate_submission(request.json)
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+
+    salary_id = secrets.token_hex(16)
+
+    if WRITE_BEHIND is not None:
+        # Acknowledge once the row is in the local log; the flusher stores it
+        try:
+            WRITE_BEHIND.append((
+                salary_id, *values.values(), datetime.now(timezone.utc).strftime('%Y-%m-%d %H:%M:%S')
+            ))
+        except WriteBehindFull as e:
+            return jsonify({'error': 'Too many submissions waiting to be saved, please retry shortly',
+                            'detail': str(e)}), 503, {'Retry-After': '5'}
+        except OSError as e:
+            return jsonify({'error': str(e)}), 500
+        if SALARY_INDEX.ready:
+            SALARY_INDEX.add(values['industry'], values['years_experience'], values['salary'])
+        return jsonify({'message': 'Salary data submitted successfully', 'id': salary_id}), 201
+
+    try:
+        execute_query("""
+            INSERT INTO salary_submissions
+            (id, job_title, industry, years_experience, salary, location, gender, ethnicity, education_level, company_size, company_name, remote_status, created_at)
+            VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, CURRENT_TIMESTAMP())
+        """, [salary_id, *values.values()], fetch=False)
+
+        if SALARY_INDEX.ready:
+            SALARY_INDEX.add(values['industry'], values['years_experience'], values['salary'])
+        ANALYTICS_SNAPSHOT.mark_dirty()
+        SUBMISSIONS_VERSION.mark_dirty()
+        submissions_stored([(salary_id, *values.values(), None)])
+
+        return jsonify({'message': 'Salary data submitted successfully', 'id': salary_id}), 201
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+
+@app.route('/api/salary/bulk', methods=['POST'])
+def bulk_ingest_salaries():
+    """
+    Import many submissions from a streamed CSV or NDJSON upload (a JSON
+    list also works but is parsed whole).
+
+    Rows are validated as they are read and written in micro-batches of
+    INGEST_BATCH_ROWS through the backend's bulk loader (multi-row INSERTs,
+    or staged COPY INTO on Snowflake), so memory stays flat whatever the
+    file size. Invalid rows are skipped and reported; the first
+    INGEST_MAX_ERRORS errors are listed individually.
+    """
+    batch_rows = int(os.getenv('INGEST_BATCH_ROWS', 5000))
+    max_errors = int(os.getenv('INGEST_MAX_ERRORS', 100))
+    report = {'inserted': 0, 'rejected': 0, 'batches': 0, 'errors': []}
+    cohorts = set()  # (industry, location) pairs touched, for cache invalidation
+    sketches = CohortSketches(QUANTILE_SKETCHES.k) if QUANTILE_SKETCHES is not None else None
+    created_at = datetime.now(timezone.utc).strftime('%Y-%m-%d %H:%M:%S')
+
+    def micro_batches(records):
+        batch = []
+        for row, record in records:
+            try:
+                if isinstance(record, Exception):
+                    raise record
+                values = validate_submission(record)
+            except ValueError as e:
+                report['rejected'] += 1
+                if len(report['errors']) < max_errors:
+                    report['errors'].append({'row': row, 'error': str(e)})
+                continue
+            batch.append((secrets.token_hex(16), *values.values(), created_at))
+            cohorts.add((values['industry'], values['location']))
+            if len(batch) >= batch_rows:
+                report['batches'] += 1
+                if sketches is not None:
+                    sketches.add_rows(sketch_rows(batch))
+                yield batch
+                batch = []
+        if batch:
+            report['batches'] += 1
+            if sketches is not None:
+                sketches.add_rows(sketch_rows(batch))
+            yield batch
+
+    started = time.perf_counter()
+    try:
+        stream, kind = open_upload()
+        report['inserted'] = get_storage_backend().bulk_insert(
+            'salary_submissions', SUBMISSION_COLUMNS, micro_batches(iter_upload_records(stream, kind))
+        )
+    except (ValueError, UnicodeDecodeError, csv.Error, OSError) as e:
+        return jsonify({'error': f'Could not read upload: {e}', **report}), 400
+    except Exception as e:
+        return jsonify({'error': str(e), **report}), 500
+    seconds = time.perf_counter() - started
+
+    if report['inserted']:
+        if SALARY_INDEX.ready:
+            refresh_salary_index()
+        if SALARY_TRENDS.ready:
+            SALARY_TRENDS.load()
+        ANALYTICS_SNAPSHOT.mark_dirty()
+        SUBMISSIONS_VERSION.mark_dirty()
+        invalidate_market_data(cohorts)
+        if sketches is not None:
+            QUANTILE_SKETCHES.add_sketches(sketches)
+
+    return jsonify({
+        **report,
+        'errors_truncated': report['rejected'] > len(report['errors']),
+        'seconds': round(seconds, 3),
+        'rows_per_second': round(report['inserted'] / seconds) if seconds > 0 else None,
+    }), 201 if report['inserted'] else 200
+
+
+def build_comparison(user_salary, stat, rank, company_data):
+    """
+    The /api/salary/compare payload for one salary, from its cohort stats,
+    its percentile rank in the cohort (unused when company data is given)
+    and the matched company record, if any.
+    """
+    market_median = float(stat['median_salary'])
+    market_avg = float(stat['avg_salary'])
+    market_p25 = float(stat['p25_salary'])
+    market_p75 = float(stat['p75_salary'])
+    market_p90 = float(stat['p90_salary'])
+
+    # Apply company-specific adjustments if we have company data
+    if company_data:
+        multiplier = company_data['multiplier']
+        # Adjust expected salaries for this company
+        company_median = market_median * multiplier
+        company_avg = market_avg * multiplier
+        company_p25 = market_p25 * multiplier
+        company_p75 = market_p75 * multiplier
+        company_p90 = market_p90 * multiplier
+
+        # Calculate percentile within company context
+        # User's salary compared to what this company typically pays
+        if user_salary >= company_p90:
+            company_percentile = 90 + (10 * (user_salary - company_p90) / (company_p90 * 0.2)) if company_p90 > 0 else 95
+            company_percentile = min(99, company_percentile)
+        elif user_salary >= company_p75:
+            company_percentile = 75 + (15 * (user_salary - company_p75) / (company_p90 - company_p75)) if (company_p90 - company_p75) > 0 else 82
+        elif user_salary >= company_median:
+            company_percentile = 50 + (25 * (user_salary - company_median) / (company_p75 - company_median)) if (company_p75 - company_median) > 0 else 62
+        elif user_salary >= company_p25:
+            company_percentile = 25 + (25 * (user_salary - company_p25) / (company_median - company_p25)) if (company_median - company_p25) > 0 else 37
+        else:
+            company_percentile = max(1, 25 * user_salary / company_p25) if company_p25 > 0 else 10
+
+        gap_percentage = ((user_salary - company_median) / company_median) * 100 if company_median > 0 else 0
+
+        # Use company-adjusted values for display
+        median = company_median
+        avg = company_avg
+        p25 = company_p25
+        p75 = company_p75
+        p90 = company_p90
+        percentile = company_percentile
+    else:
+        # No company data, use market rates
+        median = market_median
+        avg = market_avg
+        p25 = market_p25
+        p75 = market_p75
+        p90 = market_p90
+
+        # Calculate percentile rank against market
+        percentile = rank or 50
+        gap_percentage = ((user_salary - median) / median) * 100 if median > 0 else 0
+
+    # Generate recommendation based on company context
+    context_label = f"at {company_data['name']}" if company_data else "in the market"
+
+    if percentile < 25:
+        recommendation = {
+            'status': 'below_market',
+            'message': f'Your salary is significantly below typical pay {context_label}. You may have strong grounds for negotiation.',
+            'action': 'Consider requesting a salary review with documented market data.',
+            'potential_increase': f"${abs(int(median - user_salary)):,} to reach median"
+        }
+    elif percentile < 50:
+        recommendation = {
+            'status': 'below_median',
+            'message': f'Your salary is below the median {context_label} for your role and experience.',
+            'action': 'Document your achievements and consider discussing compensation.',
+            'potential_increase': f"${abs(int(median - user_salary)):,} potential increase"
+        }
+    elif percentile < 75:
+        recommendation = {
+            'status': 'competitive',
+            'message': f'Your salary is competitive and above median {context_label}.',
+            'action': 'Focus on maintaining performance and exploring growth opportunities.',
+            'potential_increase': None
+        }
+    else:
+        recommendation = {
+            'status': 'above_market',
+            'message': f'Your salary is in the top quartile {context_label}.',
+            'action': 'Continue excelling and consider mentoring others.',
+            'potential_increase': None
+        }
+
+    response = {
+        'comparison': {
+            'your_salary': user_salary,
+            'median_salary': round(median, 0),
+            'average_salary': round(avg, 0),
+            'percentile_rank': round(percentile, 1),
+            'gap_percentage': round(gap_percentage, 1),
+            'p25_salary': round(p25, 0),
+            'p75_salary': round(p75, 0),
+            'p90_salary': round(p90, 0),
+            'sample_size': stat['sample_size'],
+            'recommendation': recommendation
+        }
+    }
+
+    # Add company-specific insights if available
+    if company_data:
+        response['comparison']['company_insights'] = {
+            'company_name': company_data['name'],
+            'pay_tier': company_data['tier'],
+            'market_position': f"{int((company_data['multiplier'] - 1) * 100):+d}% vs market average",
+            'typical_range': f"${int(p25):,} - ${int(p90):,}",
+            'note': f"{company_data['name']} typically pays {'above' if company_data['multiplier'] > 1.15 else 'at or near'} market rates"
+        }
+        # Also include raw market data for reference
+        response['comparison']['market_reference'] = {
+            'market_median': round(market_median, 0),
+            'market_p25': round(market_p25, 0),
+            'market_p75': round(market_p75, 0),
+            'market_p90': round(market_p90, 0)
+        }
+
+    return response
+
+
+def parse_compare_record(data):
+    """
+    Validate one compare request. Returns (user_salary, experience,
+    company_data) or raises ValueError.
+    """
+    if not all(k in data for k in REQUIRED_SALARY_FIELDS):
+        raise ValueError('Missing required fields')
+    try:
+        user_salary = float(data['salary'])
+        experience = int(data['years_experience'])
+    except (TypeError, ValueError):
+        raise ValueError('salary and years_experience must be numbers')
+    company_name = (data.get('company_name') or '').strip()
+
+    # Get company-specific data if available
+    company_data = get_company_data(company_name) if company_name else None
+    return user_salary, experience, company_data
+
+
+@app.route('/api/salary/compare', methods=['POST'])
+def compare_salary():
+    """Compare salary using Snowflake analytics (MEDIAN, PERCENTILE_CONT)."""
+    data = request.json
+    try:
+        user_salary, experience, company_data = parse_compare_record(data)
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+
+    try:
+        stat, rank = fetch_comparison_inputs(str(data['industry']).strip(), experience, user_salary, company_data)
+        if stat['sample_size'] == 0:
+            return jsonify({'error': 'Insufficient data', 'sample_size': 0}), 404
+
+        return jsonify(build_comparison(user_salary, stat, rank, company_data))
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+
+def fetch_comparison_inputs(industry, experience, user_salary, company_data):
+    """Cohort stats and (without company data) percentile rank for a compare request."""
+    # The two are independent queries; the in-memory index answers both in
+    # microseconds, so only fan out when they go to the database.
+    plan = QueryPlan(parallel=not SALARY_INDEX.ready)
+    plan.add('stats', get_cohort_stats, industry, experience)
+    if not company_data:
+        plan.add('rank', get_percentile_rank, user_salary, industry, experience)
+    results = plan.run()
+    return results['stats'], results.get('rank')
+
+
+@app.route('/api/salary/compare/batch', methods=['POST'])
+def compare_salary_batch():
+    """
+    Run /api/salary/compare for many employee records in one request.
+
+    Each distinct (industry, years_experience) cohort is aggregated once and
+    percentile ranks for every salary in it are found with one vectorized
+    binary search. Results keep input order: {"row": i, "comparison": ...}
+    or {"row": i, "error": ...}; a record that cannot be parsed is an error
+    for its row. Batches over BATCH_COMPARE_STREAM_ROWS rows (or requests
+    sent with Accept: application/x-ndjson) are streamed back as NDJSON,
+    one result per line.
+    """
+    max_rows = int(os.getenv('BATCH_COMPARE_MAX_ROWS', 50000))
+    parsed = []  # (row, cohort key, salary, company_data) or (row, error)
+    cohorts = {}
+    try:
+        stream, kind = open_upload()
+        # Records are parsed as they are read; only the compact parsed tuples are kept
+        for row, data in iter_upload_records(stream, kind):
+            if row >= max_rows:
+                return jsonify({'error': f'Batch too large (more than {max_rows} rows)'}), 413
+            try:
+                if isinstance(data, Exception):
+                    raise data
+                if not isinstance(data, dict):
+                    raise ValueError('Record must be an object')
+                user_salary, experience, company_data = parse_compare_record(data)
+            except ValueError as e:
+                parsed.append((row, str(e)))
+                continue
+            key = (str(data['industry']).strip().lower(), experience)
+            cohort = cohorts.setdefault(key, {'industry': str(data['industry']).strip(), 'rows': [], 'needs_rank': False})
+            cohort['rows'].append(len(parsed))
+            cohort['needs_rank'] |= not company_data
+            parsed.append((row, key, user_salary, company_data))
+    except (ValueError, UnicodeDecodeError, csv.Error, OSError) as e:
+        return jsonify({'error': f'Could not parse batch: {e}'}), 400
+
+    try:
+        plan = QueryPlan(parallel=not SALARY_INDEX.ready)
+        for key, cohort in cohorts.items():
+            plan.add(('stats', key), get_cohort_stats, cohort['industry'], key[1])
+            if cohort['needs_rank']:
+                plan.add(('salaries', key), get_cohort_salaries, cohort['industry'], key[1])
+        cohort_data = plan.run()
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+    ranks = {}
+    for key, cohort in cohorts.items():
+        cohort_salaries = cohort_data.get(('salaries', key))
+        if cohort_salaries is None or not len(cohort_salaries):
+            continue
+        salaries = np.array([parsed[i][2] for i in cohort['rows']])
+        below = np.searchsorted(cohort_salaries, salaries, side='left')
+        ranks.update(zip(cohort['rows'], (below * 100.0 / len(cohort_salaries)).tolist()))
+
+    def result(index):
+        entry = parsed[index]
+        if len(entry) == 2:
+            return {'row': entry[0], 'error': entry[1]}
+        row, key, user_salary, company_data = entry
+        stat = cohort_data[('stats', key)]
+        if stat['sample_size'] == 0:
+            return {'row': row, 'error': 'Insufficient data', 'sample_size': 0}
+        comparison = build_comparison(user_salary, stat, ranks.get(index), company_data)['comparison']
+        return {'row': row, 'comparison': comparison}
+
+    stream_rows = int(os.getenv('BATCH_COMPARE_STREAM_ROWS', 1000))
+    if len(parsed) > stream_rows or request.accept_mimetypes.best == 'application/x-ndjson':
+        def generate():
+            for index in range(len(parsed)):
+                yield json.dumps(result(index), default=float) + '\n'
+        return Response(generate(), mimetype='application/x-ndjson')
+
+    results = [result(index) for index in range(len(parsed))]
+    return jsonify({
+        'results': results,
+        'summary': {
+            'rows': len(results),
+            'compared': sum('comparison' in r for r in results),
+            'errors': sum('error' in r for r in results),
+            'cohorts': len(cohorts),
+        }
+    })
+
+# =============================================================================
+# ADJUSTED PAY GAP
+# =============================================================================
+# The raw gaps on /api/analytics/pay-gap mix in where people work and how
+# experienced they are. The adjusted gap regresses log(salary) on
+# experience, industry, location, education and company size plus one dummy
+# per gender (or ethnicity) group, for everyone, each industry and each
+# company, and splits every group's raw gap Oaxaca-Blinder style: the
+# controls' share is the difference in mean characteristics times the pooled
+# coefficients, the unexplained rest is the group dummy's coefficient.
+#
+# The normal equations of every scope are accumulated in one pass with
+# bincount and solved as one batched pseudo-inverse, in a process pool so the
+# number crunching never holds the GIL of a worker serving requests. Results
+# are cached per data version and recomputed in the background.
+
+PAY_GAP_CONTROLS = ('experience', 'industry', 'location', 'education_level', 'company_size')
+# Reference group of each dimension; None picks the largest group
+PAY_GAP_DIMENSIONS = {'gender': 'Male', 'ethnicity': None}
+PAY_GAP_SCOPES = ('overall', 'industry', 'company')
+
+
+def encode_levels(column, min_count=1, other='Other', missing='Unknown'):
+    """
+    Sorted level names and codes for a DictionaryColumn. Missing values
+    become `missing` and levels seen fewer than min_count times share the
+    `other` level. Returns (codes, level names).
+    """
+    names = [missing if v is None or v == '' else str(v) for v in column.levels]
+    counts = np.bincount(column.codes, minlength=len(names))
+    names = [other if count < min_count else name for name, count in zip(names, counts)]
+    levels = sorted(set(names))
+    position = {name: i for i, name in enumerate(levels)}
+    remap = np.array([position[name] for name in names], dtype=np.int32)
+    return remap[column.codes], levels
+
+
+def fit_pay_gap_models(scope, n_scopes, y, terms, group, n_groups):
+    """
+    Oaxaca-Blinder decomposition of every scope's pay gaps, batched.
+
+    Rows belong to scope[i] (0..n_scopes-1) and group[i], where group 0 is
+    the reference. y is log salary; terms are the controls as
+    (codes, values, width): categorical terms have codes and width levels,
+    continuous terms have values and width 1. Runs in the pay gap process
+    pool, so it takes and returns plain arrays.
+    """
+    dummies = n_groups - 1
+    # Column layout: intercept, controls, one dummy per non-reference group
+    terms = [(None, None, 1), *terms,
+             (np.maximum(group - 1, 0), (group > 0).astype(np.float64), dummies)]
+    offsets = np.cumsum([0] + [width for _, _, width in terms])
+    p = offsets[-1]
+
+    xtx = np.zeros((n_scopes, p, p))
+    xty = np.zeros((n_scopes, p))
+    for a, (codes_a, values_a, width_a) in enumerate(terms):
+        index_a = scope * width_a + (codes_a if codes_a is not None else 0)
+        cols_a = slice(offsets[a], offsets[a + 1])
+        xty[:, cols_a] = np.bincount(index_a, weights=y if values_a is None else values_a * y,
+                                     minlength=n_scopes * width_a).reshape(n_scopes, width_a)
+        for b in range(a, len(terms)):
+            codes_b, values_b, width_b = terms[b]
+            cols_b = slice(offsets[b], offsets[b + 1])
+            if values_a is None and values_b is None:
+                weights = None
+            elif values_b is None:
+                weights = values_a
+            elif values_a is None:
+                weights = values_b
+            else:
+                weights = values_a * values_b
+            if a == b and codes_a is not None:
+                # One-hot columns of the same term are orthogonal
+                diagonal = np.bincount(index_a, weights=weights, minlength=n_scopes * width_a)
+                block = np.zeros((n_scopes, width_a, width_a))
+                block[:, np.arange(width_a), np.arange(width_a)] = diagonal.reshape(n_scopes, width_a)
+            else:
+                index = index_a * width_b + (codes_b if codes_b is not None else 0)
+                block = np.bincount(index, weights=weights,
+                                    minlength=n_scopes * width_a * width_b).reshape(n_scopes, width_a, width_b)
+            xtx[:, cols_a, cols_b] = block
+            xtx[:, cols_b, cols_a] = block.transpose(0, 2, 1)
+    yty = np.bincount(scope, weights=y * y, minlength=n_scopes)
+
+    # One-hot blocks are collinear with the intercept; the pseudo-inverse
+    # picks the minimum-norm solution, which leaves fitted values and the
+    # group coefficients unchanged.
+    inverse = np.linalg.pinv(xtx, rcond=1e-10, hermitian=True)
+    beta = np.einsum('spq,sq->sp', inverse, xty)
+    eigenvalues = np.linalg.eigvalsh(xtx)
+    rank = (eigenvalues > eigenvalues[:, -1:] * 1e-10).sum(axis=1)
+
+    n = xtx[:, 0, 0]
+    residual_dof = np.maximum(n - rank, 1)
+    sigma2 = np.maximum(yty - np.einsum('sp,sp->s', beta, xty), 0) / residual_dof
+
+    dummy_cols = np.arange(offsets[-2], offsets[-1])
+    n_group = xtx[:, dummy_cols, dummy_cols]
+    n_reference = n - n_group.sum(axis=1)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        mean_x_group = xtx[:, dummy_cols, :] / n_group[:, :, None]
+        mean_x_reference = (xtx[:, 0, :] - xtx[:, dummy_cols, :].sum(axis=1)) / n_reference[:, None]
+        mean_y_group = xty[:, dummy_cols] / n_group
+        mean_y_reference = (xty[:, 0] - xty[:, dummy_cols].sum(axis=1)) / n_reference
+    contributions = (mean_x_reference[:, None, :] - mean_x_group) * beta[:, None, :]
+    return {
+        'n_group': n_group,
+        'n_reference': n_reference,
+        'raw_gap': mean_y_reference[:, None] - mean_y_group,
+        'unexplained': -beta[:, dummy_cols],
+        'standard_error': np.sqrt(sigma2[:, None] * inverse[:, dummy_cols, dummy_cols]),
+        # Per control term (intercept and dummies excluded), in log points
+        'explained': np.stack([contributions[:, :, offsets[t]:offsets[t + 1]].sum(axis=2)
+                               for t in range(1, len(terms) - 1)], axis=2),
+    }
+
+
+_pay_gap_executors = {}
+_pay_gap_executors_lock = threading.Lock()
+
+
+def get_pay_gap_executor():
+    """
+    Process pool for the pay gap fits, one per worker process. Children are
+    spawned rather than forked so they never inherit pooled connections or
+    held locks. None when PAY_GAP_WORKERS=0 (fit in the calling thread).
+    """
+    pid = os.getpid()
+    executor = _pay_gap_executors.get(pid)
+    if executor is None:
+        workers = int(os.getenv('PAY_GAP_WORKERS', 2))
+        if workers <= 0:
+            return None
+        with _pay_gap_executors_lock:
+            executor = _pay_gap_executors.get(pid)
+            if executor is None:
+                executor = ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context('spawn'))
+                _pay_gap_executors[pid] = executor
+    return executor
+
+
+def pay_gap_comparisons(fit, scope_index, groups, min_rows):
+    """Payload entries for one scope's groups with enough rows on both sides."""
+    comparisons = []
+    for j, name in enumerate(groups[1:]):
+        n_group, n_reference = fit['n_group'][scope_index, j], fit['n_reference'][scope_index]
+        if n_group < min_rows or n_reference < min_rows:
+            continue
+        raw = fit['raw_gap'][scope_index, j]
+        unexplained = fit['unexplained'][scope_index, j]
+        margin = 1.96 * fit['standard_error'][scope_index, j]
+        comparisons.append({
+            'group': name,
+            'sample_size': int(n_group),
+            'reference_sample_size': int(n_reference),
+            'raw_gap_percent': round((1 - math.exp(-raw)) * 100, 1),
+            'adjusted_gap_percent': round((1 - math.exp(-unexplained)) * 100, 1),
+            'adjusted_gap_ci95_percent': [round((1 - math.exp(-(unexplained - margin))) * 100, 1),
+                                          round((1 - math.exp(-(unexplained + margin))) * 100, 1)],
+            'explained_share': round(float((raw - unexplained) / raw), 3) if abs(raw) > 1e-9 else None,
+            'explained_log_points': {
+                control: round(float(value) * 100, 2)
+                for control, value in zip(PAY_GAP_CONTROLS, fit['explained'][scope_index, j])
+            },
+        })
+    return comparisons
+
+
+def build_adjusted_pay_gap(version=None):
+    """Fit every dimension and scope over salary_submissions; returns the payload."""
+    fields = ('salary', 'years_experience', 'industry', 'location', 'education_level', 'company_size',
+              'company_name', 'gender', 'ethnicity')
+    columns = submission_columns(fields, version)
+    keep = np.flatnonzero(columns['salary'] > 0)
+    columns = {name: column.take(keep) if isinstance(column, DictionaryColumn) else column[keep]
+               for name, column in columns.items()}
+    n = len(keep)
+    min_rows = int(os.getenv('PAY_GAP_MIN_GROUP_ROWS', 10))
+    min_scope_rows = int(os.getenv('PAY_GAP_MIN_SCOPE_ROWS', 30))
+    min_level_rows = int(os.getenv('PAY_GAP_MIN_LEVEL_ROWS', 20))
+
+    y = np.log(columns['salary'])
+    # Experience as a quadratic, in decades to keep the normal equations
+    # well conditioned
+    decades = columns['years_experience'] / 10
+    industry, industries = encode_levels(columns['industry'])
+    terms = [
+        (None, decades, 1),
+        (None, decades * decades, 1),
+        (industry, None, len(industries)),
+    ]
+    for name in PAY_GAP_CONTROLS[2:]:
+        codes, levels = encode_levels(columns[name], min_count=min_level_rows)
+        terms.append((codes, None, len(levels)))
+    # Terms per control: experience is linear + quadratic
+    term_sizes = (2, 1, 1, 1, 1)
+
+    company = columns['company_name']
+    company_codes, companies = encode_levels(
+        DictionaryColumn(company.codes, [(name or '').strip() for name in company.levels]), missing='')
+    company_counts = np.bincount(company_codes, minlength=len(companies))
+    companies = np.array(companies, dtype=object)
+    keep_company = (company_counts >= min_scope_rows) & (companies != '')
+    company_scope = np.cumsum(keep_company) - 1
+    scopes = {
+        'overall': (np.zeros(n, dtype=np.int64), np.ones(n, dtype=bool), ['All']),
+        'industry': (industry.astype(np.int64), np.ones(n, dtype=bool), industries),
+        'company': (company_scope[company_codes].astype(np.int64), keep_company[company_codes],
+                    [str(name) for name in companies[keep_company]]),
+    }
 
-        response = {
-            'comparison': {
-                'your_salary': user_salary,
-                'median_salary': round(median, 0),
-                'average_salary': round(avg, 0),
-                'percentile_rank': round(percentile, 1),
-                'gap_percentage': round(gap_percentage, 1),
-                'p25_salary': round(p25, 0),
-                'p75_salary': round(p75, 0),
-                'p90_salary': round(p90, 0),
-                'sample_size': stat['sample_size'],
-                'recommendation': recommendation
-            }
+    tasks, results = {}, {}
+    executor = get_pay_gap_executor()
+    for dimension, reference in PAY_GAP_DIMENSIONS.items():
+        codes, names = encode_levels(columns[dimension], missing='')
+        counts = np.bincount(codes, minlength=len(names))
+        sizes = {name: int(count) for name, count in zip(names, counts) if name and count >= min_rows}
+        if reference is None and sizes:
+            reference = max(sizes, key=sizes.get)
+        if reference not in sizes or len(sizes) < 2:
+            continue
+        groups = [reference] + [name for name in sizes if name != reference]
+        results[dimension] = {'reference': reference, 'overall': [], 'industry': {}, 'company': {}}
+        lookup = {name: i for i, name in enumerate(groups)}
+        group = np.array([lookup.get(name, -1) for name in names], dtype=np.int64)[codes]
+        for kind, (scope, in_scope, scope_names) in scopes.items():
+            mask = in_scope & (group >= 0)
+            if not scope_names or not mask.any():
+                continue
+            args = (
+                scope[mask], len(scope_names), y[mask],
+                [(codes[mask] if codes is not None else None, values[mask] if values is not None else None, width)
+                 for codes, values, width in terms],
+                group[mask], len(groups),
+            )
+            future = executor.submit(fit_pay_gap_models, *args) if executor is not None else None
+            tasks[(dimension, kind)] = (future, args, groups, scope_names)
+
+    for (dimension, kind), (future, args, groups, scope_names) in tasks.items():
+        try:
+            fit = future.result() if future is not None else fit_pay_gap_models(*args)
+        except BrokenProcessPool:
+            # A child died (OOM kill); start a fresh pool next time
+            with _pay_gap_executors_lock:
+                _pay_gap_executors.pop(os.getpid(), None)
+            raise
+        # Fold the two experience columns back into one control
+        explained = fit['explained']
+        bounds = np.cumsum((0,) + term_sizes)
+        fit['explained'] = np.stack([explained[:, :, bounds[i]:bounds[i + 1]].sum(axis=2)
+                                     for i in range(len(term_sizes))], axis=2)
+        entries = {}
+        for s, scope_name in enumerate(scope_names):
+            comparisons = pay_gap_comparisons(fit, s, groups, min_rows)
+            if comparisons:
+                entries[scope_name] = comparisons
+        results[dimension][kind] = entries.get('All', []) if kind == 'overall' else entries
+    return {'controls': list(PAY_GAP_CONTROLS), 'sample_size': n, 'dimensions': results}
+
+
+class AdjustedPayGap:
+    """
+    Cached adjusted pay gap results. Reads never wait for a fit: when the
+    data version (SUBMISSIONS_VERSION) moves past the cached result, a
+    background refit is scheduled and the previous result is served until
+    it lands.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.result = None
+        self.version = None
+        self.computed_at = None
+        self.error = None
+        self._computing = False
+
+    def data_version(self):
+        return SUBMISSIONS_VERSION.current()
+
+    def get(self):
+        """Return (result or None, version, computed_at, current)."""
+        version = self.data_version()
+        if version != self.version:
+            self._schedule(version)
+        return self.result, self.version, self.computed_at, version == self.version
+
+    def compute(self, version=None):
+        """Fit synchronously and store the result under `version`."""
+        version = version or self.data_version()
+        started = time.perf_counter()
+        result = build_adjusted_pay_gap(version)
+        with self._lock:
+            self.result, self.version, self.computed_at, self.error = result, version, time.time(), None
+        print(f"Adjusted pay gap computed ({result['sample_size']} records, {time.perf_counter() - started:.2f}s)")
+        return result
+
+    def _schedule(self, version):
+        with self._lock:
+            if self._computing:
+                return
+            self._computing = True
+
+        def compute():
+            try:
+                self.compute(version)
+            except Exception as e:
+                print(f"Adjusted pay gap error: {e}")
+                self.error = str(e)
+            finally:
+                self._computing = False
+
+        threading.Thread(target=compute, daemon=True).start()
+
+    def stats(self):
+        return {
+            'version': self.version,
+            'age_seconds': round(time.time() - self.computed_at, 1) if self.computed_at else None,
+            'computing': self._computing,
+            'error': self.error,
         }
 
-        # Add company-specific insights if available
-        if company_data:
-            response['comparison']['company_insights'] = {
-                'company_name': company_data['name'],
-                'pay_tier': company_data['tier'],
-                'market_position': f"{int((company_data['multiplier'] - 1) * 100):+d}% vs market average",
-                'typical_range': f"${int(p25):,} - ${int(p90):,}",
-                'note': f"{company_data['name']} typically pays {'above' if company_data['multiplier'] > 1.15 else 'at or near'} market rates"
-            }
-            # Also include raw market data for reference
-            response['comparison']['market_reference'] = {
-                'market_median': round(market_median, 0),
-                'market_p25': round(market_p25, 0),
-                'market_p75': round(market_p75, 0),
-                'market_p90': round(market_p90, 0)
-            }
 
-        return jsonify(response)
-    except Exception as e:
-        return jsonify({'error': str(e)}), 500
+ADJUSTED_PAY_GAP = AdjustedPayGap()
+
 
 # =============================================================================
 # ANALYTICS ROUTES - Showcasing Snowflake Features
 # =============================================================================
 
+def pay_gap_payload(data):
+    return {
+        'gender_breakdown': data['gender_breakdown'],
+        'ethnicity_breakdown': data['ethnicity_breakdown'],
+        'gap_summary': data['gap_summary']
+    }
+
+
+def company_comparison_payload(data, company):
+    if company:
+        # Get company-specific data (case-insensitive substring match)
+        needle = company.lower()
+        comparison = [c for c in data['companies'] if needle in c['company_name'].lower()][:10]
+    else:
+        # Get top companies by submission count
+        comparison = [
+            {k: v for k, v in c.items() if k not in ('min_salary', 'max_salary')}
+            for c in data['companies'] if c['sample_size'] >= 3
+        ][:20]
+    return {'companies': comparison}
+
+
 @app.route('/api/analytics/pay-gap', methods=['GET'])
 def get_pay_gap_analytics():
     """Get pay gap analytics using Snowflake GROUP BY and aggregations."""
     try:
-        # Gender breakdown with Snowflake MEDIAN
-        gender_gap = execute_query("""
-            SELECT
-                gender,
-                COUNT(*) as count,
-                AVG(salary) as avg_salary,
-                MEDIAN(salary) as median_salary
-            FROM salary_submissions
-            WHERE gender IS NOT NULL
-            GROUP BY gender
-            HAVING COUNT(*) >= 5
-            ORDER BY avg_salary DESC
-        """)
-
-        # Calculate gap percentage
-        gap_summary = {}
-        male_salary = next((float(g['avg_salary']) for g in gender_gap if g['gender'] == 'Male'), None)
-        female_salary = next((float(g['avg_salary']) for g in gender_gap if g['gender'] == 'Female'), None)
-
-        if male_salary and female_salary:
-            gap_summary['gender_gap_percentage'] = round(((male_salary - female_salary) / male_salary) * 100, 1)
-            gap_summary['female_cents_per_dollar'] = round((female_salary / male_salary) * 100, 0)
-
-        # Ethnicity breakdown
-        ethnicity_gap = execute_query("""
-            SELECT
-                ethnicity,
-                COUNT(*) as count,
-                AVG(salary) as avg_salary,
-                MEDIAN(salary) as median_salary
-            FROM salary_submissions
-            WHERE ethnicity IS NOT NULL
-            GROUP BY ethnicity
-            HAVING COUNT(*) >= 5
-            ORDER BY avg_salary DESC
-        """)
-
-        return jsonify({
-            'gender_breakdown': gender_gap,
-            'ethnicity_breakdown': ethnicity_gap,
-            'gap_summary': gap_summary
-        })
+        return analytics_response(pay_gap_payload)
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
@@ -875,22 +5506,7 @@ def get_pay_gap_analytics():
 def get_industry_comparison():
     """Compare salaries across industries using Snowflake PERCENTILE_CONT."""
     try:
-        comparison = execute_query("""
-            SELECT
-                industry,
-                COUNT(*) as sample_size,
-                AVG(salary) as avg_salary,
-                MEDIAN(salary) as median_salary,
-                PERCENTILE_CONT(0.25) WITHIN GROUP (ORDER BY salary) as p25,
-                PERCENTILE_CONT(0.75) WITHIN GROUP (ORDER BY salary) as p75,
-                PERCENTILE_CONT(0.90) WITHIN GROUP (ORDER BY salary) as p90
-            FROM salary_submissions
-            GROUP BY industry
-            HAVING COUNT(*) >= 5
-            ORDER BY median_salary DESC
-        """)
-
-        return jsonify({'industries': comparison})
+        return analytics_response(lambda data: {'industries': data['industries']})
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
@@ -898,22 +5514,7 @@ def get_industry_comparison():
 def get_location_comparison():
     """Compare salaries across locations."""
     try:
-        comparison = execute_query("""
-            SELECT
-                location,
-                COUNT(*) as sample_size,
-                AVG(salary) as avg_salary,
-                MEDIAN(salary) as median_salary,
-                MIN(salary) as min_salary,
-                MAX(salary) as max_salary
-            FROM salary_submissions
-            GROUP BY location
-            HAVING COUNT(*) >= 3
-            ORDER BY median_salary DESC
-            LIMIT 20
-        """)
-
-        return jsonify({'locations': comparison})
+        return analytics_response(lambda data: {'locations': data['locations']})
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
@@ -921,73 +5522,162 @@ def get_location_comparison():
 def get_company_comparison():
     """Get salary analytics for specific companies (like Glassdoor)."""
     company = request.args.get('company', '')
+    try:
+        return analytics_response(lambda data: company_comparison_payload(data, company))
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
 
+
+@app.route('/api/analytics/pay-gap/adjusted', methods=['GET'])
+def get_adjusted_pay_gap():
+    """
+    Pay gaps adjusted for experience, industry, location, education and
+    company size (Oaxaca-Blinder decomposition). Query: dimension (gender or
+    ethnicity), by (overall, industry or company) and an optional group name
+    within `by`. Answers 202 while the first fit is still running.
+    """
+    dimension = request.args.get('dimension', 'gender')
+    by = request.args.get('by', 'overall')
+    group = request.args.get('group', '')
+    if dimension not in PAY_GAP_DIMENSIONS or by not in PAY_GAP_SCOPES:
+        return jsonify({'error': f"dimension must be one of {', '.join(PAY_GAP_DIMENSIONS)} "
+                                 f"and by one of {', '.join(PAY_GAP_SCOPES)}"}), 400
     try:
-        if company:
-            # Get company-specific data
-            comparison = execute_query("""
-                SELECT
-                    company_name,
-                    COUNT(*) as sample_size,
-                    AVG(salary) as avg_salary,
-                    MEDIAN(salary) as median_salary,
-                    PERCENTILE_CONT(0.25) WITHIN GROUP (ORDER BY salary) as p25,
-                    PERCENTILE_CONT(0.75) WITHIN GROUP (ORDER BY salary) as p75,
-                    MIN(salary) as min_salary,
-                    MAX(salary) as max_salary
-                FROM salary_submissions
-                WHERE LOWER(company_name) LIKE LOWER(%s)
-                  AND company_name IS NOT NULL
-                  AND company_name != ''
-                GROUP BY company_name
-                HAVING COUNT(*) >= 2
-                ORDER BY sample_size DESC
-                LIMIT 10
-            """, [f'%{company}%'])
-        else:
-            # Get top companies by submission count
-            comparison = execute_query("""
-                SELECT
-                    company_name,
-                    COUNT(*) as sample_size,
-                    AVG(salary) as avg_salary,
-                    MEDIAN(salary) as median_salary,
-                    PERCENTILE_CONT(0.25) WITHIN GROUP (ORDER BY salary) as p25,
-                    PERCENTILE_CONT(0.75) WITHIN GROUP (ORDER BY salary) as p75
-                FROM salary_submissions
-                WHERE company_name IS NOT NULL
-                  AND company_name != ''
-                GROUP BY company_name
-                HAVING COUNT(*) >= 3
-                ORDER BY sample_size DESC
-                LIMIT 20
-            """)
+        result, version, computed_at, current = ADJUSTED_PAY_GAP.get()
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+    if result is None:
+        if ADJUSTED_PAY_GAP.error:
+            return jsonify({'error': ADJUSTED_PAY_GAP.error}), 500
+        return jsonify({'status': 'computing'}), 202, {'Retry-After': '5'}
+
+    entry = result['dimensions'].get(dimension)
+    if entry is None:
+        return jsonify({'error': 'Insufficient data', 'dimension': dimension}), 404
+    gaps = entry[by]
+    if group and by != 'overall':
+        needle = group.lower()
+        gaps = {name: comparisons for name, comparisons in gaps.items() if name.lower() == needle}
+        if not gaps:
+            return jsonify({'error': 'Insufficient data', by: group}), 404
+    response = jsonify({
+        'dimension': dimension,
+        'reference': entry['reference'],
+        'controls': result['controls'],
+        'sample_size': result['sample_size'],
+        'by': by,
+        'gaps': gaps,
+        'current': current,
+    })
+    response.headers.update({
+        'X-Pay-Gap-Version': version,
+        'X-Pay-Gap-Age': f"{time.time() - computed_at:.1f}",
+    })
+    return response
+
 
-        return jsonify({'companies': comparison})
+@app.route('/api/analytics/trends', methods=['GET'])
+def get_salary_trends():
+    """
+    Monthly or weekly submissions, average and median salary and gender gap
+    for the last `periods` buckets ending at `end` (YYYY-MM-DD, default
+    today). Filters: industry, gender, location.
+    """
+    args = request.args
+    granularity = args.get('granularity', 'month')
+    if granularity not in TRENDS_GRANULARITIES:
+        return jsonify({'error': f"granularity must be one of {', '.join(TRENDS_GRANULARITIES)}"}), 400
+    try:
+        periods = int(args.get('periods', 12))
+        if not 1 <= periods <= TRENDS_GRANULARITIES[granularity]:
+            raise ValueError(f"periods must be between 1 and {TRENDS_GRANULARITIES[granularity]}")
+        end = datetime.fromisoformat(args['end']).date() if args.get('end') else datetime.now(timezone.utc).date()
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+
+    filters = {name: args.get(name) or None for name in TRENDS_DIMENSIONS}
+    try:
+        SALARY_TRENDS.ensure_loaded()
+        series, window = SALARY_TRENDS.series(granularity, periods, np.datetime64(end, 'D').astype(np.int64),
+                                              **filters)
     except Exception as e:
         return jsonify({'error': str(e)}), 500
+    return jsonify({
+        'granularity': granularity,
+        'filters': filters,
+        'series': series,
+        'window': {'start': series[0]['period'], 'end': series[-1]['period'], **window},
+    })
+
+
+@app.route('/api/analytics/quantiles', methods=['GET'])
+def get_cohort_quantiles():
+    """
+    Approximate salary quantiles (and optionally the rank of `salary`) for a
+    cohort, from the KLL sketches. Filters: industry, experience (years),
+    location, company_size; q is a comma-separated list of quantiles.
+    """
+    if QUANTILE_SKETCHES is None or not QUANTILE_SKETCHES.ready:
+        return jsonify({'error': 'Quantile sketches are not available'}), 503
+    args = request.args
+    try:
+        quantiles = [float(q) for q in args.get('q', '0.1,0.25,0.5,0.75,0.9').split(',')]
+        if not all(0 <= q <= 1 for q in quantiles):
+            raise ValueError("quantiles must be between 0 and 1")
+        experience = int(args['experience']) if args.get('experience') else None
+        salary = float(args['salary']) if args.get('salary') else None
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+
+    cohort = {
+        'industry': args.get('industry') or None,
+        'experience': experience,
+        'location': args.get('location') or None,
+        'company_size': args.get('company_size') or None,
+    }
+    sketch = QUANTILE_SKETCHES.sketch(**cohort)
+    if not sketch.n:
+        return jsonify({'error': 'Insufficient data', 'sample_size': 0}), 404
+    payload = {
+        'cohort': {**cohort, 'experience_band': experience_band(experience) if experience is not None else None},
+        'sample_size': sketch.n,
+        'avg_salary': round(sketch.mean, 2),
+        'quantiles': {f'{q:g}': sketch.quantile(q) for q in quantiles},
+        'rank_error': round(sketch.rank_error(all_quantiles=len(quantiles) > 1), 4),
+        'exact': sketch.exact,
+    }
+    if salary is not None:
+        payload['salary'] = salary
+        payload['percentile_rank'] = round(sketch.rank(salary) * 100, 1)
+    return jsonify(payload)
 
 # =============================================================================
 # NEGOTIATION TOOLS
 # =============================================================================
 
+NEGOTIATION_REQUIRED_FIELDS = ['current_salary', 'target_salary', 'job_title', 'achievements']
+
+
 @app.route('/api/negotiation/script', methods=['POST'])
 def generate_negotiation_script():
     """Generate a personalized salary negotiation script with real market data."""
     data = request.json
-    required = ['current_salary', 'target_salary', 'job_title', 'achievements']
-    if not all(k in data for k in required):
+    if not all(k in data for k in NEGOTIATION_REQUIRED_FIELDS):
         return jsonify({'error': 'Missing required fields'}), 400
 
+    # Fetch real market data from Snowflake
+    market_data = get_negotiation_market_data(data.get('industry', 'Technology'), data.get('location', ''))
+    return jsonify({'script': build_negotiation_script(data, market_data)})
+
+
+def build_negotiation_script(data, market_data):
+    """The negotiation script for a validated request and its market data."""
     current = float(data['current_salary'])
     target = float(data['target_salary'])
     increase_pct = ((target - current) / current) * 100
     industry = data.get('industry', 'Technology')
     location = data.get('location', '')
 
-    # Fetch real market data from Snowflake
-    market_data = get_negotiation_market_data(industry, location)
-
     achievements_list = [a for a in data.get('achievements', []) if a and a.strip()]
     achievements_text = "; ".join(achievements_list[:5]) if achievements_list else "my consistent high performance"
 
@@ -1035,90 +5725,166 @@ def generate_negotiation_script():
         }
     }
 
-    return jsonify({'script': script})
-
-
-def get_negotiation_market_data(industry, location):
-    """Fetch real market data from Snowflake for negotiation context."""
-    try:
-        # Query for industry + location specific data
-        query = """
-            SELECT
-                COUNT(*) as sample_size,
-                ROUND(AVG(salary), 0) as avg_salary,
-                ROUND(MEDIAN(salary), 0) as median_salary,
-                ROUND(PERCENTILE_CONT(0.25) WITHIN GROUP (ORDER BY salary), 0) as p25,
-                ROUND(PERCENTILE_CONT(0.75) WITHIN GROUP (ORDER BY salary), 0) as p75,
-                ROUND(PERCENTILE_CONT(0.90) WITHIN GROUP (ORDER BY salary), 0) as p90,
-                ROUND(MIN(salary), 0) as min_salary,
-                ROUND(MAX(salary), 0) as max_salary
-            FROM salary_submissions
-            WHERE industry = %s
-        """
-        params = [industry]
+    return script
 
-        if location:
-            query += " AND location = %s"
-            params.append(location)
 
-        results = execute_query(query, params)
+MARKET_DATA_CACHE = TTLCache(
+    max_entries=int(os.getenv('MARKET_DATA_CACHE_MAX_ENTRIES', 2000)),
+    ttl=float(os.getenv('MARKET_DATA_CACHE_TTL', 300)),
+)
 
-        if results and results[0]['sample_size'] >= 5:
-            return {
-                'sample_size': results[0]['sample_size'],
-                'avg': results[0]['avg_salary'],
-                'median': results[0]['median_salary'],
-                'p25': results[0]['p25'],
-                'p75': results[0]['p75'],
-                'p90': results[0]['p90'],
-                'min': results[0]['min_salary'],
-                'max': results[0]['max_salary']
-            }
+# Fewest submissions a cohort needs before its own statistics are used
+MARKET_DATA_MIN_SAMPLE = 5
 
-        # Fallback to industry-only data if location-specific is too small
-        if location:
-            return get_negotiation_market_data(industry, None)
+DEFAULT_MARKET_DATA = {
+    'sample_size': 100,
+    'avg': 85000,
+    'median': 80000,
+    'p25': 70000,
+    'p75': 115000,
+    'p90': 140000,
+    'min': 50000,
+    'max': 200000
+}
 
-        # Fallback to all data
-        results = execute_query("""
-            SELECT
-                COUNT(*) as sample_size,
-                ROUND(AVG(salary), 0) as avg_salary,
-                ROUND(MEDIAN(salary), 0) as median_salary,
-                ROUND(PERCENTILE_CONT(0.25) WITHIN GROUP (ORDER BY salary), 0) as p25,
-                ROUND(PERCENTILE_CONT(0.75) WITHIN GROUP (ORDER BY salary), 0) as p75,
-                ROUND(PERCENTILE_CONT(0.90) WITHIN GROUP (ORDER BY salary), 0) as p90
-            FROM salary_submissions
-        """)
 
-        if results:
-            return {
-                'sample_size': results[0]['sample_size'],
-                'avg': results[0]['avg_salary'],
-                'median': results[0]['median_salary'],
-                'p25': results[0]['p25'],
-                'p75': results[0]['p75'],
-                'p90': results[0]['p90'],
-                'min': results[0].get('min_salary', results[0]['p25']),
-                'max': results[0].get('max_salary', results[0]['p90'])
-            }
+def get_negotiation_market_data(industry, location):
+    """
+    Fetch real market data from Snowflake for negotiation context.
 
+    Results are cached per (industry, location) cohort together with the
+    level they were resolved at ('location', 'industry' or 'all'), so a
+    new submission only drops the entries it can change. Concurrent misses
+    for one cohort share a single lookup.
+    """
+    try:
+        _, market_data = MARKET_DATA_CACHE.get_or_load(
+            (industry, location or None), lambda: resolve_negotiation_market_data(industry, location)
+        )
+        return dict(market_data)
     except Exception as e:
         print(f"Error fetching market data: {e}")
 
     # Return defaults if all else fails
-    return {
-        'sample_size': 100,
-        'avg': 95000,
-        'median': 90000,
-        'p25': 70000,
-        'p75': 115000,
-        'p90': 140000,
-        'min': 50000,
-        'max': 200000
+    return dict(DEFAULT_MARKET_DATA)
+
+
+def resolve_negotiation_market_data(industry, location):
+    """
+    (level, market data) for a cohort: industry + location when it has
+    enough submissions, else industry only, else all data. Served from the
+    quantile sketches once they are loaded.
+    """
+    if QUANTILE_SKETCHES is not None and QUANTILE_SKETCHES.ready:
+        for level, fields in (('location', {'industry': industry, 'location': location}),
+                              ('industry', {'industry': industry}), ('all', {})):
+            if level == 'location' and not location:
+                continue
+            sketch = QUANTILE_SKETCHES.sketch(**fields)
+            if sketch.n >= MARKET_DATA_MIN_SAMPLE or (level == 'all' and sketch.n):
+                return level, sketch_market_data(sketch)
+
+    # Query for industry + location specific data
+    query = """
+        SELECT
+            COUNT(*) as sample_size,
+            ROUND(AVG(salary), 0) as avg_salary,
+            ROUND(MEDIAN(salary), 0) as median_salary,
+            ROUND(PERCENTILE_CONT(0.25) WITHIN GROUP (ORDER BY salary), 0) as p25,
+            ROUND(PERCENTILE_CONT(0.75) WITHIN GROUP (ORDER BY salary), 0) as p75,
+            ROUND(PERCENTILE_CONT(0.90) WITHIN GROUP (ORDER BY salary), 0) as p90,
+            ROUND(MIN(salary), 0) as min_salary,
+            ROUND(MAX(salary), 0) as max_salary
+        FROM salary_submissions
+        WHERE industry = %s
+    """
+    params = [industry]
+
+    if location:
+        query += " AND location = %s"
+        params.append(location)
+
+    results = execute_query(query, params)
+
+    if results and results[0]['sample_size'] >= MARKET_DATA_MIN_SAMPLE:
+        return ('location' if location else 'industry'), {
+            'sample_size': results[0]['sample_size'],
+            'avg': results[0]['avg_salary'],
+            'median': results[0]['median_salary'],
+            'p25': results[0]['p25'],
+            'p75': results[0]['p75'],
+            'p90': results[0]['p90'],
+            'min': results[0]['min_salary'],
+            'max': results[0]['max_salary']
+        }
+
+    # Fallback to industry-only data if location-specific is too small
+    # (through the cache, so every small location shares one lookup)
+    if location:
+        return MARKET_DATA_CACHE.get_or_load(
+            (industry, None), lambda: resolve_negotiation_market_data(industry, None)
+        )
+
+    # Fallback to all data
+    results = execute_query("""
+        SELECT
+            COUNT(*) as sample_size,
+            ROUND(AVG(salary), 0) as avg_salary,
+            ROUND(MEDIAN(salary), 0) as median_salary,
+            ROUND(PERCENTILE_CONT(0.25) WITHIN GROUP (ORDER BY salary), 0) as p25,
+            ROUND(PERCENTILE_CONT(0.75) WITHIN GROUP (ORDER BY salary), 0) as p75,
+            ROUND(PERCENTILE_CONT(0.90) WITHIN GROUP (ORDER BY salary), 0) as p90
+        FROM salary_submissions
+    """)
+
+    if not results:
+        raise LookupError("No salary data")
+    return 'all', {
+        'sample_size': results[0]['sample_size'],
+        'avg': results[0]['avg_salary'],
+        'median': results[0]['median_salary'],
+        'p25': results[0]['p25'],
+        'p75': results[0]['p75'],
+        'p90': results[0]['p90'],
+        'min': results[0].get('min_salary', results[0]['p25']),
+        'max': results[0].get('max_salary', results[0]['p90'])
     }
 
 
+def submission_cohorts(rows):
+    """(industry, location) pairs of rows in SUBMISSION_COLUMNS order."""
+    industry, location = SUBMISSION_COLUMNS.index('industry'), SUBMISSION_COLUMNS.index('location')
+    return {(row[industry], row[location]) for row in rows}
+
+
+def invalidate_market_data(cohorts=None):
+    """
+    Drop cached market data that new submissions in `cohorts` ((industry,
+    location) pairs) can change; everything when cohorts is None.
+    Other workers' caches catch up within MARKET_DATA_CACHE_TTL (plus the
+    quantile sketches' sync or rebuild interval when they serve the data).
+    """
+    if cohorts is None:
+        MARKET_DATA_CACHE.clear()
+        return
+    cohorts = set(cohorts)
+    if not cohorts:
+        return
+    industries = {industry for industry, _ in cohorts}
+    for key, (level, _) in MARKET_DATA_CACHE.items():
+        if level == 'all' or (key[0] in industries and (level == 'industry' or key in cohorts)):
+            MARKET_DATA_CACHE.pop(key)
+
+
+def submissions_stored(rows):
+    """Bring in-process caches up to date with rows (SUBMISSION_COLUMNS order) just written."""
+    invalidate_market_data(submission_cohorts(rows))
+    if QUANTILE_SKETCHES is not None:
+        QUANTILE_SKETCHES.add_rows(sketch_rows(rows))
+    if SALARY_TRENDS.ready:
+        SALARY_TRENDS.add_rows(rows)
+
+
 def calculate_percentile_position(salary, market_data):
     """Calculate which percentile a salary falls into."""
     if salary <= market_data['p25']:
@@ -1200,31 +5966,303 @@ def build_ask_script(current, target, increase_pct, market_data, target_percenti
 # CORTEX AI CHATBOT
 # =============================================================================
 
-@app.route('/api/chatbot/advice', methods=['POST'])
-def get_chatbot_advice():
+class ResponseCache:
     """
-    Generate salary negotiation advice using Snowflake Cortex AI with RAG.
+    Two-level cache for chatbot completions.
 
-    This endpoint demonstrates three Snowflake Cortex AI features:
-    1. EMBED_TEXT_768 - Creates embeddings for semantic search
-    2. VECTOR_COSINE_SIMILARITY - Finds similar documents
-    3. COMPLETE - Generates responses with Llama 3.1
+    Level 1 is an exact match on the normalized (message, percentile bucket,
+    industry) key. Level 2 reuses an answer from the same (bucket, industry)
+    when the question embedding is within `similarity` cosine of a cached
+    question.
     """
-    data = request.json
 
-    # Extract user context
-    job_title = data.get('job_title', 'professional')
-    salary = data.get('salary', 0)
-    percentile = data.get('percentile', 50)
-    industry = data.get('industry', 'technology')
-    location = data.get('location', '')
-    median_salary = data.get('median_salary', 0)
-    user_message = data.get('message', '')
+    def __init__(self, max_entries=1000, ttl=3600, max_bytes=5_000_000, similarity=0.92):
+        self.similarity = similarity
+        self._groups = {}  # (bucket, industry) -> {key: embedding}
+        self._entries = TTLCache(
+            max_entries=max_entries,
+            ttl=ttl,
+            max_bytes=max_bytes,
+            sizeof=lambda value: len(json.dumps(value['payload'])),
+            on_evict=self._forget,
+        )
+        self.exact_hits = 0
+        self.semantic_hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def make_key(message, percentile, industry):
+        try:
+            bucket = min(3, max(0, int(float(percentile) // 25)))
+        except (TypeError, ValueError):
+            bucket = 2
+        normalized = ' '.join(re.findall(r"[a-z0-9']+", (message or '').lower()))
+        return normalized, bucket, (industry or '').strip().lower()
+
+    def get_exact(self, key):
+        """Payload for an exact key match, or None (a miss is not counted)."""
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        self.exact_hits += 1
+        return entry['payload']
+
+    def lookup(self, key, embed=None):
+        """
+        Return (payload, status, similarity, embedding) where status is
+        'exact', 'semantic' or 'miss'. `embed()` is only called when the exact
+        level misses; its result is returned so callers can reuse it.
+        """
+        entry = self._entries.get(key)
+        if entry is not None:
+            self.exact_hits += 1
+            return entry['payload'], 'exact', 1.0, None
+
+        embedding = embed() if embed else None
+        if embedding is not None:
+            with self._entries._lock:
+                group = self._groups.get(key[1:], {})
+                keys = list(group)
+                matrix = np.stack([group[k] for k in keys]) if keys else None
+            if matrix is not None:
+                scores = matrix @ embedding / (np.linalg.norm(matrix, axis=1) * (np.linalg.norm(embedding) or 1.0))
+                best = int(np.argmax(scores))
+                entry = self._entries.peek(keys[best]) if scores[best] >= self.similarity else None
+                if entry is not None:
+                    self.semantic_hits += 1
+                    return entry['payload'], 'semantic', round(min(1.0, float(scores[best])), 4), embedding
+        self.misses += 1
+        return None, 'miss', None, embedding
+
+    def set(self, key, payload, embedding=None):
+        with self._entries._lock:
+            if self._entries.set(key, {'payload': payload, 'embedding': embedding}) and embedding is not None:
+                self._groups.setdefault(key[1:], {})[key] = embedding
+
+    def stats(self):
+        stats = self._entries.stats()
+        lookups = self.exact_hits + self.semantic_hits + self.misses
+        return {
+            'entries': stats['entries'],
+            'bytes': stats['bytes'],
+            'evictions': stats['evictions'],
+            'exact_hits': self.exact_hits,
+            'semantic_hits': self.semantic_hits,
+            'misses': self.misses,
+            'hit_rate': round((self.exact_hits + self.semantic_hits) / lookups, 4) if lookups else 0.0,
+        }
+
+    def _forget(self, key, value):
+        group = self._groups.get(key[1:])
+        if group is not None:
+            group.pop(key, None)
+            if not group:
+                del self._groups[key[1:]]
+
+
+CHATBOT_CACHE = ResponseCache(
+    max_entries=int(os.getenv('CHATBOT_CACHE_MAX_ENTRIES', 1000)),
+    ttl=float(os.getenv('CHATBOT_CACHE_TTL', 3600)),
+    max_bytes=int(os.getenv('CHATBOT_CACHE_MAX_BYTES', 5_000_000)),
+    similarity=float(os.getenv('CHATBOT_CACHE_SIMILARITY', 0.92)),
+)
+
+
+class ModelClient:
+    """
+    Interface for the LLM behind the chatbot.
+
+    `stream(prompt)` yields text chunks as they become available;
+    `complete(prompt)` returns the whole response (or None if the model
+    produced nothing).
+    """
+
+    name = None
+    powered_by = None
+
+    def stream(self, prompt):
+        raise NotImplementedError
+
+    def complete(self, prompt):
+        return ''.join(self.stream(prompt)).strip() or None
+
+    async def complete_async(self, prompt):
+        """Awaitable complete(); the default runs it in a worker thread."""
+        return await asyncio.to_thread(self.complete, prompt)
+
+    async def stream_async(self, prompt):
+        """Async iterator over stream(); the default chunks complete_async()."""
+        for chunk in chunk_text(await self.complete_async(prompt) or ''):
+            yield chunk
+
+
+class CortexModelClient(ModelClient):
+    """
+    Snowflake Cortex COMPLETE. The SQL function returns the full completion
+    in one result, so stream() chunks it once it arrives.
+    """
+
+    name = 'llama3.1-8b'
+    powered_by = 'Snowflake Cortex AI + RAG'
+
+    COMPLETE_SQL = """
+        SELECT SNOWFLAKE.CORTEX.COMPLETE(
+            'llama3.1-8b',
+            %s
+        ) as response
+    """
+
+    def complete(self, prompt):
+        # Use Snowflake Cortex COMPLETE with Llama model
+        return self._response_text(execute_query(self.COMPLETE_SQL, [prompt]))
+
+    async def complete_async(self, prompt):
+        return self._response_text(await execute_query_async(self.COMPLETE_SQL, [prompt]))
+
+    @staticmethod
+    def _response_text(result):
+        if result and result[0].get('response'):
+            response_text = result[0]['response']
+            # Clean up the response if needed
+            if isinstance(response_text, str):
+                response_text = response_text.strip()
+            return response_text
+        return None
+
+    def stream(self, prompt):
+        yield from chunk_text(self.complete(prompt) or '')
 
-    # RAG: Retrieve relevant knowledge base articles
-    retrieved_context, rag_sources = retrieve_relevant_context(user_message, top_k=3)
 
-    # Build context-aware prompt with RAG context
+class StubModelClient(ModelClient):
+    """
+    Local stand-in model for development and latency testing. Waits
+    `first_token_delay` seconds, then emits a canned answer word by word
+    with `token_delay` seconds between words.
+    """
+
+    name = 'stub'
+    powered_by = 'CounterMarket stub model + RAG'
+
+    def __init__(self, first_token_delay=0.0, token_delay=0.0):
+        self.first_token_delay = first_token_delay
+        self.token_delay = token_delay
+
+    @staticmethod
+    def _answer(prompt):
+        question = re.search(r"USER'S QUESTION: (.*)", prompt)
+        return (
+            f"You asked: {question.group(1).strip() if question else 'how to negotiate'}. "
+            "Start from the market data for your role, write down your three strongest "
+            "achievements, and ask for a specific number slightly above your target. "
+            "If the base salary is fixed, negotiate the rest of the package."
+        )
+
+    def stream(self, prompt):
+        time.sleep(self.first_token_delay)
+        for n, chunk in enumerate(chunk_text(self._answer(prompt), words=1)):
+            if n and self.token_delay:
+                time.sleep(self.token_delay)
+            yield chunk
+
+    async def complete_async(self, prompt):
+        return ''.join([chunk async for chunk in self.stream_async(prompt)]).strip() or None
+
+    async def stream_async(self, prompt):
+        await asyncio.sleep(self.first_token_delay)
+        for n, chunk in enumerate(chunk_text(self._answer(prompt), words=1)):
+            if n and self.token_delay:
+                await asyncio.sleep(self.token_delay)
+            yield chunk
+
+
+def chunk_text(text, words=8):
+    """Split text into chunks of `words` words, keeping the whitespace."""
+    tokens = re.findall(r'\S+\s*', text)
+    for i in range(0, len(tokens), words):
+        yield ''.join(tokens[i:i + words])
+
+
+_model_client = None
+
+
+def get_model_client():
+    """Model client selected by CHATBOT_MODEL (cortex or stub)."""
+    global _model_client
+    if _model_client is None:
+        kind = os.getenv('CHATBOT_MODEL', 'cortex').lower()
+        if kind == 'stub':
+            _model_client = StubModelClient(
+                first_token_delay=float(os.getenv('CHATBOT_STUB_FIRST_TOKEN_DELAY', 0.5)),
+                token_delay=float(os.getenv('CHATBOT_STUB_TOKEN_DELAY', 0.02)),
+            )
+        elif kind == 'cortex':
+            _model_client = CortexModelClient()
+        else:
+            raise ValueError(f"Unknown CHATBOT_MODEL '{kind}' (expected 'cortex' or 'stub')")
+    return _model_client
+
+
+def parse_advice_request(data):
+    """Extract the user context shared by the chatbot endpoints."""
+    return {
+        'job_title': data.get('job_title', 'professional'),
+        'salary': data.get('salary', 0),
+        'percentile': data.get('percentile', 50),
+        'industry': data.get('industry', 'technology'),
+        'location': data.get('location', ''),
+        'median_salary': data.get('median_salary', 0),
+        'user_message': data.get('message', ''),
+    }
+
+
+def prepare_advice(ctx, cache_enabled):
+    """
+    Cache lookup and RAG retrieval for a chatbot question, as one QueryPlan.
+
+    An exact cache hit returns straight away. Otherwise the question is
+    embedded once, then the semantic cache lookup and article retrieval run
+    concurrently on that embedding (retrieval starts immediately when it
+    embeds the question inside its own SQL). Returns a dict with cache_key,
+    cached (payload or None), cache_status, similarity, embedding, context
+    and sources.
+    """
+    message = ctx['user_message']
+    cache_key = ResponseCache.make_key(message, ctx['percentile'], ctx['industry'])
+    prepared = {'cache_key': cache_key, 'cached': None, 'cache_status': None, 'similarity': None,
+                'embedding': None, 'context': '', 'sources': []}
+    if cache_enabled:
+        cached = CHATBOT_CACHE.get_exact(cache_key)
+        if cached is not None:
+            return {**prepared, 'cached': cached, 'cache_status': 'exact', 'similarity': 1.0}
+
+    def embed():
+        try:
+            return embed_question(message)
+        except Exception as e:
+            print(f"Question embedding error: {e}")
+            return None
+
+    plan = QueryPlan()
+    plan.add('embedding', embed)
+    if cache_enabled:
+        plan.add('cache', lambda embedding: CHATBOT_CACHE.lookup(cache_key, lambda: embedding),
+                 depends_on=('embedding',))
+    if (KNOWLEDGE_INDEX is not None and len(KNOWLEDGE_INDEX)) or not get_storage_backend().supports_cortex:
+        plan.add('rag', lambda embedding: retrieve_relevant_context(message, top_k=3, question_embedding=embedding),
+                 depends_on=('embedding',))
+    else:
+        plan.add('rag', retrieve_relevant_context, message, top_k=3)
+    results = plan.run()
+
+    prepared['embedding'] = results['embedding']
+    prepared['context'], prepared['sources'] = results['rag']
+    if cache_enabled:
+        prepared['cached'], prepared['cache_status'], prepared['similarity'], _ = results['cache']
+    return prepared
+
+
+def build_advice_prompt(ctx, retrieved_context):
+    """Build context-aware prompt with RAG context."""
     rag_section = ""
     if retrieved_context:
         rag_section = f"""
@@ -1235,17 +6273,17 @@ Use the above articles to inform your response when relevant.
 
 """
 
-    prompt = f"""You are a helpful salary negotiation advisor for CounterMarket, a pay equity platform.
+    return f"""You are a helpful salary negotiation advisor for CounterMarket, a pay equity platform.
 {rag_section}
 USER'S PROFILE:
-- Job Title: {job_title}
-- Current Salary: ${salary:,.0f}
-- Industry: {industry}
-- Location: {location}
-- Percentile Rank: {percentile}th percentile
-- Market Median: ${median_salary:,.0f}
+- Job Title: {ctx['job_title']}
+- Current Salary: ${ctx['salary']:,.0f}
+- Industry: {ctx['industry']}
+- Location: {ctx['location']}
+- Percentile Rank: {ctx['percentile']}th percentile
+- Market Median: ${ctx['median_salary']:,.0f}
 
-USER'S QUESTION: {user_message}
+USER'S QUESTION: {ctx['user_message']}
 
 INSTRUCTIONS:
 - Provide helpful, specific advice for their salary negotiation
@@ -1256,45 +6294,155 @@ INSTRUCTIONS:
 - If they're below median, suggest how to negotiate
 - If above, suggest how to maintain their position"""
 
-    try:
-        # Use Snowflake Cortex COMPLETE with Llama model
-        result = execute_query("""
-            SELECT SNOWFLAKE.CORTEX.COMPLETE(
-                'llama3.1-8b',
-                %s
-            ) as response
-        """, [prompt])
 
-        if result and result[0].get('response'):
-            response_text = result[0]['response']
-            # Clean up the response if needed
-            if isinstance(response_text, str):
-                response_text = response_text.strip()
-            return jsonify({
-                'response': response_text,
-                'model': 'llama3.1-8b',
-                'rag_enabled': bool(retrieved_context),
-                'sources': rag_sources,
-                'powered_by': 'Snowflake Cortex AI + RAG'
-            })
-        else:
-            return jsonify({
-                'response': get_fallback_advice(percentile, salary, median_salary),
-                'model': 'fallback',
-                'rag_enabled': False,
-                'powered_by': 'CounterMarket'
-            })
+def cached_advice_payload(prepared):
+    """Response body for a question answered from CHATBOT_CACHE."""
+    return {**prepared['cached'], 'cache': {
+        'status': prepared['cache_status'], 'similarity': prepared['similarity'], **CHATBOT_CACHE.stats()}}
+
+
+def model_advice_payload(ctx, prepared, model, response_text, error=None, cache_enabled=True):
+    """
+    Response body once the model has answered (or failed): the completion,
+    cached for next time, or rule-based fallback advice.
+    """
+    if response_text and error is None:
+        payload = {
+            'response': response_text,
+            'model': model.name,
+            'rag_enabled': bool(prepared['context']),
+            'sources': prepared['sources'],
+            'powered_by': model.powered_by
+        }
+        if cache_enabled:
+            CHATBOT_CACHE.set(prepared['cache_key'], payload, prepared['embedding'])
+            payload = {**payload, 'cache': {'status': 'miss', 'similarity': None, **CHATBOT_CACHE.stats()}}
+        return payload
+
+    # Fallback to rule-based advice if Cortex fails
+    payload = {
+        'response': get_fallback_advice(ctx['percentile'], ctx['salary'], ctx['median_salary']),
+        'model': 'fallback',
+        'rag_enabled': False,
+        'powered_by': 'CounterMarket'
+    }
+    if error is not None:
+        payload['error'] = error
+    return payload
+
+
+@app.route('/api/chatbot/advice', methods=['POST'])
+def get_chatbot_advice():
+    """
+    Generate salary negotiation advice using Snowflake Cortex AI with RAG.
+
+    This endpoint demonstrates three Snowflake Cortex AI features:
+    1. EMBED_TEXT_768 - Creates embeddings for semantic search
+    2. VECTOR_COSINE_SIMILARITY - Finds similar documents
+    3. COMPLETE - Generates responses with Llama 3.1
+    """
+    ctx = parse_advice_request(request.json)
+
+    # Serve repeated (or near-identical) questions from the response cache
+    cache_enabled = os.getenv('CHATBOT_CACHE_ENABLED', '1') == '1'
+    # RAG: Retrieve relevant knowledge base articles
+    prepared = prepare_advice(ctx, cache_enabled)
+    if prepared['cached'] is not None:
+        return jsonify(cached_advice_payload(prepared))
+    prompt = build_advice_prompt(ctx, prepared['context'])
 
+    model = get_model_client()
+    try:
+        with span('llm'):
+            response_text = model.complete(prompt)
     except Exception as e:
         print(f"Cortex AI error: {e}")
-        # Fallback to rule-based advice if Cortex fails
-        return jsonify({
-            'response': get_fallback_advice(percentile, salary, median_salary),
-            'model': 'fallback',
-            'rag_enabled': False,
-            'error': str(e),
-            'powered_by': 'CounterMarket'
-        })
+        return jsonify(model_advice_payload(ctx, prepared, model, None, str(e), cache_enabled))
+    return jsonify(model_advice_payload(ctx, prepared, model, response_text, None, cache_enabled))
+
+
+def sse_event(event, data):
+    """Format one server-sent event with a JSON payload."""
+    return f"event: {event}\ndata: {json.dumps(data)}\n\n"
+
+
+SSE_HEADERS = {'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'}
+
+
+def cached_advice_events(prepared):
+    """(event, data) pairs replaying a cached answer as a stream."""
+    cached = prepared['cached']
+    yield 'sources', {'sources': cached['sources'], 'rag_enabled': cached['rag_enabled']}
+    for chunk in chunk_text(cached['response']):
+        yield 'chunk', {'text': chunk}
+    yield 'done', {
+        'model': cached['model'],
+        'powered_by': cached['powered_by'],
+        'cache': {'status': prepared['cache_status'], 'similarity': prepared['similarity'],
+                  **CHATBOT_CACHE.stats()},
+    }
+
+
+def sources_event(prepared):
+    return 'sources', {'sources': prepared['sources'], 'rag_enabled': bool(prepared['context'])}
+
+
+def final_advice_events(ctx, prepared, model, chunks, error, cache_enabled):
+    """(event, data) pairs closing a stream once the model has finished or failed."""
+    response_text = ''.join(chunks).strip()
+    if error is None and response_text:
+        model_advice_payload(ctx, prepared, model, response_text, None, cache_enabled)
+        yield 'done', {'model': model.name, 'powered_by': model.powered_by}
+        return
+
+    # Fallback to rule-based advice if the model failed before answering
+    if not chunks:
+        for chunk in chunk_text(get_fallback_advice(ctx['percentile'], ctx['salary'], ctx['median_salary'])):
+            yield 'chunk', {'text': chunk}
+    done = {'model': 'fallback' if not chunks else model.name, 'powered_by': 'CounterMarket'}
+    if error:
+        done['error'] = error
+    yield 'done', done
+
+
+@app.route('/api/chatbot/advice/stream', methods=['POST'])
+def stream_chatbot_advice():
+    """
+    Streaming variant of /api/chatbot/advice using server-sent events.
+
+    Emits `sources` as soon as RAG retrieval finishes, then `chunk` events
+    with the completion text as the model produces it, then `done` with the
+    model name (and `error` if the model failed and fallback advice was
+    streamed instead).
+    """
+    ctx = parse_advice_request(request.json)
+    cache_enabled = os.getenv('CHATBOT_CACHE_ENABLED', '1') == '1'
+
+    def generate():
+        prepared = prepare_advice(ctx, cache_enabled)
+        if prepared['cached'] is not None:
+            for event in cached_advice_events(prepared):
+                yield sse_event(*event)
+            return
+
+        yield sse_event(*sources_event(prepared))
+        model = get_model_client()
+        chunks = []
+        error = None
+        try:
+            # Streamed responses finish after the request trace closes, so
+            # this span only reaches the histogram (and includes client writes)
+            with span('llm'):
+                for chunk in model.stream(build_advice_prompt(ctx, prepared['context'])):
+                    chunks.append(chunk)
+                    yield sse_event('chunk', {'text': chunk})
+        except Exception as e:
+            print(f"Cortex AI error: {e}")
+            error = str(e)
+        for event in final_advice_events(ctx, prepared, model, chunks, error, cache_enabled):
+            yield sse_event(*event)
+
+    return Response(stream_with_context(generate()), mimetype='text/event-stream', headers=SSE_HEADERS)
 
 def get_fallback_advice(percentile, salary, median_salary):
     """Fallback advice when Cortex AI is unavailable."""
@@ -1347,14 +6495,30 @@ You've earned your position through strong performance. Continue to deliver resu
 
 @app.route('/api/admin/reset-data', methods=['POST'])
 def reset_sample_data():
-    """Reset and regenerate sample data with realistic salaries."""
+    """
+    Reset and regenerate sample data with realistic salaries.
+
+    Optional JSON body: {"rows": 500, "seed": 42} to control the volume and
+    make the generated dataset reproducible.
+    """
+    data = request.get_json(silent=True) or {}
     try:
         # Clear existing data
         execute_query("DELETE FROM salary_submissions", fetch=False)
         print("Cleared existing data...")
 
         # Insert new realistic data
-        insert_snowflake_sample_data()
+        insert_snowflake_sample_data(count=data.get('rows'), seed=data.get('seed'))
+
+        if SALARY_INDEX.ready:
+            refresh_salary_index()
+        if SALARY_TRENDS.ready:
+            SALARY_TRENDS.load()
+        ANALYTICS_SNAPSHOT.mark_dirty()
+        SUBMISSIONS_VERSION.mark_dirty()
+        invalidate_market_data()
+        if QUANTILE_SKETCHES is not None and QUANTILE_SKETCHES.ready:
+            QUANTILE_SKETCHES.rebuild()
 
         # Get new count
         result = execute_query("SELECT COUNT(*) as cnt FROM salary_submissions")
@@ -1367,10 +6531,91 @@ def reset_sample_data():
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
+
+@app.route('/api/admin/companies', methods=['POST'])
+def upsert_company_route():
+    """
+    Add or update a company in the registry, e.g.
+    {"key": "stripe", "name": "Stripe", "multiplier": 1.55, "tier": "top", "aliases": []}.
+    This worker reloads immediately; other workers pick the change up on
+    their next version check.
+    """
+    data = request.get_json(silent=True) or {}
+    key = str(data.get('key', '')).lower().strip()
+    name = str(data.get('name', '')).strip()
+    tier = data.get('tier', 'mid')
+    aliases = data.get('aliases', [])
+    try:
+        multiplier = float(data['multiplier'])
+    except (KeyError, TypeError, ValueError):
+        return jsonify({'error': 'multiplier must be a number'}), 400
+    if not key or not name:
+        return jsonify({'error': 'key and name are required'}), 400
+    if not 0 < multiplier < 10 or tier not in ('top', 'high', 'mid') or not isinstance(aliases, list):
+        return jsonify({'error': "multiplier must be in (0, 10), tier one of top/high/mid, aliases a list"}), 400
+
+    try:
+        updated = upsert_company(key, name, multiplier, tier, [str(a) for a in aliases])
+        companies = COMPANY_REGISTRY.load()
+        return jsonify({
+            'message': f"Company {'updated' if updated else 'added'}",
+            'company': dict(COMPANY_REGISTRY.snapshot.companies[key]),
+            'registry_size': companies
+        })
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
 # =============================================================================
 # HEALTH CHECK
 # =============================================================================
 
+@app.route('/api/ready', methods=['GET'])
+def readiness_check():
+    """Readiness probe: 200 once the schema is verified and warm-up has finished."""
+    try:
+        READINESS.ensure_schema()
+    except SchemaNotReady:
+        pass
+    status = READINESS.status()
+    return jsonify(status), 200 if status['status'] in ('ready', 'degraded') else 503
+
+
+@app.route('/metrics', methods=['GET'])
+def metrics():
+    """Prometheus text exposition of this worker's latency histograms and pool state."""
+    lines = []
+    for histogram in (REQUEST_SECONDS, SPAN_SECONDS, QUERY_SECONDS):
+        lines.extend(histogram.exposition())
+
+    pools = get_pool_stats()['pools']
+    pool_metrics = (
+        ('in_use', 'gauge', 'Connections currently borrowed.'),
+        ('idle', 'gauge', 'Idle connections in the pool.'),
+        ('max_size', 'gauge', 'Pool capacity.'),
+        ('created', 'counter', 'Connections opened.'),
+        ('destroyed', 'counter', 'Connections closed.'),
+        ('checkouts', 'counter', 'Connection checkouts.'),
+    )
+    for key, kind, help_text in pool_metrics:
+        name = f"countermarket_db_pool_{key}" + ('_total' if kind == 'counter' else '')
+        lines += [f"# HELP {name} {help_text}", f"# TYPE {name} {kind}"]
+        lines += [f'{name}{{database="{prometheus_escape(db)}"}} {stats[key]}' for db, stats in pools.items()]
+    name = 'countermarket_db_pool_wait_seconds_max'
+    lines += [f"# HELP {name} Longest wait for a free connection slot.", f"# TYPE {name} gauge"]
+    lines += [f'{name}{{database="{prometheus_escape(db)}"}} {stats["wait_time_max_ms"] / 1000:.6f}'
+              for db, stats in pools.items()]
+    name = 'countermarket_db_pool_connect_seconds_max'
+    lines += [f"# HELP {name} Longest connection open or health check.", f"# TYPE {name} gauge"]
+    lines += [f'{name}{{database="{prometheus_escape(db)}"}} {stats["connect_time_max_ms"] / 1000:.6f}'
+              for db, stats in pools.items()]
+
+    if WRITE_BEHIND is not None:
+        lines += ["# HELP countermarket_write_behind_pending Submissions queued but not yet stored.",
+                  "# TYPE countermarket_write_behind_pending gauge",
+                  f"countermarket_write_behind_pending {WRITE_BEHIND.pending}"]
+    return Response('\n'.join(lines) + '\n', mimetype='text/plain; version=0.0.4')
+
+
 @app.route('/api/health', methods=['GET'])
 def health_check():
     """Health check with Snowflake connection test."""
@@ -1379,14 +6624,22 @@ def health_check():
         count = result[0]['cnt'] if result else 0
         return jsonify({
             'status': 'healthy',
-            'database': 'Snowflake connected',
+            'database': f"{get_storage_backend().name} connected",
             'data_points': count,
+            'connection_pool': get_pool_stats(),
+            'write_behind': WRITE_BEHIND.stats() if WRITE_BEHIND is not None else None,
+            'market_data_cache': MARKET_DATA_CACHE.stats(),
+            'quantile_sketches': QUANTILE_SKETCHES.stats() if QUANTILE_SKETCHES is not None else None,
+            'adjusted_pay_gap': ADJUSTED_PAY_GAP.stats(),
+            'columnar_snapshot': COLUMNAR_SNAPSHOT.stats() if COLUMNAR_SNAPSHOT is not None else None,
+            'query_cache': QUERY_CACHE.stats() if QUERY_CACHE is not None else None,
             'timestamp': datetime.now().isoformat()
         })
     except Exception as e:
         return jsonify({
             'status': 'error',
             'database': str(e),
+            'connection_pool': get_pool_stats(),
             'timestamp': datetime.now().isoformat()
         }), 500
 
@@ -1412,4 +6665,10 @@ if __name__ == '__main__':
     print("CounterMarket API - Snowflake + Cortex AI")
     print("Hack Violet 2026")
     print(f"{'='*50}\n")
+    # Development server: bootstrap the database here, as `flask init-db` would
+    try:
+        init_snowflake_database()
+    except Exception as e:
+        print(f"Database init error: {e}")
+        print("Make sure your Snowflake credentials (or STORAGE_BACKEND) are correct in .env")
     app.run(debug=True, port=5001)
@@ -0,0 +1,245 @@
+"""
+CounterMarket ASGI entry point
+
+Serves the latency-bound routes (compare, analytics, negotiation script and
+the chatbot) as async handlers, so a slow Cortex completion waits on the
+event loop instead of pinning a worker thread and hundreds of chatbot
+requests can be in flight per process. Every other route, CORS preflights
+included, is passed through to the Flask app unchanged.
+
+    pip install -r requirements-asgi.txt
+    uvicorn asgi:application --port 5001 --workers 4
+
+Warehouse round trips run through execute_query_async: on Snowflake,
+Cortex COMPLETE is submitted with execute_async and polled, so it holds
+neither a thread nor a pooled connection while it runs. Short queries
+(cohort stats, RAG retrieval, snapshot builds) run in the event loop's
+worker threads.
+"""
+import asyncio
+import json
+import os
+from urllib.parse import parse_qsl
+
+try:
+    from asgiref.wsgi import WsgiToAsgi
+except ImportError as e:
+    raise ImportError("The ASGI mode needs asgiref: pip install -r requirements-asgi.txt") from e
+
+import app as countermarket
+
+flask_app = countermarket.app
+wsgi_application = WsgiToAsgi(flask_app)
+
+CORS_HEADERS = [(b'access-control-allow-origin', b'*')]
+
+
+class Request:
+    def __init__(self, scope, body):
+        self.scope = scope
+        self.body = body
+        self.args = dict(parse_qsl(scope.get('query_string', b'').decode()))
+
+    @property
+    def json(self):
+        return json.loads(self.body or b'null')
+
+
+async def read_body(receive):
+    body = b''
+    while True:
+        message = await receive()
+        body += message.get('body', b'')
+        if not message.get('more_body'):
+            return body
+
+
+async def send_json(send, payload, status=200, headers=None):
+    # Serialize with the Flask app's JSON provider so both modes return
+    # byte-identical bodies (Decimal, datetime, key order)
+    body = flask_app.json.dumps(payload).encode()
+    await send({
+        'type': 'http.response.start',
+        'status': status,
+        'headers': [
+            (b'content-type', b'application/json'),
+            (b'content-length', str(len(body)).encode()),
+            *CORS_HEADERS,
+            *[(k.lower().encode(), v.encode()) for k, v in (headers or {}).items()],
+        ],
+    })
+    await send({'type': 'http.response.body', 'body': body})
+
+
+# =============================================================================
+# ROUTES
+# =============================================================================
+
+async def compare_salary(request, send):
+    data = request.json
+    try:
+        user_salary, experience, company_data = countermarket.parse_compare_record(data)
+    except ValueError as e:
+        return await send_json(send, {'error': str(e)}, 400)
+
+    try:
+        args = (data['industry'], experience, user_salary, company_data)
+        if countermarket.SALARY_INDEX.ready:
+            stat, rank = countermarket.fetch_comparison_inputs(*args)
+        else:
+            stat, rank = await asyncio.to_thread(countermarket.fetch_comparison_inputs, *args)
+        if stat['sample_size'] == 0:
+            return await send_json(send, {'error': 'Insufficient data', 'sample_size': 0}, 404)
+        await send_json(send, countermarket.build_comparison(user_salary, stat, rank, company_data))
+    except Exception as e:
+        await send_json(send, {'error': str(e)}, 500)
+
+
+def analytics_route(build_payload):
+    async def handler(request, send):
+        snapshot = countermarket.ANALYTICS_SNAPSHOT
+        try:
+            if snapshot.data is None:
+                data, version, built_at = await asyncio.to_thread(snapshot.get)
+            else:
+                data, version, built_at = snapshot.get()
+            await send_json(send, build_payload(data, request),
+                            headers=countermarket.analytics_headers(version, built_at))
+        except Exception as e:
+            await send_json(send, {'error': str(e)}, 500)
+    return handler
+
+
+async def negotiation_script(request, send):
+    data = request.json
+    if not all(k in data for k in countermarket.NEGOTIATION_REQUIRED_FIELDS):
+        return await send_json(send, {'error': 'Missing required fields'}, 400)
+    market_data = await asyncio.to_thread(
+        countermarket.get_negotiation_market_data, data.get('industry', 'Technology'), data.get('location', '')
+    )
+    await send_json(send, {'script': countermarket.build_negotiation_script(data, market_data)})
+
+
+async def chatbot_advice(request, send):
+    ctx = countermarket.parse_advice_request(request.json)
+    cache_enabled = os.getenv('CHATBOT_CACHE_ENABLED', '1') == '1'
+    prepared = await asyncio.to_thread(countermarket.prepare_advice, ctx, cache_enabled)
+    if prepared['cached'] is not None:
+        return await send_json(send, countermarket.cached_advice_payload(prepared))
+
+    model = countermarket.get_model_client()
+    response_text, error = None, None
+    try:
+        with countermarket.span('llm'):
+            response_text = await model.complete_async(countermarket.build_advice_prompt(ctx, prepared['context']))
+    except Exception as e:
+        print(f"Cortex AI error: {e}")
+        error = str(e)
+    await send_json(send, countermarket.model_advice_payload(ctx, prepared, model, response_text, error, cache_enabled))
+
+
+async def stream_chatbot_advice(request, send):
+    ctx = countermarket.parse_advice_request(request.json)
+    cache_enabled = os.getenv('CHATBOT_CACHE_ENABLED', '1') == '1'
+    await send({
+        'type': 'http.response.start',
+        'status': 200,
+        'headers': [
+            (b'content-type', b'text/event-stream; charset=utf-8'),
+            *CORS_HEADERS,
+            *[(k.lower().encode(), v.encode()) for k, v in countermarket.SSE_HEADERS.items()],
+        ],
+    })
+
+    async def emit(event, data):
+        await send({'type': 'http.response.body', 'body': countermarket.sse_event(event, data).encode(),
+                    'more_body': True})
+
+    prepared = await asyncio.to_thread(countermarket.prepare_advice, ctx, cache_enabled)
+    if prepared['cached'] is not None:
+        events = countermarket.cached_advice_events(prepared)
+    else:
+        await emit(*countermarket.sources_event(prepared))
+        model = countermarket.get_model_client()
+        chunks, error = [], None
+        try:
+            with countermarket.span('llm'):
+                async for chunk in model.stream_async(countermarket.build_advice_prompt(ctx, prepared['context'])):
+                    chunks.append(chunk)
+                    await emit('chunk', {'text': chunk})
+        except Exception as e:
+            print(f"Cortex AI error: {e}")
+            error = str(e)
+        events = countermarket.final_advice_events(ctx, prepared, model, chunks, error, cache_enabled)
+    for event in events:
+        await emit(*event)
+    await send({'type': 'http.response.body', 'body': b''})
+
+
+ROUTES = {
+    ('POST', '/api/salary/compare'): compare_salary,
+    ('GET', '/api/analytics/pay-gap'): analytics_route(
+        lambda data, request: countermarket.pay_gap_payload(data)),
+    ('GET', '/api/analytics/industry-comparison'): analytics_route(
+        lambda data, request: {'industries': data['industries']}),
+    ('GET', '/api/analytics/location-comparison'): analytics_route(
+        lambda data, request: {'locations': data['locations']}),
+    ('GET', '/api/analytics/company-comparison'): analytics_route(
+        lambda data, request: countermarket.company_comparison_payload(data, request.args.get('company', ''))),
+    ('POST', '/api/negotiation/script'): negotiation_script,
+    ('POST', '/api/chatbot/advice'): chatbot_advice,
+    ('POST', '/api/chatbot/advice/stream'): stream_chatbot_advice,
+}
+
+
+async def lifespan(receive, send):
+    while True:
+        message = await receive()
+        if message['type'] == 'lifespan.startup':
+            await send({'type': 'lifespan.startup.complete'})
+        elif message['type'] == 'lifespan.shutdown':
+            await send({'type': 'lifespan.shutdown.complete'})
+            return
+
+
+async def application(scope, receive, send):
+    if scope['type'] == 'lifespan':
+        return await lifespan(receive, send)
+    handler = ROUTES.get((scope.get('method'), scope.get('path'))) if scope['type'] == 'http' else None
+    if handler is None:
+        return await wsgi_application(scope, receive, send)
+
+    trace = countermarket.start_trace(profile=False)
+    status = 500
+
+    async def send_traced(message):
+        nonlocal status
+        if message['type'] == 'http.response.start':
+            status = message['status']
+            if countermarket.server_timing_enabled():
+                message = {**message, 'headers': [*message['headers'],
+                                                  (b'server-timing', trace.server_timing().encode())]}
+        await send(message)
+
+    try:
+        await dispatch(handler, scope, receive, send_traced)
+    finally:
+        countermarket.finish_trace(trace, scope['path'], scope['method'], status)
+
+
+async def dispatch(handler, scope, receive, send):
+    request = Request(scope, await read_body(receive))
+    if not countermarket.READINESS.schema_ok:
+        try:
+            await asyncio.to_thread(countermarket.READINESS.ensure_schema)
+        except countermarket.SchemaNotReady as e:
+            return await send_json(send, {'error': 'Service not ready', 'detail': str(e)}, 503,
+                                   headers={'Retry-After': os.getenv('SCHEMA_RETRY_INTERVAL', '5')})
+    if scope['method'] == 'POST':
+        try:
+            valid = isinstance(request.json, dict)
+        except ValueError:
+            valid = False
+        if not valid:
+            return await send_json(send, {'error': 'Request body must be a JSON object'}, 400)
+    await handler(request, send)
@@ -0,0 +1,167 @@
+"""Benchmark the cohort quantile sketches: accuracy and latency vs exact answers
+
+Usage:
+    python bench_quantile_sketches.py                 # synthetic population only
+    python bench_quantile_sketches.py --database      # also compare against the SQL aggregates
+"""
+import argparse
+import json
+import time
+
+import numpy as np
+
+QUANTILES = (0.1, 0.25, 0.5, 0.75, 0.9)
+
+
+def percentile_ms(samples, q):
+    return round(float(np.percentile(samples, q)) * 1000, 3)
+
+
+def synthetic_rows(app, size, seed):
+    columns = {name: [] for name in app.SKETCH_ROW_COLUMNS}
+    for chunk in app.generate_sample_population(size, seed, '2025-12-31'):
+        for name in columns:
+            columns[name].append(chunk[name])
+    return {name: np.concatenate(values) for name, values in columns.items()}
+
+
+def rank_errors(sketch, exact_sorted):
+    """
+    Distance from q to the true rank range of the sketch's q-quantile, over
+    a grid of q. Salaries repeat, so a value's rank is the interval between
+    the mass below it and the mass at or below it.
+    """
+    grid = np.linspace(0.01, 0.99, 99)
+    n = len(exact_sorted)
+    errors = []
+    for q in grid:
+        value = sketch.quantile(q)
+        low = np.searchsorted(exact_sorted, value, side='left') / n
+        high = np.searchsorted(exact_sorted, value, side='right') / n
+        errors.append(max(0.0, low - q, q - high))
+    return errors
+
+
+def bench_synthetic(app, args):
+    data = synthetic_rows(app, args.size, args.seed)
+    rows = list(zip(*(data[name].tolist() for name in app.SKETCH_ROW_COLUMNS)))
+
+    start = time.perf_counter()
+    sketches = app.CohortSketches(args.k)
+    for i in range(0, len(rows), 10_000):
+        sketches.add_rows(rows[i:i + 10_000])
+    build_seconds = time.perf_counter() - start
+
+    # Workers build their own sketches; merging them must not lose accuracy
+    shards = [app.CohortSketches(args.k) for _ in range(args.workers)]
+    for i, row in enumerate(rows):
+        shards[i % args.workers].add_rows([row])
+    merged = app.CohortSketches(args.k)
+    for shard in shards:
+        merged.merge(shard)
+
+    bands = np.array([app.experience_band(int(y)) for y in data['years_experience']])
+    industry = data['industry'][0]
+    location = data['location'][0]
+    filters = {
+        'all': ({}, np.ones(len(rows), dtype=bool)),
+        'industry': ({'industry': industry}, data['industry'] == industry),
+        'industry_location': ({'industry': industry, 'location': location},
+                              (data['industry'] == industry) & (data['location'] == location)),
+        'industry_band': ({'industry': industry, 'band': '3-5'}, (data['industry'] == industry) & (bands == '3-5')),
+    }
+
+    results = {
+        'population': {'size': args.size, 'k': args.k, 'cohorts': len(sketches), 'workers_merged': args.workers},
+        'build_seconds': round(build_seconds, 3),
+        'retained_values': sum(s.retained() for s in sketches.cohorts.values()),
+        'serialized_bytes': len(json.dumps(sketches.to_dict())),
+        'rank_error_bound': round(app.normalized_rank_error(args.k, all_quantiles=True), 4),
+        'queries': {},
+    }
+    for name, (fields, mask) in filters.items():
+        exact_sorted = np.sort(data['salary'][mask])
+        for label, source in (('single', sketches), ('merged', merged)):
+            times = []
+            for _ in range(args.repeat):
+                t = time.perf_counter()
+                sketch = app.KLLSketch(args.k)
+                for part in source.select(**fields):
+                    sketch.merge(part)
+                sketch.quantile(0.5)
+                times.append(time.perf_counter() - t)
+            errors = rank_errors(sketch, exact_sorted)
+            results['queries'][f'{name}/{label}'] = {
+                'rows': int(mask.sum()),
+                'exact': sketch.exact,
+                'max_rank_error': round(max(errors), 4),
+                'mean_rank_error': round(float(np.mean(errors)), 5),
+                'merge_and_query_p50_ms': percentile_ms(times, 50),
+            }
+    return results
+
+
+def bench_database(app, args):
+    """Sketch answers vs PERCENTILE_CONT for the negotiation cohorts."""
+    app.READINESS.ensure_schema()
+    index = app.QuantileSketchIndex(k=args.k)
+    start = time.perf_counter()
+    index.rebuild()
+    build_seconds = time.perf_counter() - start
+
+    cohorts = app.execute_query("""
+        SELECT industry, location, COUNT(*) as cnt FROM salary_submissions
+        GROUP BY industry, location ORDER BY cnt DESC LIMIT 10
+    """)
+    sql = """
+        SELECT COUNT(*) as n,
+               PERCENTILE_CONT(0.25) WITHIN GROUP (ORDER BY salary) as p25,
+               MEDIAN(salary) as p50,
+               PERCENTILE_CONT(0.75) WITHIN GROUP (ORDER BY salary) as p75,
+               PERCENTILE_CONT(0.90) WITHIN GROUP (ORDER BY salary) as p90
+        FROM salary_submissions WHERE industry = %s AND location = %s
+    """
+    sql_times, sketch_times, relative_errors = [], [], []
+    for cohort in cohorts:
+        t = time.perf_counter()
+        exact = app.execute_query(sql, [cohort['industry'], cohort['location']])[0]
+        sql_times.append(time.perf_counter() - t)
+        index._merged.clear()  # time the merge, not the cache
+        t = time.perf_counter()
+        sketch = index.sketch(industry=cohort['industry'], location=cohort['location'])
+        approx = [sketch.quantile(q) for q in (0.25, 0.5, 0.75, 0.9)]
+        sketch_times.append(time.perf_counter() - t)
+        for value, key in zip(approx, ('p25', 'p50', 'p75', 'p90')):
+            relative_errors.append(abs(value - float(exact[key])) / float(exact[key]))
+    return {
+        'backend': app.get_storage_backend().name,
+        'build_seconds': round(build_seconds, 3),
+        'cohorts_compared': len(cohorts),
+        'max_relative_error': round(max(relative_errors), 4) if relative_errors else None,
+        'mean_relative_error': round(float(np.mean(relative_errors)), 5) if relative_errors else None,
+        'sql': {'p50_ms': percentile_ms(sql_times, 50), 'p95_ms': percentile_ms(sql_times, 95)},
+        'sketch': {'p50_ms': percentile_ms(sketch_times, 50), 'p95_ms': percentile_ms(sketch_times, 95)},
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--size', type=int, default=500_000, help='synthetic population size')
+    parser.add_argument('-k', type=int, default=200, help='sketch accuracy parameter')
+    parser.add_argument('--workers', type=int, default=8, help='shards merged in the merge test')
+    parser.add_argument('--repeat', type=int, default=20)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--database', action='store_true',
+                        help='also compare against PERCENTILE_CONT on the configured backend')
+    args = parser.parse_args()
+
+    import app
+
+    report = {'synthetic': bench_synthetic(app, args)}
+    if args.database:
+        report['database'] = bench_database(app, args)
+    print(json.dumps(report, indent=2))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,130 @@
+"""Benchmark the in-process vector index: recall vs latency against exact search
+
+Usage:
+    python bench_vector_index.py                     # synthetic corpus only
+    python bench_vector_index.py --knowledge-base    # also compare against the SQL path
+"""
+import argparse
+import json
+import time
+
+import numpy as np
+
+
+def percentile_ms(samples, q):
+    return round(float(np.percentile(samples, q)) * 1000, 3)
+
+
+def clustered_corpus(n, dim, clusters, seed):
+    """Unit vectors scattered around random cluster centres (embedding-like)."""
+    rng = np.random.default_rng(seed)
+    centres = rng.normal(size=(clusters, dim))
+    labels = rng.integers(0, clusters, n)
+    vectors = centres[labels] + 0.35 * rng.normal(size=(n, dim))
+    return (vectors / np.linalg.norm(vectors, axis=1, keepdims=True)).astype(np.float32)
+
+
+def bench_synthetic(app, args):
+    # Queries come from the same distribution as the corpus but are held out
+    vectors = clustered_corpus(args.size + args.queries, args.dim, max(8, args.size // 500), args.seed)
+    corpus, queries = vectors[:args.size], vectors[args.size:]
+
+    flat = app.VectorIndex(args.dim, ivf_threshold=args.size + 1)
+    flat.add(list(range(args.size)), corpus)
+    ivf = app.VectorIndex(args.dim, ivf_threshold=1)
+    start = time.perf_counter()
+    ivf.add(list(range(args.size)), corpus)
+    train_seconds = time.perf_counter() - start
+
+    exact, flat_times = [], []
+    for q in queries:
+        t = time.perf_counter()
+        exact.append({i for i, _ in flat.search(q, args.k)})
+        flat_times.append(time.perf_counter() - t)
+
+    results = {
+        'corpus': {'size': args.size, 'dim': args.dim, 'queries': args.queries, 'k': args.k},
+        'flat': {'recall': 1.0, 'p50_ms': percentile_ms(flat_times, 50), 'p95_ms': percentile_ms(flat_times, 95)},
+        'ivf': {'nlist': len(ivf._centroids), 'train_seconds': round(train_seconds, 3), 'nprobe': []},
+    }
+    for nprobe in (1, 2, 4, 8, 16, 32):
+        ivf.nprobe = nprobe
+        hits, times = 0, []
+        for q, truth in zip(queries, exact):
+            t = time.perf_counter()
+            found = {i for i, _ in ivf.search(q, args.k)}
+            times.append(time.perf_counter() - t)
+            hits += len(found & truth)
+        results['ivf']['nprobe'].append({
+            'nprobe': nprobe,
+            'recall': round(hits / (len(queries) * args.k), 4),
+            'p50_ms': percentile_ms(times, 50),
+            'p95_ms': percentile_ms(times, 95),
+        })
+    return results
+
+
+def bench_knowledge_base(app, args):
+    """Local index vs the exact SQL ranking over negotiation_knowledge."""
+    questions = [
+        "How do I ask for a raise?",
+        "What should I say when they make me an offer?",
+        "I work remotely, does that change my pay?",
+        "Is there a gender pay gap where I work?",
+        "When is the best time to negotiate?",
+        "I just got promoted but the raise is small",
+        "How do I find out what I'm worth?",
+        "I get nervous talking about money",
+    ]
+    app.READINESS.ensure_schema()
+    app.refresh_knowledge_index()
+    index = app.KNOWLEDGE_INDEX
+
+    def timed(fn):
+        times, titles = [], []
+        for question in questions:
+            t = time.perf_counter()
+            _, sources = fn(question)
+            times.append(time.perf_counter() - t)
+            titles.append({s['title'] for s in sources})
+        return times, titles
+
+    index_times, index_titles = timed(lambda q: app.retrieve_relevant_context(q, top_k=args.k))
+    app.KNOWLEDGE_INDEX = None
+    try:
+        sql_times, sql_titles = timed(lambda q: app.retrieve_relevant_context(q, top_k=args.k))
+    finally:
+        app.KNOWLEDGE_INDEX = index
+
+    hits = sum(len(a & b) for a, b in zip(index_titles, sql_titles))
+    total = sum(len(b) for b in sql_titles) or 1
+    return {
+        'backend': app.get_storage_backend().name,
+        'articles': len(index),
+        'recall_vs_sql': round(hits / total, 4),
+        'sql': {'p50_ms': percentile_ms(sql_times, 50), 'p95_ms': percentile_ms(sql_times, 95)},
+        'index': {'p50_ms': percentile_ms(index_times, 50), 'p95_ms': percentile_ms(index_times, 95)},
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--size', type=int, default=50000, help='synthetic corpus size')
+    parser.add_argument('--dim', type=int, default=768)
+    parser.add_argument('--queries', type=int, default=200)
+    parser.add_argument('-k', type=int, default=3)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--knowledge-base', action='store_true',
+                        help='also benchmark retrieve_relevant_context against the SQL path')
+    args = parser.parse_args()
+
+    import app
+
+    report = {'synthetic': bench_synthetic(app, args)}
+    if args.knowledge_base:
+        report['knowledge_base'] = bench_knowledge_base(app, args)
+    print(json.dumps(report, indent=2))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,273 @@
+"""Benchmark every API route against a seeded local database
+
+Seeds a deterministic SQLite dataset (`flask init-db` with a fixed seed and
+anchor date), starts the API in a separate process with the stub chatbot
+model, drives each route with concurrent requests and reports p50/p95/p99
+latency, throughput and the server's peak RSS as JSON. Save a run and pass
+it to --compare to diff two commits.
+
+Usage:
+    python benchmark.py --output before.json
+    python benchmark.py --output after.json --compare before.json
+    python benchmark.py --rows 100000 --concurrency 16 --routes salary_compare analytics_pay_gap
+"""
+import argparse
+import http.client
+import json
+import os
+import platform
+import random
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+from loadtest_asgi import free_port, process_tree_rss
+
+ROOT = os.path.dirname(os.path.abspath(__file__))
+
+
+def percentile_ms(samples, q):
+    return round(float(np.percentile(samples, q)) * 1000, 3)
+
+
+def dataset_values(db_path):
+    """Industries, locations, job titles and experience range of the seeded data."""
+    conn = sqlite3.connect(db_path)
+    try:
+        def distinct(column):
+            return [row[0] for row in conn.execute(f"SELECT DISTINCT {column} FROM salary_submissions ORDER BY 1")]
+        return {
+            'industries': distinct('industry'),
+            'locations': distinct('location'),
+            'job_titles': distinct('job_title'),
+            'max_experience': conn.execute("SELECT MAX(years_experience) FROM salary_submissions").fetchone()[0],
+        }
+    finally:
+        conn.close()
+
+
+def route_scenarios(values):
+    """name -> (method, path, payload(rng, i) or None)."""
+    companies = ['Google', 'Meta', 'Amazon', 'Stripe', 'JPMorgan Chase', 'Unknown Startup']
+
+    def compare(rng, i):
+        return {
+            'job_title': rng.choice(values['job_titles']),
+            'industry': rng.choice(values['industries']),
+            'years_experience': rng.randint(0, values['max_experience']),
+            'salary': rng.randrange(50_000, 250_000, 1000),
+            'location': rng.choice(values['locations']),
+            'company_name': rng.choice(companies),
+        }
+
+    def negotiation(rng, i):
+        current = rng.randrange(60_000, 180_000, 1000)
+        return {
+            'current_salary': current,
+            'target_salary': current + rng.randrange(5_000, 40_000, 1000),
+            'job_title': rng.choice(values['job_titles']),
+            'industry': rng.choice(values['industries']),
+            'location': rng.choice(values['locations']),
+            'achievements': ['Led the platform migration', 'Cut infrastructure costs 20%'],
+        }
+
+    def advice(rng, i):
+        # Distinct questions so every request reaches the model
+        return {
+            'message': f"How should I negotiate my salary? (benchmark request {i})",
+            'salary': rng.randrange(60_000, 180_000, 1000),
+            'industry': rng.choice(values['industries']),
+        }
+
+    return {
+        'salary_compare': ('POST', '/api/salary/compare', compare),
+        'analytics_pay_gap': ('GET', '/api/analytics/pay-gap', None),
+        'analytics_industry': ('GET', '/api/analytics/industry-comparison', None),
+        'analytics_location': ('GET', '/api/analytics/location-comparison', None),
+        'analytics_company': ('GET', '/api/analytics/company-comparison?company=Google', None),
+        'negotiation_script': ('POST', '/api/negotiation/script', negotiation),
+        'chatbot_advice': ('POST', '/api/chatbot/advice', advice),
+    }
+
+
+def request(port, method, path, payload=None):
+    conn = http.client.HTTPConnection('127.0.0.1', port, timeout=60)
+    try:
+        body = json.dumps(payload) if payload is not None else None
+        headers = {'Content-Type': 'application/json'} if body else {}
+        conn.request(method, path, body=body, headers=headers)
+        response = conn.getresponse()
+        response.read()
+        return response.status
+    finally:
+        conn.close()
+
+
+def start_server(args, env, port):
+    if args.server == 'asgi':
+        cmd = [sys.executable, '-m', 'uvicorn', 'asgi:application', '--port', str(port), '--log-level', 'warning']
+    else:
+        cmd = [sys.executable, '-m', 'flask', '--app', 'app', 'run', '--port', str(port), '--with-threads']
+    server = subprocess.Popen(cmd, env=env, cwd=ROOT, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    deadline = time.time() + 120
+    while time.time() < deadline:
+        if server.poll() is not None:
+            raise SystemExit(f"Server exited with code {server.returncode}")
+        try:
+            if request(port, 'GET', '/api/ready') == 200:
+                return server
+        except OSError:
+            pass
+        time.sleep(0.25)
+    server.kill()
+    raise SystemExit("Server was not ready within 120s")
+
+
+def bench_route(port, method, path, payload_fn, args, seed):
+    rng = random.Random(seed)
+    payloads = [payload_fn(rng, i) if payload_fn else None for i in range(args.warmup + args.requests)]
+    for payload in payloads[:args.warmup]:
+        request(port, method, path, payload)
+
+    def one(payload):
+        start = time.perf_counter()
+        try:
+            status = request(port, method, path, payload)
+        except OSError:
+            status = None
+        return time.perf_counter() - start, status
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=args.concurrency) as pool:
+        results = list(pool.map(one, payloads[args.warmup:]))
+    elapsed = time.perf_counter() - start
+    latencies = [seconds for seconds, _ in results]
+    return {
+        'requests': args.requests,
+        'errors': sum(status != 200 for _, status in results),
+        'throughput_rps': round(args.requests / elapsed, 1),
+        'mean_ms': round(float(np.mean(latencies)) * 1000, 3),
+        'p50_ms': percentile_ms(latencies, 50),
+        'p95_ms': percentile_ms(latencies, 95),
+        'p99_ms': percentile_ms(latencies, 99),
+    }
+
+
+def git_revision():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=ROOT, capture_output=True,
+                              text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare_reports(baseline, current):
+    """Per-route change (%) of each latency percentile and throughput."""
+    diff = {}
+    for route, now in current['routes'].items():
+        before = baseline['routes'].get(route)
+        if before is None:
+            continue
+        diff[route] = {
+            key: round((now[key] - before[key]) / before[key] * 100, 1) if before[key] else None
+            for key in ('p50_ms', 'p95_ms', 'p99_ms', 'throughput_rps')
+        }
+    if baseline.get('peak_rss_mb'):
+        diff['peak_rss_mb'] = round((current['peak_rss_mb'] - baseline['peak_rss_mb']) / baseline['peak_rss_mb'] * 100, 1)
+    return diff
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--rows', type=int, default=20000, help='seeded salary_submissions rows')
+    parser.add_argument('--seed', type=int, default=42)
+    parser.add_argument('--requests', type=int, default=500, help='measured requests per route')
+    parser.add_argument('--warmup', type=int, default=20, help='unmeasured requests per route')
+    parser.add_argument('--concurrency', type=int, default=8)
+    parser.add_argument('--model-delay', type=float, default=0.05, help='stub model first-token delay (s)')
+    parser.add_argument('--server', choices=('werkzeug', 'asgi'), default='werkzeug')
+    parser.add_argument('--routes', nargs='+', help='subset of routes to run (default: all)')
+    parser.add_argument('--output', help='also write the report to this file')
+    parser.add_argument('--compare', help='baseline report to diff against')
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        db_path = os.path.join(tmp, 'benchmark.db')
+        env = {
+            **os.environ,
+            'STORAGE_BACKEND': 'sqlite',
+            'LOCAL_DB_PATH': db_path,
+            'SAMPLE_DATA_ROWS': str(args.rows),
+            'SAMPLE_DATA_SEED': str(args.seed),
+            'SAMPLE_DATA_ANCHOR_DATE': '2025-12-31',
+            'CHATBOT_MODEL': 'stub',
+            'CHATBOT_STUB_FIRST_TOKEN_DELAY': str(args.model_delay),
+            'CHATBOT_STUB_TOKEN_DELAY': '0',
+            'CHATBOT_CACHE_ENABLED': '0',
+            'WRITE_BEHIND_ENABLED': '0',
+            'PROFILE_SAMPLE_RATE': '0',
+        }
+        subprocess.run([sys.executable, '-m', 'flask', '--app', 'app', 'init-db'], env=env, cwd=ROOT,
+                       check=True, stdout=subprocess.DEVNULL)
+        scenarios = route_scenarios(dataset_values(db_path))
+        selected = args.routes or list(scenarios)
+        unknown = [name for name in selected if name not in scenarios]
+        if unknown:
+            parser.error(f"unknown routes: {', '.join(unknown)} (choose from {', '.join(scenarios)})")
+
+        port = free_port()
+        server = start_server(args, env, port)
+        peak = [process_tree_rss(server.pid)]
+        idle_rss = peak[0]
+        stop = threading.Event()
+
+        def sample():
+            while not stop.wait(0.1):
+                peak[0] = max(peak[0], process_tree_rss(server.pid))
+
+        sampler = threading.Thread(target=sample, daemon=True)
+        sampler.start()
+        routes = {}
+        try:
+            for n, name in enumerate(selected):
+                method, path, payload_fn = scenarios[name]
+                routes[name] = bench_route(port, method, path, payload_fn, args, args.seed + n)
+                print(f"{name}: {json.dumps(routes[name])}", file=sys.stderr)
+        finally:
+            stop.set()
+            sampler.join()
+            server.terminate()
+            server.wait()
+
+    report = {
+        'meta': {
+            'revision': git_revision(),
+            'python': platform.python_version(),
+            'server': args.server,
+            'rows': args.rows,
+            'seed': args.seed,
+            'requests': args.requests,
+            'concurrency': args.concurrency,
+            'model_delay_seconds': args.model_delay,
+        },
+        'idle_rss_mb': round(idle_rss / 2**20, 1),
+        'peak_rss_mb': round(peak[0] / 2**20, 1),
+        'routes': routes,
+    }
+    if args.compare:
+        with open(args.compare) as f:
+            report['change_percent'] = compare_reports(json.load(f), report)
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+    print(json.dumps(report, indent=2))
+
+
+if __name__ == '__main__':
+    main()
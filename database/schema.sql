@@ -94,6 +94,14 @@ CREATE TABLE IF NOT EXISTS transparent_companies (
     founded_year INTEGER,
     description TEXT,
 
+    -- Company Registry (read by the API; bump revision when editing by hand
+    -- so running workers reload)
+    company_key VARCHAR(100), -- lowercase lookup key, e.g. 'goldman sachs'
+    salary_multiplier DECIMAL(4, 2), -- pay relative to market median (1.0 = market)
+    pay_tier VARCHAR(20), -- 'top', 'high', 'mid'
+    aliases VARCHAR(2000), -- JSON array of alternate names
+    revision INTEGER DEFAULT 1,
+
     created_at TIMESTAMP_NTZ DEFAULT CURRENT_TIMESTAMP(),
     updated_at TIMESTAMP_NTZ DEFAULT CURRENT_TIMESTAMP()
 );
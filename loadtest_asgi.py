@@ -0,0 +1,175 @@
+"""Load-test chatbot concurrency: ASGI mode vs the sync Flask workers
+
+Starts the server on a throwaway SQLite database with the stub model (a fixed
+first-token delay standing in for a Cortex completion), fires waves of
+concurrent /api/chatbot/advice requests and reports throughput, latency and
+the server's peak resident memory (Linux /proc) per concurrency level.
+
+Usage:
+    python loadtest_asgi.py                           # ASGI (uvicorn), 1 worker
+    python loadtest_asgi.py --server wsgi --threads 8 # gunicorn sync baseline
+    python loadtest_asgi.py --concurrency 10 100 500 --delay 1.0
+"""
+import argparse
+import asyncio
+import json
+import os
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+import numpy as np
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def process_tree_rss(pid):
+    """Resident memory (bytes) of a process and its descendants."""
+    total, pending = 0, [pid]
+    while pending:
+        current = pending.pop()
+        try:
+            with open(f'/proc/{current}/status') as f:
+                total += next(int(line.split()[1]) * 1024 for line in f if line.startswith('VmRSS:'))
+            for task in os.listdir(f'/proc/{current}/task'):
+                with open(f'/proc/{current}/task/{task}/children') as f:
+                    pending.extend(int(child) for child in f.read().split())
+        except (FileNotFoundError, ProcessLookupError, StopIteration):
+            continue
+    return total
+
+
+def start_server(args, port, db_path):
+    env = {
+        **os.environ,
+        'STORAGE_BACKEND': 'sqlite',
+        'LOCAL_DB_PATH': db_path,
+        'CHATBOT_MODEL': 'stub',
+        'CHATBOT_STUB_FIRST_TOKEN_DELAY': str(args.delay),
+        'CHATBOT_STUB_TOKEN_DELAY': '0',
+        'CHATBOT_CACHE_ENABLED': '0',
+    }
+    root = os.path.dirname(os.path.abspath(__file__))
+    subprocess.run([sys.executable, '-m', 'flask', '--app', 'app', 'init-db'], env=env, cwd=root,
+                   check=True, stdout=subprocess.DEVNULL)
+    if args.server == 'asgi':
+        cmd = [sys.executable, '-m', 'uvicorn', 'asgi:application', '--port', str(port),
+               '--workers', str(args.workers), '--log-level', 'warning', '--backlog', '4096']
+    else:
+        cmd = [sys.executable, '-m', 'gunicorn', 'app:app', '--bind', f'127.0.0.1:{port}',
+               '--workers', str(args.workers), '--threads', str(args.threads), '--backlog', '4096']
+    server = subprocess.Popen(cmd, env=env, cwd=root,
+                              stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    deadline = time.time() + 120
+    while time.time() < deadline:
+        try:
+            with socket.create_connection(('127.0.0.1', port), timeout=1):
+                return server
+        except OSError:
+            if server.poll() is not None:
+                raise SystemExit(f"Server exited with code {server.returncode}")
+            time.sleep(0.5)
+    server.kill()
+    raise SystemExit("Server did not start within 120s")
+
+
+async def post(port, path, payload):
+    body = json.dumps(payload).encode()
+    reader, writer = await asyncio.open_connection('127.0.0.1', port)
+    writer.write(
+        f"POST {path} HTTP/1.1\r\nHost: 127.0.0.1\r\nContent-Type: application/json\r\n"
+        f"Content-Length: {len(body)}\r\nConnection: close\r\n\r\n".encode() + body
+    )
+    await writer.drain()
+    response = await reader.read()
+    writer.close()
+    return int(response.split(b' ', 2)[1])
+
+
+async def wave(port, concurrency, requests):
+    semaphore = asyncio.Semaphore(concurrency)
+    latencies, errors = [], 0
+
+    async def one(n):
+        nonlocal errors
+        async with semaphore:
+            start = time.perf_counter()
+            try:
+                status = await post(port, '/api/chatbot/advice', {
+                    'message': f'How should I negotiate offer number {n}?',
+                    'salary': 90000, 'median_salary': 100000, 'percentile': 35, 'industry': 'Technology',
+                })
+            except OSError:
+                status = None
+            latencies.append(time.perf_counter() - start)
+            errors += status != 200
+
+    start = time.perf_counter()
+    await asyncio.gather(*(one(n) for n in range(requests)))
+    elapsed = time.perf_counter() - start
+    return {
+        'concurrency': concurrency,
+        'requests': requests,
+        'errors': errors,
+        'seconds': round(elapsed, 2),
+        'requests_per_second': round(requests / elapsed, 1),
+        'p50_ms': round(float(np.percentile(latencies, 50)) * 1000, 1),
+        'p95_ms': round(float(np.percentile(latencies, 95)) * 1000, 1),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--server', choices=('asgi', 'wsgi'), default='asgi')
+    parser.add_argument('--workers', type=int, default=1)
+    parser.add_argument('--threads', type=int, default=4, help='threads per gunicorn worker (wsgi only)')
+    parser.add_argument('--concurrency', type=int, nargs='+', default=[1, 10, 50, 100, 200, 400])
+    parser.add_argument('--rounds', type=int, default=3, help='requests per level = rounds x concurrency')
+    parser.add_argument('--delay', type=float, default=1.0, help='simulated completion latency (s)')
+    args = parser.parse_args()
+
+    port = free_port()
+    with tempfile.TemporaryDirectory() as tmp:
+        server = start_server(args, port, os.path.join(tmp, 'loadtest.db'))
+        try:
+            idle_rss = process_tree_rss(server.pid)
+            levels = []
+            for concurrency in args.concurrency:
+                peak = [idle_rss]
+                stop = threading.Event()
+
+                def sample():
+                    while not stop.wait(0.1):
+                        peak[0] = max(peak[0], process_tree_rss(server.pid))
+
+                sampler = threading.Thread(target=sample, daemon=True)
+                sampler.start()
+                result = asyncio.run(wave(port, concurrency, concurrency * args.rounds))
+                stop.set()
+                sampler.join()
+                result['peak_rss_mb'] = round(peak[0] / 2**20, 1)
+                levels.append(result)
+                print(json.dumps(result), file=sys.stderr)
+        finally:
+            server.terminate()
+            server.wait()
+
+    print(json.dumps({
+        'server': args.server,
+        'workers': args.workers,
+        'threads': args.threads if args.server == 'wsgi' else None,
+        'simulated_completion_seconds': args.delay,
+        'idle_rss_mb': round(idle_rss / 2**20, 1),
+        'levels': levels,
+    }, indent=2))
+
+
+if __name__ == '__main__':
+    main()